@@ -12,6 +12,7 @@ from opscore.utility.qstr import qstr
 
 import centroidTools as ct
 import dbRoutinesAGCC as dbRoutinesAGCC
+import timing
 nCams = 6
 
 class AgccCmd(object):
@@ -29,11 +30,13 @@ class AgccCmd(object):
         self.vocab = [
             ('ping', '', self.ping),
             ('status', '', self.status),
+            ('timing', '[@reset]', self.timing),
+            ('profile', '@(start|stop) [@workers] [<duration>]', self.profile),
             ('expose', '@(test|dark|object) [<visit>] [<exptime>] '
                        '[<cameras>] [<combined>] [<centroid>] [<cMethod>] '
                        '[<threadDelay>] [@tecOFF]', self.expose),
             ('abort', '[<cameras>]', self.abort),
-            ('reconnect', '', self.reconnect),
+            ('reconnect', '[<camera>]', self.reconnect),
             ('shutter','@(close|open) [<cameras>]', self.shutterOps),
             ('setframe', '[<cameras>] [<bx>] [<by>] <cx> <cy> <sx> <sy>', self.setframe),
             ('resetframe', '[<cameras>]', self.resetframe),
@@ -42,14 +45,21 @@ class AgccCmd(object):
             ('getmodestring', '', self.getmodestring),
             ('settemperature', '[<cameras>] <temperature>', self.settemperature),
             ('setregions', '<camera> <regions>', self.setregions),
-            ('startsequence', '<sequence> <exptime> <count> <cameras> [<combined>]', self.startsequence),
+            ('startsequence', '<sequence> <exptime> <count> <cameras> [<combined>] [<centroid>] '
+                              '[<cadence>] [<visit>] [<cMethod>] [<archive>] [<stack>] [<stackClip>]',
+             self.startsequence),
             ('stopsequence', '<sequence>', self.stopsequence),
+            ('saveFrames', '[<cameras>]', self.saveFrames),
             ('inusesequence', '<sequence>', self.inusesequence),
             ('inusecamera', '<camera>', self.inusecamera),
             ('insertVisit', '<visit>', self.insertVisit),
             ('setCentroidParams','[<nmin>] [<thresh>] [<deblend>]',
              self.setCentroidParams),
             ('setImageParams', '', self.setImageParams),
+            ('recentroid', '[<cameras>] [<frameId>] [<nmin>] [<thresh>] [<deblend>] [<cMethod>] [@writeDB]',
+             self.recentroid),
+            ('sweep', '<camera> [<frameId>] [<threshList>] [<deblendList>] [<minareaList>] [<nminList>] '
+                      '[<cMethod>]', self.sweep),
         ]
 
         # Define typed command arguments for the above commands.
@@ -77,6 +87,16 @@ class AgccCmd(object):
                                         keys.Key("thresh", types.Float(), help="threshhold for finding spots"),
                                         keys.Key("deblend", types.Float(), help="deblend_cont for sep"),
                                         keys.Key("cMethod", types.String(), help="method to use for centroiding (win, sep)"),
+                                        keys.Key("duration", types.Float(), help="Profiling duration in seconds"),
+                                        keys.Key("cadence", types.Float(), help="Seconds between sequence exposure starts"),
+                                        keys.Key("archive", types.Int(), help="Write every Nth sequence exposure, 0 for anomalies only"),
+                                        keys.Key("frameId", types.Int(), help="agc_exposure_id of a frame kept in memory"),
+                                        keys.Key("stack", types.Int(), help="Number of sequence frames in each co-add"),
+                                        keys.Key("stackClip", types.Float(), help="Sigma clipping threshold of the co-adds, 0 for none"),
+                                        keys.Key("threshList", types.String(), help="thresh values to sweep, e.g. 3,5,10"),
+                                        keys.Key("deblendList", types.String(), help="deblend values to sweep"),
+                                        keys.Key("minareaList", types.String(), help="minarea values to sweep"),
+                                        keys.Key("nminList", types.String(), help="nmin values to sweep"),
                                         )
         # initialize centroid parameters
         self.setCentroidParams(None)
@@ -89,7 +109,16 @@ class AgccCmd(object):
         cmd.finish()
 
     def reconnect(self, cmd):
-        """Reconnect camera devices"""
+        """Reconnect camera devices, or only the given camera"""
+
+        cmdKeys = cmd.cmd.keywords
+        if 'camera' in cmdKeys:
+            n = cmdKeys['camera'].values[0] - 1
+            if n < 0 or n >= nCams:
+                cmd.fail('text="camera id error: %d"' % (n + 1))
+                return
+            self.actor.camera.reconnectCamera(cmd, n)
+            return
 
         #self.actor.connectCamera(cmd, self.actor.actorConfig)
         self.actor.reloadCamera(cmd, self.actor.actorConfig)
@@ -105,6 +134,35 @@ class AgccCmd(object):
         cmd.inform('text="Present!"')
         cmd.finish()
 
+    def timing(self, cmd):
+        """Report the per-stage exposure timing statistics, in ms"""
+
+        cmdKeys = cmd.cmd.keywords
+        for stage, count, p50, p95, p99, tmax in timing.stats.summary():
+            cmd.inform('agc_timing=%s,%d,%.1f,%.1f,%.1f,%.1f' % (stage, count, p50, p95, p99, tmax))
+        if 'reset' in cmdKeys:
+            timing.stats.reset()
+            cmd.inform('text="timing statistics reset"')
+        cmd.finish()
+
+    def profile(self, cmd):
+        """Profile the actor threads, and with workers the photometry processes.
+
+        The profiles are written to $ICS_MHS_DATA_ROOT/agcc/profiles on stop,
+        or after duration seconds.
+        """
+
+        cmdKeys = cmd.cmd.keywords
+        if 'start' in cmdKeys:
+            duration = cmdKeys['duration'].values[0] if 'duration' in cmdKeys else None
+            if self.actor.camera.startProfile(cmd, workers='workers' in cmdKeys, duration=duration):
+                cmd.finish('text="profiling started"')
+            else:
+                cmd.fail('text="profiling is already running"')
+        else:
+            self.actor.camera.stopProfile(cmd)
+            cmd.finish()
+
     def setOrGetVisit(self, cmd):
         """Set and return the visit passed in the command keys, or fetch one from gen2. """
 
@@ -165,11 +223,13 @@ class AgccCmd(object):
         expType = cmdKeys[0].name
         visit = self.setOrGetVisit(cmd)
         self.actor.logger.info(f'Starting exposure of type {expType} for pfs_visit_id={visit}')
+        timeline = timing.Timeline()
 
         # Ask gen2 updating the telescope status
-        self.actor.cmdr.call(actor='gen2',
-                             cmdStr=f'updateTelStatus caller=agcc visit={visit}',
-                             timeLim=5.0)
+        with timeline.span('telStatus'):
+            self.actor.cmdr.call(actor='gen2',
+                                 cmdStr=f'updateTelStatus caller=agcc visit={visit}',
+                                 timeLim=5.0)
 
         if 'exptime' in cmdKeys:
             expTime = cmdKeys['exptime'].values[0]
@@ -231,7 +291,7 @@ class AgccCmd(object):
         cmd.inform(f'text="pfs_visit_id: {visit}"')
         self.actor.camera.expose(cmd, expTime, expType, cams, combined, centroid, visit, 
                                  self.cParms, cMethod, self.iParms, threadDelay=threadDelay,
-                                 tecOFF=tecOFF)
+                                 tecOFF=tecOFF, timeline=timeline)
 
 
     def abort(self, cmd):
@@ -387,7 +447,10 @@ class AgccCmd(object):
         self.actor.camera.setregions(cmd, camid, regions)
 
     def startsequence(self, cmd):
-        """Start a exposure sequence"""
+        """Start a exposure sequence, count=0 runs until stopsequence.
+
+        The exposures start every cadence seconds, or back to back without one.
+        """
 
         cmdKeys = cmd.cmd.keywords
         seq_id = cmdKeys['sequence'].values[0] - 1
@@ -407,6 +470,26 @@ class AgccCmd(object):
                 cmd.fail()
                 return
             cams.append(k)
+        centroid = False
+        if 'centroid' in cmdKeys:
+            if cmdKeys['centroid'].values[0] == 1:
+                centroid = True
+        cadence = 0.0
+        if 'cadence' in cmdKeys:
+            cadence = cmdKeys['cadence'].values[0]
+        cMethod = "sep"
+        if 'cMethod' in cmdKeys:
+            cMethod = cmdKeys['cMethod'].values[0]
+        archive = None
+        if 'archive' in cmdKeys:
+            archive = cmdKeys['archive'].values[0]
+        stack = 0
+        if 'stack' in cmdKeys:
+            stack = cmdKeys['stack'].values[0]
+        stackClip = 0.0
+        if 'stackClip' in cmdKeys:
+            stackClip = cmdKeys['stackClip'].values[0]
+
         if count < 0:
             cmd.error('text="parameter count invalid: %d"' % count)
             cmd.fail()
@@ -416,8 +499,39 @@ class AgccCmd(object):
         elif expTime <= 0:
             cmd.error('text="exposure time invalid: %f"' % expTime)
             cmd.fail()
+        elif cadence < 0:
+            cmd.error('text="cadence invalid: %f"' % cadence)
+            cmd.fail()
+        elif archive is not None and archive < 0:
+            cmd.error('text="parameter archive invalid: %d"' % archive)
+            cmd.fail()
+        elif stack < 0 or stackClip < 0:
+            cmd.error('text="parameter stack/stackClip invalid: %d/%f"' % (stack, stackClip))
+            cmd.fail()
         else:
-            self.actor.camera.startsequence(cmd, seq_id, expTime, count, cams, combined)
+            visit = self.setOrGetVisit(cmd)
+            self.setImageParams(cmd)
+            self.actor.camera.startsequence(cmd, seq_id, expTime, count, cams, combined, centroid, visit,
+                                            self.cParms, cMethod, self.iParms, cadence=cadence, archive=archive,
+                                            stack=stack, stackClip=stackClip)
+
+    def saveFrames(self, cmd):
+        """Write the sequence frames kept in memory, by default of all cameras"""
+
+        cmdKeys = cmd.cmd.keywords
+        cams = None
+        if 'cameras' in cmdKeys:
+            cams = []
+            camList = cmdKeys['cameras'].values[0]
+            for cam in camList:
+                k = int(cam) - 1
+                if k < 0 or k >= nCams:
+                    cmd.error('text="camera list error: %s"' % camList)
+                    cmd.fail()
+                    return
+                cams.append(k)
+
+        self.actor.camera.saveFrames(cmd, cams)
 
     def stopsequence(self, cmd):
         """Stop a exposure sequence"""
@@ -467,6 +581,89 @@ class AgccCmd(object):
         if cmd is not None:
             cmd.finish(f'text="centroid parameters set thresh/deblend/nmin = {thresh} {deblend} {nmin}"')
 
+    def recentroid(self, cmd):
+        """Centroid the last frames, or those of frameId, again without exposing.
+
+        nmin, thresh and deblend override the current centroid parameters for
+        this measurement only; with writeDB the centroids in OpDB are replaced.
+        """
+
+        cmdKeys = cmd.cmd.keywords
+        cams = []
+        if 'cameras' in cmdKeys:
+            camList = cmdKeys['cameras'].values[0]
+            for cam in camList:
+                k = int(cam) - 1
+                if k < 0 or k >= nCams:
+                    cmd.error('text="camera list error: %s"' % camList)
+                    cmd.fail()
+                    return
+                cams.append(k)
+        else:
+            for k in range(nCams):
+                cams.append(k)
+
+        nframe = None
+        if 'frameId' in cmdKeys:
+            nframe = cmdKeys['frameId'].values[0]
+        cMethod = "sep"
+        if 'cMethod' in cmdKeys:
+            cMethod = cmdKeys['cMethod'].values[0]
+
+        cParms = dict(self.cParms)
+        if 'nmin' in cmdKeys:
+            cParms['nmin'] = int(cmdKeys['nmin'].values[0])
+        if 'thresh' in cmdKeys:
+            cParms['thresh'] = float(cmdKeys['thresh'].values[0])
+        if 'deblend' in cmdKeys:
+            cParms['deblend'] = float(cmdKeys['deblend'].values[0])
+        cmd.inform(f'text="recentroid with thresh/deblend/nmin = {cParms["thresh"]} {cParms["deblend"]} {cParms["nmin"]}"')
+
+        iParms = getattr(self, 'iParms', None)
+        if iParms is None:
+            self.setImageParams(cmd)
+            iParms = self.iParms
+        self.actor.camera.recentroid(cmd, cams, nframe, cParms, iParms, cMethod,
+                                     writeDB='writeDB' in cmdKeys)
+
+    def sweep(self, cmd):
+        """Centroid a frame kept in memory over a grid of centroid parameters.
+
+        Each of threshList, deblendList, minareaList and nminList is a comma
+        separated list of values; the parameters not given keep their value.
+        """
+
+        cmdKeys = cmd.cmd.keywords
+        n = cmdKeys['camera'].values[0] - 1
+        if n < 0 or n >= nCams:
+            cmd.fail('text="camera id error: %d"' % (n + 1))
+            return
+        nframe = None
+        if 'frameId' in cmdKeys:
+            nframe = cmdKeys['frameId'].values[0]
+        cMethod = "sep"
+        if 'cMethod' in cmdKeys:
+            cMethod = cmdKeys['cMethod'].values[0]
+
+        values = {}
+        for name, cast in (('thresh', float), ('deblend', float), ('minarea', int), ('nmin', int)):
+            if name + 'List' in cmdKeys:
+                valueList = cmdKeys[name + 'List'].values[0]
+                try:
+                    values[name] = [cast(v) for v in str(valueList).split(',')]
+                except ValueError:
+                    cmd.fail('text="%sList error: %s"' % (name, valueList))
+                    return
+        if len(values) == 0:
+            cmd.fail('text="no parameter to sweep"')
+            return
+
+        iParms = getattr(self, 'iParms', None)
+        if iParms is None:
+            self.setImageParams(cmd)
+            iParms = self.iParms
+        self.actor.camera.sweep(cmd, n, nframe, self.cParms, values, iParms, cMethod)
+
     def setImageParams(self, cmd):
 
         """
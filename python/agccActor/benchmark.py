@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+"""End-to-end exposure benchmark on the simulator.
+
+Drives camera.Camera.expose with the fake cameras, a command object which
+records the keywords and an in-memory SQLite stand-in for OpDB with an
+injected latency, for N exposures with centroiding off and on. Reports
+frames per second, the per-stage latency percentiles of the exposure
+timelines and the memory use as JSON, to compare versions:
+
+    python benchmark.py -n 20 --latency 0.02 --starfield '{"nstars": 40}' -o bench.json
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import resource
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+import timing
+
+# centroid parameters for the simulated frames, used without PFS_INSTDATA_DIR
+benchCentroidParams = dict(thresh=5.0, minarea=5, deblend=0.1, ellip=0.3, nmin=5)
+benchImageParams = dict(flatVal=0.01, magFit=[1.0, 22.0],
+                        **{str(k + 1): dict(reg=[24, 536, 9, 1033, 536, 1048, 9, 1033], badCols=[])
+                           for k in range(6)})
+
+
+class FakeOpDB(object):
+    """ In-memory SQLite stand-in for pfs.utils.database.opdb.OpDB """
+
+    lock = threading.Lock()
+    conn = None
+    latency = 0.0
+    nCalls = 0
+
+    @classmethod
+    def setup(cls, latency=0.0):
+        """ Create the shared database, with a telescope status for every visit """
+
+        cls.latency = latency
+        cls.nCalls = 0
+        cls.conn = sqlite3.connect(':memory:', check_same_thread=False)
+        cls.conn.execute('CREATE TABLE tel_status (pfs_visit_id, status_sequence_id, altitude, azimuth, '
+                         'insrot, adc_pa, m2_pos3)')
+        cls.conn.execute('CREATE TABLE env_condition (pfs_visit_id, status_sequence_id, outside_temperature, '
+                         'outside_pressure, outside_humidity)')
+
+    @classmethod
+    def addVisit(cls, visitId):
+        with cls.lock:
+            cls.conn.execute('INSERT INTO tel_status VALUES (?, 1, 60.0, 180.0, 0.0, 0.0, 0.0)', (visitId,))
+            cls.conn.execute('INSERT INTO env_condition VALUES (?, 1, 0.0, 620.0, 20.0)', (visitId,))
+
+    @classmethod
+    def set_default_connection(cls, **kwargs):
+        pass
+
+    def _call(self, sql, params=None):
+        time.sleep(self.latency)
+        with self.lock:
+            FakeOpDB.nCalls += 1
+            try:
+                return self.conn.execute(sql, params or {})
+            except sqlite3.OperationalError as e:
+                # tables which were never written
+                if 'no such table' in str(e):
+                    return None
+                raise
+
+    def query_scalar(self, sql, params=None):
+        cur = self._call(sql, params)
+        row = None if cur is None else cur.fetchone()
+        return None if row is None else row[0]
+
+    def query_series(self, sql, params=None):
+        cur = self._call(sql, params)
+        row = None if cur is None else cur.fetchone()
+        if row is None:
+            return None
+        return dict(zip([d[0] for d in cur.description], row))
+
+    def execute(self, sql, params=None):
+        self._call(sql, params)
+
+    def _insert(self, table, columns, rows):
+        time.sleep(self.latency)
+        with self.lock:
+            FakeOpDB.nCalls += 1
+            self.conn.execute(f'CREATE TABLE IF NOT EXISTS {table} ({", ".join(columns)})')
+            self.conn.executemany(f'INSERT INTO {table} ({", ".join(columns)}) '
+                                  f'VALUES ({", ".join("?" * len(columns))})', rows)
+
+    def insert_kw(self, table, **cols):
+        values = [v.isoformat() if isinstance(v, datetime.datetime) else v for v in cols.values()]
+        self._insert(table, list(cols), [values])
+
+    def insert_dataframe(self, table, df):
+        rows = [tuple(v.item() if isinstance(v, np.generic) else v for v in row)
+                for row in df.itertuples(index=False, name=None)]
+        self._insert(table, list(df.columns), rows)
+
+
+class BenchCmd(object):
+    """ Command stand-in recording the keywords """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.keywords = []
+        self.finished = threading.Event()
+        self.failed = False
+
+    def _record(self, level, text):
+        with self.lock:
+            self.keywords.append((time.monotonic(), level, text))
+
+    def inform(self, text):
+        self._record('i', text)
+
+    def respond(self, text):
+        self._record('i', text)
+
+    def debug(self, text):
+        self._record('d', text)
+
+    def warn(self, text):
+        self._record('w', text)
+
+    def error(self, text):
+        self._record('e', text)
+
+    def finish(self, text=''):
+        self._record(':', text)
+        self.finished.set()
+
+    def fail(self, text=''):
+        self._record('f', text)
+        self.failed = True
+        self.finished.set()
+
+    def count(self, level):
+        with self.lock:
+            return sum(1 for k in self.keywords if k[1] == level)
+
+
+def rss():
+    """ Return the resident set size in MB """
+
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+
+
+def run(camera, nexp, cams, expTime, centroid, combined, cParms, iParms, visitId):
+    """ Take nexp exposures and return the measurements """
+
+    timing.stats.reset()
+    rss0 = rss()
+    cmds = []
+    t0 = time.monotonic()
+    for n in range(nexp):
+        cmd = BenchCmd()
+        thr = camera.expose(cmd, expTime, 'object', cams, combined, centroid, visitId,
+                            dict(cParms), 'sep', iParms)
+        if thr is None:
+            raise RuntimeError(f'exposure {n} not started: {cmd.keywords[-1][2]}')
+        thr.join()
+        cmds.append(cmd)
+    # the FITS files are done when the writer is idle
+    while camera.fitsWriter is not None and len(camera.fitsWriter.pending) > 0:
+        time.sleep(0.01)
+    wall = time.monotonic() - t0
+
+    stages = {stage: dict(count=count, p50=p50, p95=p95, p99=p99, max=tmax)
+              for stage, count, p50, p95, p99, tmax in timing.stats.summary()}
+    return dict(centroid=centroid, combined=combined, exposures=nexp, cameras=len(cams),
+                wall_s=wall, exposures_per_s=nexp / wall, frames_per_s=nexp * len(cams) / wall,
+                stages_ms=stages,
+                warnings=sum(cmd.count('w') for cmd in cmds),
+                failures=sum(cmd.failed for cmd in cmds),
+                memory_mb=dict(rss_start=rss0, rss_end=rss(),
+                               maxrss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                               children_maxrss=resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024))
+
+
+def version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='AGCC exposure benchmark on the simulator')
+    parser.add_argument('-n', '--nexp', type=int, default=10, help='exposures per run')
+    parser.add_argument('--cameras', default='123456', help='cameras to expose, e.g. 1256')
+    parser.add_argument('--exptime', type=float, default=0.5, help='exposure time in seconds')
+    parser.add_argument('--latency', type=float, default=0.0, help='OpDB latency per call in seconds')
+    parser.add_argument('--combined', type=int, default=1, help='0/1: multiple FITS files/single FITS file')
+    parser.add_argument('--centroid', default='0,1', help='centroid settings to run, e.g. 0,1')
+    parser.add_argument('--no-journal', action='store_true', help='do not journal the OpDB writes which fail')
+    parser.add_argument('--starfield', default='{}', help='StarField options as JSON, "null" for zero frames')
+    parser.add_argument('--image', default='', help='simulated FITS file or directory instead of a star field')
+    parser.add_argument('--config', default='{}', help='extra camera config as JSON')
+    parser.add_argument('-o', '--output', help='JSON output file, stdout if not given')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    dataRoot = os.environ.setdefault('ICS_MHS_DATA_ROOT', tempfile.mkdtemp(prefix='agccbench'))
+
+    from pfs.utils.database import opdb
+    FakeOpDB.setup(args.latency)
+    opdb.OpDB = FakeOpDB
+
+    import camera
+    import centroidTools as ct
+    logging.getLogger('agcc').setLevel(logging.WARNING)
+    if 'PFS_INSTDATA_DIR' in os.environ:
+        cParms, iParms = ct.getCentroidParams(None), ct.getImageParams(None)
+    else:
+        cParms, iParms = benchCentroidParams, benchImageParams
+
+    config = dict(simulator=1, temperature=-20.0, simulatedImagePath=args.image,
+                  simulatedStarField=None if args.image else json.loads(args.starfield),
+                  journalPath=None if args.no_journal else os.path.join(dataRoot, 'agcc', 'dbJournal'),
+                  rawDataRoot=os.path.join(dataRoot, 'raw'),
+                  **{f'cam{k + 1}': f'SIM{k + 1}' for k in range(6)})
+    config.update(json.loads(args.config))
+
+    t0 = time.monotonic()
+    cam = camera.Camera(config)
+    startup = time.monotonic() - t0
+    cams = [int(c) - 1 for c in args.cameras]
+    visitId = 1
+    FakeOpDB.addVisit(visitId)
+
+    runs = []
+    try:
+        for centroid in [bool(int(c)) for c in args.centroid.split(',')]:
+            runs.append(run(cam, args.nexp, cams, args.exptime, centroid, bool(args.combined),
+                            cParms, iParms, visitId))
+    finally:
+        cam.closeCamera()
+
+    result = dict(version=version(), date=datetime.datetime.now().isoformat(),
+                  host=platform.node(), python=platform.python_version(), numpy=np.__version__,
+                  args=vars(args), startup_s=startup, opdb_calls=FakeOpDB.nCalls, runs=runs)
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
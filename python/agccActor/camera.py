@@ -1,12 +1,26 @@
+import time
+_importStart = time.monotonic()
+
 from agccActor import dbRoutinesAGCC
+from agccActor.journal import DBJournal
 from expose import Exposure
 from setmode import SetMode
 from sequence import Sequence, SEQ_IDLE, SEQ_RUNNING, SEQ_ABORT
 import writeFits
+from fitsWriter import FitsWriter
+from frameRing import FrameRing, Archiver
+from spotTracker import SpotTracker
+from readoutScheduler import ReadoutScheduler, parseBus
+from telemetry import CameraTelemetry
+import telemetry
 import photometry
-import os, logging
-import fli_camera
+import metrics
+import profiler
+import sweep
+import os, logging, threading
 
+# time taken by the imports above, the first part of the startup profile
+importTime = time.monotonic() - _importStart
 
 nCams = 6
 
@@ -17,6 +31,11 @@ class Camera(object):
         """ connect to AG cameras """
 
         self.logger = logging.getLogger('agcc')
+        self.startup = [('imports', importTime)]
+        importBudget = config.get('importBudget', 1.0)
+        if importTime > importBudget:
+            self.logger.warning(f'Imports took {importTime:.2f}s, over the {importBudget:.2f}s budget.')
+        t0 = time.monotonic()
 
         try:
             db_params = config["db"]["opdb"]
@@ -24,69 +43,409 @@ class Camera(object):
             dbRoutinesAGCC.opdb.OpDB.set_default_connection(**db_params)
         except KeyError:
             self.logger.info('No database configuration for opdb found, using defaults.')
+        t0 = self.profile('opdb', t0)
 
+        # OpDB writes go to the database directly, and to the journal only when they fail
+        journalPath = config.get('journalPath', os.path.join('$ICS_MHS_DATA_ROOT', 'agcc', 'dbJournal'))
+        if journalPath:
+            self.journal = DBJournal(journalPath)
+            self.logger.info(f'Journaling failed OpDB writes to {self.journal.path}.')
+        else:
+            self.journal = None
+        t0 = self.profile('journal', t0)
+
+        writeFits.setEngine(config.get('fitsEngine', 'direct'))
+        writeFits.setDataRoot(config.get('rawDataRoot', '/data/raw'))
+        writeFits.setCompression(config.get('fitsCompression', None),
+                                 workers=config.get('compressWorkers', 6))
+        if config.get('fitsWriter', True):
+            self.fitsWriter = FitsWriter(maxQueue=config.get('fitsWriterQueue', 12))
+            self.logger.info(f'Started FITS writer process {self.fitsWriter.proc.pid}.')
+        else:
+            self.fitsWriter = None
+        t0 = self.profile('fitsWriter', t0)
+
+        metricsPort = config.get('metricsPort', None)
+        metricsTextfile = config.get('metricsTextfile', None)
+        if metricsPort is not None or metricsTextfile is not None:
+            try:
+                self.metricsExporter = metrics.MetricsExporter(port=metricsPort,
+                                                               host=config.get('metricsHost', '127.0.0.1'),
+                                                               textfile=metricsTextfile,
+                                                               interval=config.get('metricsInterval', 15.0))
+            except OSError as e:
+                self.logger.warning(f'Failed to start the metrics exporter: {e}')
+                self.metricsExporter = None
+        else:
+            self.metricsExporter = None
+        self.setMetricsGauges()
+
+        photometry.setStartMethod(config.get('workerStartMethod', 'forkserver'))
+        self.workerTime = 0.0
         simulator = config['simulator']
         self.cams = [None, None, None, None, None, None]
         self.seq_stat = [SEQ_IDLE, SEQ_IDLE, SEQ_IDLE, SEQ_IDLE, SEQ_IDLE, SEQ_IDLE]
         self.seq_count = [0, 0, 0, 0, 0, 0]
+        self.sequenceDepth = config.get('sequenceDepth', 2)
+        self.sequenceLagPolicy = config.get('sequenceLagPolicy', 'skip')
+        # start the exposures of all the cameras together
+        self.syncStart = config.get('syncStart', False)
+        # last frames kept in memory per camera, 0 for none: sequences then
+        # write all their frames and recentroid is not available
+        frameRingDepth = config.get('frameRingDepth', 10)
+        self.rings = {n: FrameRing(frameRingDepth) for n in range(nCams)} if frameRingDepth > 0 else None
+        self.archiveEvery = config.get('sequenceArchiveEvery', 1)
+        self.archiveAnomaly = config.get('sequenceArchiveAnomaly', True)
+        # spot tracks across the frames of each camera, 0 radius for none
+        trackRadius = config.get('trackRadius', 3.0)
+        self.trackers = None
+        if trackRadius > 0:
+            self.trackers = {n: SpotTracker(trackRadius, config.get('trackSearchRadius', 30.0),
+                                            config.get('trackMaxMissed', 3)) for n in range(nCams)}
+        # concurrent readouts on a USB bus, learned up to this, 0 for no limit;
+        # the bus of each camera from its device name, or from usbBuses
+        readoutsPerBus = config.get('readoutsPerBus', nCams)
+        self.usbBuses = {int(k): str(v) for k, v in config.get('usbBuses', {}).items()}
+        self.readoutScheduler = ReadoutScheduler(readoutsPerBus) if readoutsPerBus > 0 else None
         temp = config['temperature']
 
         self.logger.info(f'Setting TEC to {temp}.')
 
         self.temp = temp
-        fli_camera.CameraInit()
-        
-        if simulator == 0:
+        self.config = config
+        self.initTimeout = config.get('initTimeout', 30.0)
+        self.initStats = {}
+        self.failedDevices = {}
+        self.sampler = None
+        self.profiledWorkers = []
+        self.profileTimer = None
+        self.profileLock = threading.Lock()
 
+        if simulator == 0:
+            # the driver is only needed, and built, on the real system
+            import fli_camera
+            fli_camera.CameraInit()
+            self.driver = fli_camera
             self.numberOfCamera = fli_camera.numberOfCamera()
-            for n in range(self.numberOfCamera):
-                cam = fli_camera.Camera(n)
-                cam.open()
-                for k in range(nCams):
-                    if cam.devsn == config['cam' + str(k + 1)]:
-                        self.cams[k] = cam
-                        cam.agcid = k
-                        cam.setTemperature(temp)
-                        cam.regions = ((0, 0, 0), (0, 0, 0))
-                        cam.in_queue, cam.out_queue, cam.proc = photometry.createProc()
-                        self.logger.info(f'Creating process ID for Cam {cam.agcid + 1} {cam.proc.pid}.')
-                        break
-                #else:
-                #    cam.close()
+            # the devices are enumerated in USB order, match them by serial number
+            self.serials = {config['cam' + str(k + 1)]: k for k in range(nCams)}
+            self.simImagePath = None
+            self.simStarField = None
         else:
             from fli import fake_camera
 
+            self.driver = fake_camera
             self.numberOfCamera = fake_camera.numberOfCamera()
+            self.serials = None
             simImagePath = config['simulatedImagePath']
             if len(simImagePath) == 0:
-                simImagePath = None
+                self.simImagePath = None
             else:
-                simImagePath = os.path.expandvars(simImagePath)
+                self.simImagePath = os.path.expandvars(simImagePath)
+            # StarField options, rendering synthetic star fields if set
+            self.simStarField = config.get('simulatedStarField', None)
+
+        self.openCameras(range(self.numberOfCamera))
+        self.profile('cameras', t0)
+        self.startup.append(('workers', self.workerTime))
+        self.logger.info('Startup profile: %s, total %.2fs.'
+                         % (', '.join(f'{stage}={dt:.2f}s' for stage, dt in self.startup),
+                            self.startupTime()))
+
+    def setMetricsGauges(self):
+        """Sample the gauges of the metrics registry from this camera set """
+
+        metrics.busyCameras.setFunction(lambda: Exposure.n_busy)
+        metrics.workerQueue.setFunction(
+            lambda: {str(cam.agcid + 1): cam.in_queue.qsize()
+                     for cam in self.cams if cam is not None and hasattr(cam, 'in_queue')})
+        metrics.fitsWriterQueue.setFunction(
+            lambda: 0 if self.fitsWriter is None else len(self.fitsWriter.pending))
+        metrics.journalPending.setFunction(
+            lambda: 0 if self.journal is None else self.journal.pending())
+
+    def profile(self, stage, t0):
+        """Record the time of a startup stage which began at t0, return the time now """
+
+        t = time.monotonic()
+        self.startup.append((stage, t - t0))
+        return t
+
+    def startupTime(self):
+        """Return the total startup time; workers are part of the cameras stage """
+
+        return sum(dt for stage, dt in self.startup if stage != 'workers')
+
+    def newDevice(self, n):
+        """Return the unopened camera device with index n """
+
+        if self.serials is not None:
+            import fli_camera
+            return fli_camera.Camera(n)
+        from fli import fake_camera
+        return fake_camera.Camera(n, self.config['cam' + str(n + 1)], self.simImagePath,
+                                  starField=self.simStarField)
+
+    def scheduleReadouts(self, cam):
+        """Hand the readouts of a camera to the readout scheduler """
+
+        if self.readoutScheduler is None:
+            return
+        bus = self.usbBuses.get(cam.agcid + 1)
+        if bus is None:
+            bus = parseBus(cam.getDeviceName())
+        self.readoutScheduler.setBus(cam.agcid, bus)
+        cam.readoutGate = self.readoutScheduler
+        self.logger.info(f'AGC[{cam.agcid + 1}] reads out on USB bus {bus}.')
+
+    def openCameras(self, devices, agcids=None):
+        """Open and configure camera devices in parallel
+
+        Each device is opened, matched to its camera id and set to the TEC
+        temperature in its own thread; a device which does not answer within
+        initTimeout seconds is left behind and reported.
+
+        Args:
+           devices - list of device indices
+           agcids  - dict of device index: camera id expected, for the failure report
 
-            for n in range(self.numberOfCamera):
-                devsn = config['cam' + str(n + 1)]
-                cam = fake_camera.Camera(n, devsn, simImagePath)
+        Returns:
+           - list of the camera ids started
+        """
+
+        results = {}
+
+        def init(n, cam):
+            t0 = time.time()
+            try:
                 cam.open()
-                self.cams[n] = cam
-                cam.agcid = n
-                cam.setTemperature(temp)
-                cam.regions = ((0, 0, 0), (0, 0, 0))
-                cam.in_queue, cam.out_queue,cam.proc = photometry.createProc()
+                if self.serials is not None:
+                    agcid = self.serials.get(cam.devsn)
+                else:
+                    agcid = n
+                if agcid is not None:
+                    cam.agcid = agcid
+                    cam.setTemperature(self.temp)
+                    cam.regions = ((0, 0, 0), (0, 0, 0))
+                results[n] = (cam, agcid, None, time.time() - t0)
+            except Exception as e:
+                results[n] = (cam, None, str(e), time.time() - t0)
+
+        t0 = time.time()
+        thrs = []
+        for n in devices:
+            cam = self.newDevice(n)
+            thr = threading.Thread(target=init, args=(n, cam), name=f'camInit{n}', daemon=True)
+            thr.start()
+            thrs.append((n, thr))
+            self.failedDevices[n] = (cam, thr)
+        deadline = t0 + self.initTimeout
+        for n, thr in thrs:
+            thr.join(max(deadline - time.time(), 0))
+
+        started = []
+        for n, thr in thrs:
+            if thr.is_alive():
+                self.logger.error(f'Camera device {n} did not open in {self.initTimeout}s, leaving it.')
+                self.markFailed(n, agcids, 'TIMEOUT', time.time() - t0)
+                continue
+            cam, agcid, error, dt = results[n]
+            if error is not None:
+                self.logger.error(f'Failed to open camera device {n}: {error}')
+                self.markFailed(n, agcids, 'FAILED', dt)
+                continue
+            if agcid is None:
+                self.logger.warning(f'Camera device {n} SN={cam.devsn} is not configured, leaving it.')
+                del self.failedDevices[n]
+                continue
+
+            # the photometry processes are started from this thread only
+            tw = time.monotonic()
+            cam.in_queue, cam.out_queue, cam.proc = photometry.createProc()
+            cam.workerLock = threading.Lock()
+            self.workerTime += time.monotonic() - tw
+            self.logger.info(f'Creating process ID for Cam {cam.agcid + 1} {cam.proc.pid}.')
+            interval = self.config.get('telemetryInterval', 5.0)
+            if interval > 0:
+                cam.telemetry = CameraTelemetry(cam, interval, self.config.get('telemetryHistory', 120))
+                cam.telemetry.start()
+            self.scheduleReadouts(cam)
+            self.cams[agcid] = cam
+            self.initStats[agcid] = ('OK', dt)
+            del self.failedDevices[n]
+            started.append(agcid)
+            self.logger.info(f'Opened AGC[{agcid + 1}] SN={cam.devsn} in {dt:.2f}s.')
+
+        self.logger.info(f'Opened {len(started)} cameras in {time.time() - t0:.2f}s.')
+        return started
+
+    def markFailed(self, n, agcids, state, dt):
+        """Record the failure of camera device n for the init keywords """
+
+        # without its serial number a real device is only known by its index
+        if agcids is not None and len(agcids) == 1 and n in agcids:
+            agcid = agcids[n]
+        elif self.serials is None:
+            agcid = n
+        else:
+            return
+        self.initStats[agcid] = (state, dt)
+
+    def stopCamera(self, n):
+        """Stop the photometry process and telemetry of a camera and close it """
+
+        cam = self.cams[n]
+        self.cams[n] = None
+        if getattr(cam, 'telemetry', None) is not None:
+            cam.telemetry.stop()
+        # close the queue as well
+        self.logger.info(f'Closing process ID {cam.proc.pid}.')
+        #if cam.proc.is_alive():
+        #os.kill(cam.proc.pid, signal.SIGTERM)
+        cam.proc.kill()  # Send stop signal to the input queue
+        self.logger.info(f'Join the process {cam.proc.pid}.')
+        cam.proc.join()
+        cam.close()
+
+    def startProfile(self, cmd, workers=False, duration=None, interval=0.005):
+        """Start profiling the actor threads, and the photometry workers
+
+        Args:
+           cmd      - a Command object to report to. Ignored if None.
+           workers  - also profile the photometry worker of each camera
+           duration - stop after this many seconds, or on stopProfile if None
+           interval - seconds between the stack samples of the actor
+        """
+
+        with self.profileLock:
+            if self.sampler is not None:
+                return False
+            self.sampler = profiler.StackSampler(interval)
+            self.sampler.start()
+            self.profiledWorkers = []
+            if workers:
+                for cam in self.cams:
+                    if cam is not None:
+                        cam.in_queue.put(photometry.profileRequest('start'))
+                        self.profiledWorkers.append(cam)
+            if duration is not None and duration > 0:
+                self.profileTimer = threading.Timer(duration, self.stopProfile, args=(None,))
+                self.profileTimer.daemon = True
+                self.profileTimer.start()
+
+        if cmd:
+            cmd.inform('agc_profile=RUNNING,%d,%.1f' % (len(self.profiledWorkers),
+                                                       -1 if duration is None else duration))
+        return True
+
+    def stopProfile(self, cmd):
+        """Stop profiling and write the profile files
+
+        Args:
+           cmd      - a Command object to report to. Ignored if None.
+        """
+
+        with self.profileLock:
+            sampler, self.sampler = self.sampler, None
+            if sampler is None:
+                if cmd:
+                    cmd.warn('text="profiling is not running"')
+                return []
+            if self.profileTimer is not None:
+                self.profileTimer.cancel()
+                self.profileTimer = None
+
+            filenames = [profiler.profileName('actor', 'folded')]
+            sampler.stop(filenames[0])
+            for cam in self.profiledWorkers:
+                # written by the worker once it is done with the frames queued before
+                filename = profiler.profileName(f'worker{cam.agcid + 1}', 'pstats')
+                if cam.proc.is_alive():
+                    cam.in_queue.put(photometry.profileRequest('stop', filename))
+                    filenames.append(filename)
+            self.profiledWorkers = []
+
+        for filename in filenames:
+            if cmd:
+                cmd.inform('agc_profileFile="%s"' % filename)
+            else:
+                self.logger.info(f'Profile written to {filename}.')
+        if cmd:
+            cmd.inform('agc_profile=IDLE,0,0.0')
+        return filenames
+
+    def reconnectCamera(self, cmd, n):
+        """Close and reopen one camera device, leaving the other cameras running
+
+        Args:
+           cmd     - a Command object to report to. Ignored if None.
+           n       - camera id
+        """
+
+        cam = self.cams[n]
+        if cam is not None:
+            if not cam.isReady() and cmd:
+                cmd.warn('text="AGC[%d] is %s, reconnecting anyway"' % (n + 1, cam.getStatusStr()))
+            devices = [cam.id]
+            try:
+                self.stopCamera(n)
+            except Exception as e:
+                self.logger.warning(f'Failed to close AGC[{n + 1}]: {e}')
+        else:
+            # the camera never opened: retry the devices which failed, we
+            # do not know which one it is
+            devices = []
+            for device, (failed, thr) in list(self.failedDevices.items()):
+                if thr.is_alive():
+                    self.logger.warning(f'Camera device {device} is still opening, not retrying it.')
+                    continue
+                try:
+                    failed.close()
+                except Exception:
+                    pass
+                devices.append(device)
+
+        started = self.openCameras(devices, {device: n for device in devices})
+        if cmd:
+            self.sendInitKeys(cmd, [n])
+            if n in started:
+                cmd.inform('agc%d_stat=READY' % (n + 1))
+                cmd.finish('text="AGC[%d] reconnected"' % (n + 1))
+            else:
+                cmd.fail('text="AGC[%d] reconnect failed"' % (n + 1))
+
+    def sendInitKeys(self, cmd, cams=None):
+        """Send the camera initialisation state and time
+
+        Args:
+           cmd     - a Command object to report to.
+           cams    - list of camera ids, all cameras if None
+        """
+
+        for n in (range(nCams) if cams is None else cams):
+            state, dt = self.initStats.get(n, ('ABSENT', 0.0))
+            cmd.inform('agc%d_init=%s,%.2f' % (n + 1, state, dt))
+        if cams is None:
+            cmd.inform('agc_startup=%.2f,%s' % (self.startupTime(),
+                                                ','.join('%.2f' % dt for stage, dt in self.startup)))
 
     def closeCamera(self):
+        if self.sampler is not None:
+            self.stopProfile(None)
         for c_i, cam in enumerate(self.cams):
             if cam is not None:
-                # close the queue as well
-                self.logger.info(f'Closing process ID {cam.proc.pid}.')
-                #if cam.proc.is_alive():
-                #os.kill(cam.proc.pid, signal.SIGTERM)
-                cam.proc.kill()  # Send stop signal to the input queue
-                self.logger.info(f'Join the process {cam.proc.pid}.')
-                cam.proc.join()
-
-                cam.close()
-                self.cams[c_i] = None
-                
+                self.stopCamera(c_i)
+
+        if self.fitsWriter is not None:
+            self.fitsWriter.close()
+            self.fitsWriter = None
+        writeFits.shutdownPool()
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        if self.metricsExporter is not None:
+            self.metricsExporter.close()
+            self.metricsExporter = None
 
     def runningCameras(self):
         """Return the list of valid camera Ids """
@@ -102,32 +461,54 @@ class Camera(object):
         cmd.inform('text="Number of AG cameras = %d"' % self.numberOfCamera)
         for n in range(nCams):
             if self.cams[n] != None:
-                tempstr = '%5.1f' % self.cams[n].getTemperature()
+                tempstr = self.temperatureStr(self.cams[n])
                 cmd.inform('text="[%d] %s SN=%s status=%s temp=%s"'
                     % (n + 1, self.cams[n].devname, self.cams[n].devsn,
                            self.cams[n].getStatusStr(), tempstr))
 
+    def temperatureStr(self, cam):
+        """Return the last sampled temperature of a camera, in <> if the sample failed """
+
+        snap = telemetry.snapshot(cam)
+        if snap.temperature is None:
+            return '<%5.1f>' % cam.temp
+        if snap.error is not None:
+            return '<%5.1f>' % snap.temperature
+        return '%5.1f' % snap.temperature
+
     def sendStatusKeys(self, cmd):
         """ Send our status keys to the given command. """ 
     
         cmd.inform('text="Number of AG cameras = %d"' % self.numberOfCamera)
         for n in range(nCams):
             if self.cams[n] != None:
+                tempstr = self.temperatureStr(self.cams[n])
                 if self.cams[n].isReady():
-                    tempstr = '%5.1f' % self.cams[n].getTemperature()
                     cmd.inform('agc%d_stat=READY' % (n + 1))
                 else:
-                    tempstr = '<%5.1f>' % self.cams[n].temp
                     cmd.inform('agc%d_stat=BUSY' % (n + 1))
+                snap = telemetry.snapshot(self.cams[n])
+                if snap.temperature is not None:
+                    cmd.inform('agc%d_telemetry=%.1f,%.1f,%d,%d,%.1f'
+                               % (n + 1, snap.temperature, snap.coolerPower, snap.deviceStatus,
+                                  snap.exposureStatus, time.time() - snap.time))
                 cmd.inform('text="[%d] %s SN=%s status=%s temp=%s regions=%s bin=(%d,%d) expArea=%s"'
                            % (n + 1, self.cams[n].devname, self.cams[n].devsn,
                            self.cams[n].getStatusStr(), tempstr, self.cams[n].regions,
                            self.cams[n].hbin, self.cams[n].vbin, self.cams[n].expArea))
             else:
                 cmd.inform('agc%d_stat=ABSENT' % (n + 1))
+        if self.journal is not None:
+            cmd.inform('agc_dbjournal=%s' % self.journal.statusStr())
+        if self.fitsWriter is not None:
+            cmd.inform('agc_fitswriter=%s' % self.fitsWriter.statusStr())
+        if self.readoutScheduler is not None:
+            cmd.inform('agc_usbBuses=%s' % self.readoutScheduler.busesStr(nCams))
+            cmd.inform('agc_readoutLimits=%s' % self.readoutScheduler.limitsStr())
+            cmd.inform('agc_readoutTimes=%s' % self.readoutScheduler.timesStr(nCams))
 
     def expose(self, cmd, expTime, expType, cams, combined, centroid, pfsVisitId, 
-               cParms, cMethod, iParms, threadDelay=None, tecOFF= False):
+               cParms, cMethod, iParms, threadDelay=None, tecOFF= False, timeline=None):
         """ Generate an 'exposure' image.
 
         Args:
@@ -137,9 +518,10 @@ class Camera(object):
            cams     - list of active cameras [1-6]
            combined - Multiple FITS files/Single FITS file
            centroid - do centroid if True else don't
+           timeline - timing.Timeline of the command, or None
 
         Returns:
-           - NULL
+           - the started Exposure thread, None for test or refused exposures
 
         Keys:
            stat_cam[1-6]
@@ -192,8 +574,11 @@ class Camera(object):
 
             exp_thr = Exposure(active_cams, expTime_ms, dflag, cParms, iParms, 
                                pfsVisitId, cMethod, cmd, combined, centroid, 
-                               threadDelay=threadDelay, tecOFF=tecOFF)
+                               threadDelay=threadDelay, tecOFF=tecOFF, journal=self.journal,
+                               fitsWriter=self.fitsWriter, timeline=timeline, rings=self.rings,
+                               trackers=self.trackers, syncStart=self.startBarrier())
             exp_thr.start()
+            return exp_thr
 
     def abort(self, cmd, cams):
         """ Abort current exposure
@@ -433,16 +818,23 @@ class Camera(object):
             cmd.inform('text="setregions command done"')
             cmd.finish()
 
-    def startsequence(self, cmd, seq_id, expTime, count, cams, combined, centroid=False):
+    def startsequence(self, cmd, seq_id, expTime, count, cams, combined, centroid, pfsVisitId,
+                      cParms, cMethod, iParms, cadence=0.0, archive=None, stack=0, stackClip=0.0):
         """ Start a exposure sequence
 
         Args:
            cmd      - a Command object to report to. Ignored if None.
            seq_id   - Sequence ID
            expTime  - exposure time
-           count    - number of exposures
+           count    - number of exposures, 0 to run until stopsequence
            cams     - list of active cameras [1-6]
+           combined - Multiple FITS files/Single FITS file
            centroid - True if do centroid else don't
+           cadence  - seconds between exposure starts, 0 for back to back
+           archive  - write every Nth exposure, 0 only anomalies and aborts,
+                      sequenceArchiveEvery if None
+           stack    - centroid and write only the mean of every stack frames
+           stackClip - sigma clipping threshold of the stacks, 0 for none
         """
 
         cams_available = []
@@ -467,8 +859,167 @@ class Camera(object):
             cmd.inform('inused_seq%d="YES"' % (seq_id + 1))
 
         active_cams = [self.cams[n] for n in cams_available]
-        sequence_thr = Sequence(active_cams, expTime_ms, seq_id, count, self.seq_stat, self.seq_count, combined, centroid, cParms, iParms, cmd)
+        if self.trackers is not None:
+            # a new sequence starts new tracks
+            for n in cams_available:
+                self.trackers[n].reset()
+        archiver = None
+        if self.rings is not None and stack <= 1:
+            archiver = Archiver(self.rings, self.liveFitsWriter(),
+                                every=self.archiveEvery if archive is None else archive,
+                                anomaly=self.archiveAnomaly)
+        sequence_thr = Sequence(active_cams, expTime_ms, seq_id, count, self.seq_stat, self.seq_count, combined,
+                                centroid, cParms, iParms, pfsVisitId, cMethod, cmd=cmd, cadence=cadence,
+                                journal=self.journal, fitsWriter=self.fitsWriter,
+                                maxInFlight=self.sequenceDepth, lagPolicy=self.sequenceLagPolicy,
+                                archiver=archiver, stack=stack, stackClip=stackClip, trackers=self.trackers,
+                                syncStart=self.startBarrier())
         sequence_thr.start()
+        return sequence_thr
+
+    def startBarrier(self):
+        """ Return the driver's StartBarrier class with syncStart, else None """
+
+        return self.driver.StartBarrier if self.syncStart else None
+
+    def liveFitsWriter(self):
+        """ Return the FITS writer process, None if it is not running """
+
+        if self.fitsWriter is not None and self.fitsWriter.isAlive():
+            return self.fitsWriter
+        return None
+
+    def saveFrames(self, cmd, cams):
+        """ Write the sequence frames kept in memory which are not archived yet
+
+        Args:
+           cmd     - a Command object to report to. Ignored if None.
+           cams    - list of cameras [0-5], all if None
+        """
+
+        nframes = 0
+        if self.rings is not None:
+            archiver = Archiver(self.rings, self.liveFitsWriter())
+            nframes = archiver.save(cmd, cams=cams)
+        if cmd:
+            cmd.inform('text="saved %d frames"' % nframes)
+            cmd.finish()
+
+    def recentroid(self, cmd, cams, nframe, cParms, iParms, cMethod, writeDB=False):
+        """ Centroid frames kept in memory again, with new parameters
+
+        Args:
+           cmd      - a Command object to report to. Ignored if None.
+           cams     - list of cameras [0-5]
+           nframe   - agc_exposure_id of the frames, the latest if None
+           cParms   - centroid parameters
+           iParms   - image parameters
+           cMethod  - centroid method
+           writeDB  - replace the centroids of the frames in OpDB
+        """
+
+        if self.rings is None:
+            if cmd:
+                cmd.fail('text="no frames kept in memory, frameRingDepth is 0"')
+            return
+
+        nDone = 0
+        for n in cams:
+            cam = self.cams[n]
+            frame = self.rings[n].find(nframe)
+            if cam is None or frame is None:
+                if cmd:
+                    cmd.warn('text="AGC[%d]: no frame kept in memory"' % (n + 1))
+                continue
+
+            t0 = time.monotonic()
+            frameParms = dict(cParms, expTime=frame.exptime / 1000.0)
+            try:
+                with cam.workerLock:
+                    cam.in_queue.put(photometry.measureRequest(frame.data, n, frameParms, iParms, cMethod))
+                    spots = photometry.getResult(cam.out_queue)
+            except Exception as e:
+                if cmd:
+                    cmd.warn(f'text="AGC[{n + 1}]: photometry error: {e}"')
+                continue
+            dt = time.monotonic() - t0
+            nDone += 1
+
+            if cmd:
+                cmd.inform('agc_recentroid=%d,%d,%d,%.1f' % (n + 1, frame.nframe, len(spots), dt * 1000))
+            if writeDB:
+                if self.journal is not None:
+                    self.journal.replaceCentroids(spots, frame.visitId, frame.nframe, n)
+                else:
+                    dbRoutinesAGCC.replaceCentroidsInDB(spots, frame.visitId, frame.nframe, n)
+                if cmd:
+                    cmd.inform(f'text="AGC[{n + 1}]: replaced centroids of agc_exposure_id {frame.nframe} in database"')
+
+        if cmd:
+            if nDone > 0:
+                cmd.finish('text="recentroid done"')
+            else:
+                cmd.fail('text="no frame centroided"')
+
+    def sweep(self, cmd, n, nframe, cParms, values, iParms, cMethod):
+        """ Centroid a frame kept in memory over a grid of centroid parameters
+
+        The measurements are spread over the photometry workers of all the
+        cameras; exposures wait for the measurements their worker is doing.
+
+        Args:
+           cmd      - a Command object to report to. Ignored if None.
+           n        - camera of the frame [0-5]
+           nframe   - agc_exposure_id of the frame, the latest if None
+           cParms   - centroid parameters, for those which are not swept
+           values   - dict of parameter: list of values, see sweep.grid
+           iParms   - image parameters
+           cMethod  - centroid method
+
+        Keys:
+           agc_sweep=cam,frameId,thresh,deblend,minarea,nmin,nspots,fwhm,ms,<count per flag>
+        """
+
+        frame = self.rings[n].find(nframe) if self.rings is not None else None
+        if frame is None:
+            if cmd:
+                cmd.fail('text="AGC[%d]: no frame kept in memory"' % (n + 1))
+            return
+        workers = [cam for cam in self.cams if cam is not None and cam.proc.is_alive()]
+        if len(workers) == 0:
+            if cmd:
+                cmd.fail('text="no photometry worker running"')
+            return
+
+        cParmsList = sweep.grid(dict(cParms, expTime=frame.exptime / 1000.0), values)
+        if cmd:
+            cmd.inform(f'text="AGC[{n + 1}]: sweeping {len(cParmsList)} centroid parameter sets '
+                       f'of frame {frame.nframe} over {len(workers)} workers"')
+        t0 = time.monotonic()
+        rows, errors = sweep.run(workers, frame.data, n, cParmsList, iParms, cMethod)
+        dt = time.monotonic() - t0
+
+        filename = os.path.join(sweep.sweepDir(), 'agcc_sweep_%08d_cam%d_%s.fits' %
+                                (frame.nframe, n + 1, time.strftime('%Y%m%dT%H%M%S')))
+        try:
+            sweep.writeTable(filename, rows, [('FRAMEID', frame.nframe, 'unique key for exposure'),
+                                              ('CAMERA', n + 1, 'AG camera'),
+                                              ('CMETHOD', cMethod, 'centroid method')])
+        except Exception as e:
+            filename = None
+            self.logger.warning(f'Failed to write the sweep table: {e}')
+
+        if cmd:
+            for row in rows:
+                cmd.inform('agc_sweep=%d,%d,%g,%g,%d,%d,%d,%.2f,%.1f,%s' %
+                           (n + 1, frame.nframe, row['thresh'], row['deblend'], row['minarea'], row['nmin'],
+                            row['nspots'], row['fwhm'], row['ms'],
+                            ','.join(str(row[name]) for name in sweep.flagNames)))
+            for e in errors[:3]:
+                cmd.warn(f'text="AGC[{n + 1}]: sweep photometry error: {e}"')
+            if filename is not None:
+                cmd.inform('agc_sweepFile="%s"' % filename)
+            cmd.finish(f'text="sweep of {len(rows)} parameter sets done in {dt:.2f}s"')
 
     def stopsequence(self, cmd, seq_id):
         """ Stop a exposure sequence
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+"""Centroid micro-benchmarks on synthetic AG frames.
+
+Renders frames with fli.starfield over a grid of cases (star density, in
+focus or defocused donuts, with or without saturated stars, full or small
+regions) and times each stage of centroidTools.getCentroidsSep through
+its stageTimer hook: overscan, bad columns, region copies, background,
+extraction, flagging, windowed moments and magnitudes. A second pass
+under tracemalloc measures the peak memory allocated in each stage.
+Results are printed and written as JSON; with --baseline the stage times
+are compared with an earlier run:
+
+    python centroidBench.py -r 5 -o centroid.json
+    python centroidBench.py -r 5 --baseline centroid.json
+"""
+
+import argparse
+import collections
+import datetime
+import itertools
+import json
+import platform
+import time
+import tracemalloc
+
+import numpy as np
+
+# the module photometry.measure uses, which holds the stageTimer hook
+from agccActor import centroidTools as ct
+import photometry
+from benchmark import benchCentroidParams, benchImageParams, version
+from fli import starfield
+
+densities = {'sparse': 10, 'medium': 50, 'crowded': 300}
+focus = {'focused': 0.0, 'donut': 8.0}
+magRange = (11.0, 16.0)
+# stars added in each amplifier half of the region, saturated whatever the
+# PSF and exposure time, to the field of the unsaturated case
+saturation = {'unsaturated': 0, 'saturated': 3}
+regions = {'full': [24, 536, 9, 1033, 536, 1048, 9, 1033],
+           'small': [152, 408, 393, 649, 664, 920, 393, 649]}
+
+
+def cases():
+    """ Yield (name, StarField options, region) for all the cases """
+
+    for (dname, nstars), (fname, donut), (sname, nsat), (rname, reg) in itertools.product(
+            densities.items(), focus.items(), saturation.items(), regions.items()):
+        yield ('%s/%s/%s/%s' % (dname, fname, sname, rname),
+               dict(seed=1, nstars=nstars, donut=donut, magRange=magRange, fwhm=4.0), reg, nsat)
+
+
+def addSaturated(field, reg, nstars, exptime, factor=4.0):
+    """ Add nstars stars to each amplifier half of a region, with a PSF peak
+    of factor times the saturation level in exptime """
+
+    s = field.stampSize
+    peak = field.psf(s, s, 2 * s + 1, 2 * s + 1).max()
+    rate = factor * field.saturation * field.gain / (peak * exptime)
+    # on the zero point of the field
+    mag = field.mag[0] + 2.5 * np.log10(field.rate[0] / rate)
+    rng = np.random.default_rng(len(field.x))
+    for x1, x2, y1, y2 in (reg[:4], reg[4:]):
+        field.x = np.append(field.x, rng.uniform(x1 + s, x2 - s, nstars))
+        field.y = np.append(field.y, rng.uniform(y1 + s, y2 - s, nstars))
+        field.rate = np.append(field.rate, np.full(nstars, rate))
+        field.mag = np.append(field.mag, np.full(nstars, mag))
+
+
+class StageRecorder(object):
+    """ stageTimer collecting the time, and optionally the memory, of each stage """
+
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.times = collections.defaultdict(float)
+        self.peaks = collections.defaultdict(int)
+        self.start = 0
+
+    def begin(self):
+        self.times.clear()
+        self.peaks.clear()
+        if self.memory:
+            tracemalloc.reset_peak()
+            self.start = tracemalloc.get_traced_memory()[0]
+
+    def __call__(self, stage, seconds):
+        self.times[stage] += seconds
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            self.peaks[stage] = max(self.peaks[stage], peak - self.start)
+            tracemalloc.reset_peak()
+            self.start = current
+
+
+def runCase(engine, frame, iParms, cParms, repeat):
+    """ Centroid a frame repeat times, return the per-stage times and memory """
+
+    recorder = StageRecorder()
+    ct.stageTimer = recorder
+    times = collections.defaultdict(list)
+    totals = []
+    try:
+        for n in range(repeat):
+            recorder.begin()
+            t0 = time.perf_counter()
+            spots = photometry.measure(frame.copy(), 0, dict(cParms), iParms, engine)
+            totals.append(time.perf_counter() - t0)
+            for stage, dt in recorder.times.items():
+                times[stage].append(dt)
+
+        recorder = StageRecorder(memory=True)
+        ct.stageTimer = recorder
+        tracemalloc.start()
+        try:
+            recorder.begin()
+            photometry.measure(frame.copy(), 0, dict(cParms), iParms, engine)
+        finally:
+            tracemalloc.stop()
+    finally:
+        ct.stageTimer = None
+
+    saturated = int(np.count_nonzero(spots['flags'] & ct.SourceDetectionFlag.SATURATED))
+    return dict(spots=len(spots), saturated=saturated,
+                total_ms=float(np.median(totals)) * 1000,
+                stages=dict((stage, dict(ms=float(np.median(dt)) * 1000,
+                                         peak_mb=recorder.peaks.get(stage, 0) / 2**20))
+                            for stage, dt in times.items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='AGCC centroid micro-benchmarks')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='timed runs per case')
+    parser.add_argument('--engines', default='sep', help='comma separated centroid methods')
+    parser.add_argument('--exptime', type=float, default=1.0, help='exposure time of the frames in seconds')
+    parser.add_argument('--cases', default='', help='only the cases containing this string')
+    parser.add_argument('--baseline', help='JSON of an earlier run to compare with')
+    parser.add_argument('-o', '--output', help='JSON output file')
+    args = parser.parse_args()
+
+    cParms = dict(benchCentroidParams, expTime=args.exptime)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+    results = {}
+    for engine in args.engines.split(','):
+        for name, options, reg, nsat in cases():
+            if args.cases not in name:
+                continue
+            field = starfield.StarField(**options)
+            if nsat > 0:
+                addSaturated(field, reg, nsat, args.exptime)
+            frame = field.render(args.exptime)
+            iParms = dict(benchImageParams, **{'1': dict(reg=reg, badCols=[])})
+            key = f'{engine}:{name}'
+            results[key] = r = runCase(engine, frame, iParms, cParms, args.repeat)
+
+            line = '%-44s %4d spots %3d sat %7.1f ms ' % (key, r['spots'], r['saturated'], r['total_ms'])
+            line += ' '.join('%s=%.1f' % (stage, s['ms']) for stage, s in r['stages'].items())
+            if baseline is not None and key in baseline:
+                line += '  x%.2f' % (r['total_ms'] / baseline[key]['total_ms'])
+            print(line, flush=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(version=version(), date=datetime.datetime.now().isoformat(),
+                           host=platform.node(), python=platform.python_version(),
+                           numpy=np.__version__, args=vars(args), results=results), f, indent=2)
+            f.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,26 @@
 
-from scipy.stats import sigmaclip
 import yaml
 import os
+import time
 import numpy as np
 import sep
-from scipy.ndimage import gaussian_filter
 
-from scipy.integrate import dblquad
-from lmfit import Model
-import lmfit
+from pfs.utils.datamodel.ag import SourceDetectionFlag
 
-from lmfit import Model
-import lmfit
+# optional callable(stage, seconds), called at the end of each stage of
+# getCentroidsSep; used by the centroid benchmarks (centroidBench.py)
+stageTimer = None
 
-from pfs.utils.datamodel.ag import SourceDetectionFlag
+def _mark(stage, t0):
+
+    """
+    report a stage which began at t0 to stageTimer, return the time now
+    """
+
+    t = time.perf_counter()
+    if stageTimer is not None:
+        stageTimer(stage, t - t0)
+    return t
 
 
 def getCentroidParams(cmd):
@@ -97,13 +104,16 @@ def centroidRegion(data, thresh, minarea, deblend):
     """
     
     # determine the background
+    t0 = time.perf_counter()
     bgClass = sep.Background(data)
     background = bgClass.back()
     rms = bgClass.rms()
     bgClass.subfrom(data)
+    t0 = _mark('background', t0)
 
     # get spots using sourcing extractor defaults
     spots = sep.extract(data, thresh, rms, minarea = minarea, deblend_cont=deblend)
+    _mark('extract', t0)
 
     # get windowed positions for the spots
     return spots,len(spots),background
@@ -131,14 +141,19 @@ def getCentroidsSep(data,iParms,cParms,spotDtype,agcid):
         satValue2 = (2**16)-1
     flatVal = iParms['flatVal']
 
+    t0 = time.perf_counter()
     dataProc=subOverscan(data.astype('float'))
+    t0 = _mark('overscan', t0)
     dataProc=interpBadCol(dataProc,iParms[str(agcid + 1)]['badCols'])
+    t0 = _mark('badcols', t0)
     
     _data1 = dataProc[region[2]:region[3],region[0]:region[1]].astype('float', copy=True, order="C")
     _data2 = dataProc[region[6]:region[7],region[4]:region[5]].astype('float', copy=True, order="C")
+    t0 = _mark('regions', t0)
 
     spots1, nSpots1, background1  = centroidRegion(_data1, thresh, minarea,deblend=deblend)
     spots2, nSpots2, background2  = centroidRegion(_data2, thresh, minarea,deblend=deblend)
+    t0 = time.perf_counter()
 
     nElem = nSpots1 + nSpots2
 
@@ -231,6 +246,8 @@ def getCentroidsSep(data,iParms,cParms,spotDtype,agcid):
     ind = np.where(diag < flatVal)
     result['flags'][:][ind] += SourceDetectionFlag.FLAT_TOP
     
+    t0 = _mark('flags', t0)
+
     # calculate more reasonable FWHMs
 
     # subract the background
@@ -272,8 +289,10 @@ def getCentroidsSep(data,iParms,cParms,spotDtype,agcid):
     result['central_image_moment_02_pix']=np.array(m02)
     result['central_image_moment_11_pix']=np.array(m11)
     result['flags'] = result['flags']+np.array(flags)
+    t0 = _mark('moments', t0)
     print(f'Calculating Magnitude: exptime = {cParms["expTime"]}')
     result['estimated_magnitude'] = calculateApproximateMagnitude(iParms,result['image_moment_00_pix'],cParms['expTime'])
+    _mark('magnitudes', t0)
 
     return result
 
@@ -430,6 +449,9 @@ def fittedFWHM(data, xPos, yPos):
     fit gaussian to pre-calculated centre
     """
 
+    # lmfit is slow to import and only needed here
+    from lmfit import Model
+
     ww = 10
 
     # x and y position grid
@@ -1,14 +1,44 @@
+#!/usr/bin/env python
+"""Centroid an AG frame with the configured parameters and print the spots.
 
+    python checkit.py image.fits [--camera N] [--exptime S] [--visit V --exposure E]
+
+With --visit and --exposure the centroids are also written to OpDB.
+"""
+
+import argparse
 
-import centroidTools as ct
-from astropy.io.fits import getdata
 import numpy as np
+from astropy.io.fits import getdata
+
 import dbRoutinesAGCC as dbRoutinesAGCC
-import pandas as pd
+import photometry
+from agccActor import centroidTools as ct
+
+
+def main():
+    parser = argparse.ArgumentParser(description='centroid an AG frame')
+    parser.add_argument('filename', help='FITS image')
+    parser.add_argument('--camera', type=int, default=1, help='camera id [1-6]')
+    parser.add_argument('--exptime', type=float, default=1.0, help='exposure time in seconds')
+    parser.add_argument('--visit', type=int, help='pfs_visit_id to write the centroids to')
+    parser.add_argument('--exposure', type=int, help='agc_exposure_id to write the centroids to')
+    args = parser.parse_args()
+
+    cParm = ct.getCentroidParams(None)
+    cParm['expTime'] = args.exptime
+    iParm = ct.getImageParams(None)
+    image = getdata(args.filename).astype(np.uint16)
+
+    agcid = args.camera - 1
+    centroids = photometry.measure(image, agcid, cParm, iParm, 'sep')
+    print(f'{len(centroids)} spots')
+    for spot in centroids:
+        print(spot)
 
-cParm=ct.getCentroidParams([])
-image=getdata("/Users/karr/test1.fits")
+    if args.visit is not None and args.exposure is not None:
+        dbRoutinesAGCC.writeCentroidsToDB(centroids, args.visit, args.exposure, agcid)
 
-centroids=ct.getCentroids(image,cParm)
 
-dbRoutinesAGCC.writeCentroidsToDB(centroids,100,1)
+if __name__ == '__main__':
+    main()
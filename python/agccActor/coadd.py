@@ -0,0 +1,104 @@
+"""Online co-adds of sequence frames.
+
+A Stacker keeps the running sum of the frames of one camera in a float32
+accumulator allocated once, and after nstack frames hands back a Frame
+with their mean, which is centroided and written instead of the single
+frames. The detection threshold is relative to the background noise, so
+the mean of nstack frames reaches fainter stars while the bias,
+saturation and magnitude calibration of a single frame still apply.
+
+With clipping, a pixel value further than clip sigma from the running
+mean of the frames before is left out of the pixel's sum, which removes
+cosmic rays and other transients. The per-pixel mean and variance come
+from the running sums, so no frame is kept; as a variance from a few
+frames is noisy, it is not taken below the median variance of the frame.
+"""
+
+import copy
+import threading
+
+import numpy as np
+
+
+class Stacker(object):
+    """ Running co-add of the frames of one camera """
+
+    def __init__(self, shape, nstack, clip=0.0):
+        """ Allocate the accumulators
+
+        Args:
+           shape  - (ny, nx) of the frames
+           nstack - number of frames in a stack
+           clip   - clipping threshold in sigma, 0 for a plain sum
+        """
+
+        self.nstack = nstack
+        self.clip = clip
+        self.lock = threading.Lock()
+        self.allocate(shape)
+
+    def allocate(self, shape):
+        self.shape = tuple(shape)
+        self.sum = np.zeros(self.shape, dtype=np.float32)
+        if self.clip > 0:
+            self.sumsq = np.zeros(self.shape, dtype=np.float32)
+            self.count = np.zeros(self.shape, dtype=np.uint16)
+        self.n = 0
+        self.nclipped = 0
+
+    def reset(self):
+        self.sum.fill(0)
+        if self.clip > 0:
+            self.sumsq.fill(0)
+            self.count.fill(0)
+        self.n = 0
+        self.nclipped = 0
+
+    def accumulate(self, data):
+        """ Add a frame to the sums """
+
+        if self.clip > 0 and self.n >= 2:
+            # at least two frames for a variance
+            count = np.maximum(self.count, 2).astype(np.float32)
+            mean = self.sum / count
+            var = np.maximum(self.sumsq / count - mean * mean, 0) * (count / (count - 1))
+            # the median of a chi-square variance estimate is below the variance
+            dof = self.n - 1
+            floor = np.median(var[::4, ::4]) / (1 - 2 / (9 * dof)) ** 3
+            var = np.maximum(var, floor)
+            diff = data - mean
+            keep = diff * diff <= (self.clip * self.clip) * var
+            self.nclipped += int(keep.size - np.count_nonzero(keep))
+            values = np.where(keep, data, 0).astype(np.float32)
+            self.sum += values
+            self.sumsq += values * values
+            self.count += keep
+        else:
+            self.sum += data
+            if self.clip > 0:
+                values = data.astype(np.float32)
+                self.sumsq += values * values
+                self.count += 1
+        self.n += 1
+
+    def add(self, frame):
+        """ Add a frame, return the stacked Frame after nstack frames, else None """
+
+        with self.lock:
+            if frame.data.shape != self.shape:
+                # the exposure area changed, start again
+                self.allocate(frame.data.shape)
+            self.accumulate(frame.data)
+            if self.n < self.nstack:
+                return None
+
+            if self.clip > 0:
+                image = self.sum / np.maximum(self.count, 1)
+            else:
+                image = self.sum / self.n
+            stacked = copy.copy(frame)
+            stacked.data = image.astype(np.float32)
+            stacked.nstack = self.n
+            stacked.nclipped = self.nclipped
+            self.reset()
+        return stacked
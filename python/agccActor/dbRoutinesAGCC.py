@@ -1,14 +1,21 @@
 import datetime
 import logging
+from typing import TYPE_CHECKING
 
 import numpy as np
-import pandas as pd
 from pfs.utils.database import opdb
 
+if TYPE_CHECKING:
+    import pandas as pd
+
 logger = logging.getLogger('agcc')
 logger.setLevel(logging.INFO)
 
 
+class MissingStatusError(RuntimeError):
+    """The telescope status or environmental conditions of a visit are not in OpDB."""
+
+
 def getNextAgcExposureId(db: opdb.OpDB | None = None) -> int:
     """Get the next available AGC exposure identifier.
 
@@ -41,7 +48,8 @@ def writeVisitToDB(pfsVisitId: int, db: opdb.OpDB | None = None) -> None:
     db.insert_kw('pfs_visit', pfs_visit_id=pfsVisitId, pfs_visit_description='')
 
 
-def writeExposureToDB(visitId: int, exposureId: int, exptime: float, db: opdb.OpDB | None = None) -> None:
+def writeExposureToDB(visitId: int, exposureId: int, exptime: float, takenAt: datetime.datetime | None = None,
+                      db: opdb.OpDB | None = None) -> None:
     """Write exposure information to the agc_exposure table.
 
     This includes telescope information and environmental conditions.
@@ -54,6 +62,8 @@ def writeExposureToDB(visitId: int, exposureId: int, exptime: float, db: opdb.Op
         The AGC exposure identifier.
     exptime : float
         The exposure time in seconds.
+    takenAt : datetime.datetime, optional
+        The time the exposure was taken. Defaults to now.
     db : opdb.OpDB, optional
         The database connection object. If not provided, a new connection is created.
     """
@@ -68,7 +78,7 @@ def writeExposureToDB(visitId: int, exposureId: int, exptime: float, db: opdb.Op
 
     if teleInfo is None:
         logger.error(f"No telescope status found for pfs_visit_id={visitId}. Cannot write exposure record.")
-        raise RuntimeError(f"No telescope status found for pfs_visit_id={visitId}.")
+        raise MissingStatusError(f"No telescope status found for pfs_visit_id={visitId}.")
 
     obsCond = db.query_series(
         'select pfs_visit_id, outside_temperature, outside_pressure, outside_humidity '
@@ -78,7 +88,7 @@ def writeExposureToDB(visitId: int, exposureId: int, exptime: float, db: opdb.Op
 
     if obsCond is None:
         logger.error(f"No environmental conditions found for pfs_visit_id={visitId}. Cannot write exposure record.")
-        raise RuntimeError(f"No environmental conditions found for pfs_visit_id={visitId}.")
+        raise MissingStatusError(f"No environmental conditions found for pfs_visit_id={visitId}.")
 
     cols = {'pfs_visit_id': visitId,
             'agc_exposure_id': exposureId,
@@ -91,7 +101,7 @@ def writeExposureToDB(visitId: int, exposureId: int, exptime: float, db: opdb.Op
             'outside_temperature': obsCond['outside_temperature'],
             'outside_pressure': obsCond['outside_pressure'],
             'outside_humidity': obsCond['outside_humidity'],
-            'taken_at': datetime.datetime.now(),
+            'taken_at': takenAt or datetime.datetime.now(),
             'measurement_algorithm': 'SEP',
             'version_actor': 'git',
             'version_instdata': 'git',
@@ -106,6 +116,28 @@ def writeExposureToDB(visitId: int, exposureId: int, exptime: float, db: opdb.Op
         raise
 
 
+def _centroidsDataFrame(result: np.ndarray, exposureId: int, cameraId: int) -> "pd.DataFrame":
+    """Build the agc_data rows for the centroids of one camera."""
+    # pandas is only imported when the first centroids are written
+    import pandas as pd
+
+    num_centroids = result.shape[0]
+
+    # Create array of frameIDs, etc. (same for all spots)
+    exposureIds = np.repeat(exposureId, num_centroids).astype('int')
+    cameraIds = np.repeat(cameraId, num_centroids).astype('int')
+
+    # Turn the record array into a pandas DataFrame
+    df = pd.DataFrame(result)
+
+    # Add the extra fields
+    df['agc_exposure_id'] = exposureIds
+    df['agc_camera_id'] = cameraIds
+    df['spot_id'] = np.arange(0, num_centroids).astype('int')
+
+    return df
+
+
 def writeCentroidsToDB(result: np.ndarray, visitId: int, exposureId: int, cameraId: int, db: opdb.OpDB | None = None
                        ) -> None:
     """Write the centroids to the database in bulk.
@@ -129,20 +161,70 @@ def writeCentroidsToDB(result: np.ndarray, visitId: int, exposureId: int, camera
         The database connection object. If not provided, a new connection is created.
     """
     db = db or opdb.OpDB()
-    num_centroids = result.shape[0]
+    df = _centroidsDataFrame(result, exposureId, cameraId)
 
-    # Create array of frameIDs, etc. (same for all spots)
-    exposureIds = np.repeat(exposureId, num_centroids).astype('int')
-    cameraIds = np.repeat(cameraId, num_centroids).astype('int')
+    logger.info(f"Table is prepared for pfs_visit_id={visitId} agc_exposure_id={exposureId} camera={cameraId}.")
 
-    # Turn the record array into a pandas DataFrame
-    df = pd.DataFrame(result)
+    db.insert_dataframe('agc_data', df=df)
 
-    # Add the extra fields
-    df['agc_exposure_id'] = exposureIds
-    df['agc_camera_id'] = cameraIds
-    df['spot_id'] = np.arange(0, num_centroids).astype('int')
 
-    logger.info(f"Table is prepared for pfs_visit_id={visitId} agc_exposure_id={exposureId} camera={cameraId}.")
+def deleteCentroidsFromDB(exposureId: int, cameraId: int, db: opdb.OpDB | None = None) -> None:
+    """Delete the centroids of one camera and exposure from the agc_data table.
+
+    Parameters
+    ----------
+    exposureId : int
+        The AGC exposure identifier.
+    cameraId : int
+        The AGC camera identifier.
+    db : opdb.OpDB, optional
+        The database connection object. If not provided, a new connection is created.
+    """
+    db = db or opdb.OpDB()
+    db.execute('DELETE FROM agc_data WHERE agc_exposure_id = :agc_exposure_id AND agc_camera_id = :agc_camera_id',
+               params={'agc_exposure_id': exposureId, 'agc_camera_id': cameraId})
+
+
+def replaceCentroidsInDB(result: np.ndarray, visitId: int, exposureId: int, cameraId: int,
+                         db: opdb.OpDB | None = None) -> None:
+    """Replace the centroids of one camera and exposure, e.g. after centroiding again.
+
+    Parameters
+    ----------
+    result : numpy.ndarray
+        The array of the new centroiding results.
+    visitId : int
+        The PFS visit identifier.
+    exposureId : int
+        The AGC exposure identifier.
+    cameraId : int
+        The AGC camera identifier.
+    db : opdb.OpDB, optional
+        The database connection object. If not provided, a new connection is created.
+    """
+    db = db or opdb.OpDB()
+    deleteCentroidsFromDB(exposureId, cameraId, db=db)
+    if len(result) > 0:
+        writeCentroidsToDB(result, visitId, exposureId, cameraId, db=db)
+
+
+def writeCentroidsBatchToDB(batch: list[tuple[np.ndarray, int, int, int]], db: opdb.OpDB | None = None) -> None:
+    """Write the centroids of several cameras and exposures in a single insert.
+
+    Parameters
+    ----------
+    batch : list of tuple
+        (result, visitId, exposureId, cameraId) for each camera, as passed to
+        `writeCentroidsToDB`.
+    db : opdb.OpDB, optional
+        The database connection object. If not provided, a new connection is created.
+    """
+    import pandas as pd
+
+    db = db or opdb.OpDB()
+    df = pd.concat([_centroidsDataFrame(result, exposureId, cameraId)
+                    for result, visitId, exposureId, cameraId in batch], ignore_index=True)
+
+    logger.info(f"Table is prepared for {len(batch)} cameras, {len(df)} centroids.")
 
     db.insert_dataframe('agc_data', df=df)
@@ -1,6 +1,12 @@
 import threading
 import writeFits
 import photometry
+import timing
+import metrics
+import frameRing
+import spotTracker
+from frame import Frame
+import datetime
 import os
 import time
 
@@ -10,10 +16,16 @@ from agccActor import dbRoutinesAGCC
 class Exposure(threading.Thread):
     exp_lock = threading.Lock()
     n_busy = 0
+    # ids taken from OpDB before their agc_exposure row is written
+    id_lock = threading.Lock()
+    lastExposureId = -1
+    # seconds the cameras wait for each other to start together
+    syncTimeout = 10.0
 
     def __init__(self, cams, expTime_ms, dflag, cParms, iParms, visitId, cMethod, 
                  cmd = None, combined = False, centroid = False, seq_id = -1, 
-                 threadDelay=None, tecOFF=False):
+                 threadDelay=None, tecOFF=False, journal=None, fitsWriter=None, timeline=None,
+                 pipelined=False, archiver=None, rings=None, stackers=None, trackers=None, syncStart=None):
         
         """ Run exposure command
 
@@ -25,6 +37,24 @@ class Exposure(threading.Thread):
            combined    - Multiple FITS files/Single FITS file
            centroid    - True if do centroid else don't
            seq_id      - Sequence id
+           journal     - DBJournal for the OpDB writes which fail, direct writes only if None
+           fitsWriter  - FitsWriter process for the FITS files, written in the
+                         exposure threads if None
+           timeline    - timing.Timeline of the command, a new one if None
+           pipelined   - copy the frames out of the camera buffers, the next
+                         exposure may start before they are processed
+           archiver    - frameRing.Archiver which keeps the frames and writes
+                         the selected ones, all are written if None
+           rings       - dict of agcid: frameRing.FrameRing keeping the frames
+                         written, to centroid them again
+           stackers    - dict of agcid: coadd.Stacker; only the stacked frames
+                         are centroided and written
+           trackers    - dict of agcid: spotTracker.SpotTracker giving the
+                         spots their track_id
+           syncStart   - StartBarrier class of the camera driver: set up all the
+                         cameras first and start their exposures together,
+                         unless a threadDelay staggers them. None to start
+                         them one by one
 
         Returns:
            - NULL
@@ -44,6 +74,26 @@ class Exposure(threading.Thread):
         self.iParms = iParms
         self.seq_id = seq_id
         self.cMethod = cMethod
+        self.journal = journal
+        self.timeline = timeline if timeline is not None else timing.Timeline()
+        self.pipelined = pipelined
+        self.archiver = archiver
+        self.rings = rings
+        self.stackers = stackers
+        self.trackers = trackers
+        self.syncStart = syncStart
+        self.startBarrier = None
+        # start time of the exposure of each camera, for the start skew
+        self.starts = {}
+        self.aborted = False
+        self.frames = {}
+        # set when all the cameras have read out and can take the next exposure
+        self.readoutDone = threading.Event()
+        self.nReading = len(cams)
+        if fitsWriter is not None and fitsWriter.isAlive():
+            self.fitsWriter = fitsWriter
+        else:
+            self.fitsWriter = None
 
         # update the exposure time in cParms
 
@@ -62,7 +112,14 @@ class Exposure(threading.Thread):
         else:
             self.timeDelay = threadDelay/1000
 
-        self.nframe = dbRoutinesAGCC.getNextAgcExposureId()
+        with self.timeline.span('exposureId'):
+            if self.journal is not None:
+                self.nframe = self.journal.nextExposureId()
+            else:
+                with Exposure.id_lock:
+                    self.nframe = max(dbRoutinesAGCC.getNextAgcExposureId(), Exposure.lastExposureId + 1)
+                    Exposure.lastExposureId = self.nframe
+        self.timeline.exposureId = self.nframe
         self.cmd.inform(f'text="Getting agc_exposure_id = {self.nframe} from OpDB"')
         
         # get nframe keyword, unique for each exposure
@@ -85,10 +142,39 @@ class Exposure(threading.Thread):
                     f.write(str(self.nframe))
             self.cmd.inform(f'text="Recording agc_exposure_id = {self.nframe} to {filename}"')
 
-        dbRoutinesAGCC.writeExposureToDB(self.visitId,self.nframe, expTime_ms/1000.0)
+        # the agc_exposure row is written once the exposure has started
+        self.exposureLock = threading.Lock()
+        self.exposureWritten = False
+
+    def writeExposure(self, tstart=None, agcid=None):
+        """ Write the agc_exposure row once, before any centroids
+
+        Args:
+           tstart - start time of the exposure (time.time()), now if None
+           agcid  - camera whose start is used, for the timeline
+        """
+
+        takenAt = datetime.datetime.fromtimestamp(tstart) if tstart is not None else None
+        with self.exposureLock:
+            if self.exposureWritten:
+                return
+            self.exposureWritten = True
+            with self.timeline.span('writeExposure', agcid):
+                if self.journal is not None:
+                    self.journal.writeExposure(self.visitId, self.nframe, self.expTime_ms/1000.0, takenAt=takenAt)
+                else:
+                    dbRoutinesAGCC.writeExposureToDB(self.visitId, self.nframe, self.expTime_ms/1000.0,
+                                                     takenAt=takenAt)
 
 
     def run(self):
+        try:
+            self._run()
+        finally:
+            # the cameras are free, also after an error before their readout
+            self.readoutDone.set()
+
+    def _run(self):
         # check if any camera is available
         if len(self.cams) <= 0:
             if self.cmd:
@@ -101,10 +187,26 @@ class Exposure(threading.Thread):
             if self.cmd:
                 self.cmd.inform('agc_exposing=%d' % Exposure.n_busy)
 
+        # combined files are assembled as each camera finishes
+        self.combinedWriter = None
+        self.combinedFile = None
+        if self.combined and self.archiver is None and self.stackers is None:
+            shapes = {cam.agcid: writeFits.frameShape(cam) for cam in self.cams}
+            if self.fitsWriter is not None:
+                self.combinedFile = self.fitsWriter.openCombined(self.visitId, shapes, self.nframe)
+            else:
+                filename = writeFits.fitsFilename(self.visitId, self.nframe)
+                self.combinedWriter = writeFits.CombinedWriter(filename, shapes)
+
+        if self.syncStart is not None and self.timeDelay <= 0 and len(self.cams) > 1:
+            self.startBarrier = self.syncStart(len(self.cams), Exposure.syncTimeout)
+
         thrs = []
         for cam in self.cams:
-            self.cmd.inform(f'text="Applying time delay of {self.timeDelay} second on Cam {cam.devsn}"')
-            time.sleep(self.timeDelay)
+            if self.startBarrier is None:
+                self.cmd.inform(f'text="Applying time delay of {self.timeDelay} second on Cam {cam.devsn}"')
+                with self.timeline.span('threadDelay', cam.agcid):
+                    time.sleep(self.timeDelay)
             
             if self.tecOFF is True:
                 targetTemp = cam.temp
@@ -121,6 +223,9 @@ class Exposure(threading.Thread):
         for thr in thrs:
             thr.join()
         self.cmd.debug('text="done joining exposure threads"')
+        # no camera started
+        self.writeExposure()
+        self.reportStartSkew()
 
         with Exposure.exp_lock:
             Exposure.n_busy -= len(self.cams)
@@ -128,8 +233,25 @@ class Exposure(threading.Thread):
                 self.cmd.inform('agc_exposing=%d' % Exposure.n_busy)
                 self.cmd.inform('agc_frameid=%d' % self.nframe)
 
-        if self.combined and self.cams[0].getTotalTime() > 0:
-            writeFits.wfits_combined(self.cmd, self.visitId, self.cams, self.nframe, self.seq_id)
+        if self.archiver is not None:
+            with self.timeline.span('archive'):
+                self.archiver.add(self.cmd, self, [self.frames[cam.agcid] for cam in self.cams
+                                                   if cam.agcid in self.frames])
+        elif self.stackers is not None:
+            stacked = [self.frames[cam.agcid] for cam in self.cams if cam.agcid in self.frames]
+            if len(stacked) > 0:
+                with self.timeline.span('wfitsCombined' if self.combined else 'wfits'):
+                    frameRing.writeFrames(self.cmd, stacked, self.fitsWriter)
+        else:
+            # the frames read out, the cameras for those which failed
+            frames = [self.frames.get(cam.agcid, cam) for cam in self.cams]
+            with self.timeline.span('wfitsCombined'):
+                if self.combined and self.fitsWriter is not None:
+                    self.fitsWriter.wfits_combined(self.cmd, self.combinedFile, self.visitId, frames, self.nframe,
+                                                   self.seq_id)
+                elif self.combined:
+                    writeFits.wfits_combined(self.cmd, self.visitId, frames, self.nframe, self.seq_id,
+                                             combinedWriter=self.combinedWriter)
         
         
         if self.tecOFF is True:
@@ -140,11 +262,69 @@ class Exposure(threading.Thread):
                 self.cmd.inform(f'text="Turing on TEC to {targetTemp}C"')
                 cam.setTemperature(targetTemp)
         
+        self.timeline.finish(self.cmd)
         if self.cmd and self.seq_id < 0:
             self.cmd.finish()
 
+    def reportStartSkew(self):
+        """ Send agc_startSkew=frameId,sync,skew_ms, then each camera's start offset in ms """
+
+        if len(self.starts) < 2:
+            return
+        first = min(self.starts.values())
+        skew = max(self.starts.values()) - first
+        metrics.startSkew.observe(skew)
+        if self.cmd:
+            offsets = ','.join('%.1f' % ((self.starts[cam.agcid] - first) * 1000) if cam.agcid in self.starts
+                               else 'nan' for cam in self.cams)
+            self.cmd.inform('agc_startSkew=%d,%d,%.1f,%s' % (self.nframe, self.startBarrier is not None,
+                                                             skew * 1000, offsets))
+
+    def start_exposure(self, cam):
+        """ Take the exposure of a camera, started together with the others with
+        syncStart """
+
+        if self.startBarrier is None:
+            cam.expose(dark=self.dflag)
+            return
+        try:
+            cam.prepareExposure(dark=self.dflag)
+        except Exception:
+            # the others start without this camera
+            self.startBarrier.abort()
+            raise
+        # the driver waits for the other cameras and starts in one step
+        cam.startExposure(barrier=self.startBarrier)
+
+    def cameraReleased(self):
+        """ Count a camera done with its readout, set readoutDone after the last one """
+
+        with Exposure.exp_lock:
+            self.nReading -= 1
+            if self.nReading <= 0:
+                self.readoutDone.set()
+
     def expose_thr(self, cam, multiproc=True):
         """ Concurrent exposure thread for camera readouts """
+
+        try:
+            frame = self.readout(cam)
+            if frame is not None and self.stackers is not None:
+                # added before the camera takes the next frame, so without a copy
+                with self.timeline.span('stack', cam.agcid):
+                    frame = self.stackers[cam.agcid].add(frame)
+                if frame is not None and self.cmd:
+                    self.cmd.inform('agc_stack=%d,%d,%d,%d' % (cam.agcid + 1, self.nframe, frame.nstack,
+                                                               frame.nclipped))
+        finally:
+            self.cameraReleased()
+        if frame is not None:
+            self.frames[cam.agcid] = frame
+            self.process(frame, multiproc)
+
+    def readout(self, cam):
+        """ Take the exposure, return the Frame read out or None """
+
         cam_id = cam.agcid + 1
         if self.cmd:
             self.cmd.inform(f'agc{cam_id:d}_stat=BUSY')
@@ -152,66 +332,137 @@ class Exposure(threading.Thread):
         try:
             cam.setExpTime(self.expTime_ms)
         except Exception as e:
+            if self.startBarrier is not None:
+                self.startBarrier.abort()
             if self.cmd:
                 self.cmd.warn(f'text="AGC[{cam_id}]: set exposure time error: {e}"')
-            return
+            return None
 
         try:
-            cam.expose(dark=self.dflag)
+            start = time.monotonic()
+            self.start_exposure(cam)
+            end = time.monotonic()
+            self.starts[cam.agcid] = cam.tstart
+            self.writeExposure(cam.tstart, cam.agcid)
+            # after any wait for the other cameras
+            start = max(start, end - (time.time() - cam.tstart))
+            # the driver returns after the readout, split at the exposure time
+            readout = min(start + self.expTime_ms / 1000.0, end)
+            self.timeline.add('expose', start, readout, cam.agcid)
+            self.timeline.add('readout', readout, end, cam.agcid)
         except Exception as e:
+            metrics.exposureErrors.inc(camera=str(cam_id))
             if self.cmd:
                 self.cmd.warn(f'text="AGC[{cam_id}]: exposure error: {e}"')
-            return
+            return None
 
         try:
             tread = cam.getTotalTime()
         except Exception as e:
+            metrics.exposureErrors.inc(camera=str(cam_id))
             if self.cmd:
                 self.cmd.warn(f'text="AGC[{cam_id}]: readout error in getTotalTime: {e}"')
-            return
+            return None
+
+        if tread > 0:
+            metrics.frames.inc(camera=str(cam_id))
+        else:
+            metrics.aborts.inc(camera=str(cam_id))
+            # from the abort to the camera ready
+            latency = cam.abortLatency
+            if latency is not None:
+                metrics.abortLatency.observe(latency)
 
         if self.cmd:
             if tread > 0:
                 self.cmd.inform(f'text="AGC[{cam_id:d}]: Retrieve camera data in {tread:.2f}s"')
             else:
                 self.cmd.inform(f'text="AGC[{cam_id:d}]: Exposure aborted"')
+                if latency is not None:
+                    self.cmd.inform('agc_abort=%d,%d,%.1f' % (cam_id, self.nframe, latency * 1000))
             self.cmd.inform(f'agc{cam_id:d}_stat=READY')
 
+        if tread <= 0:
+            self.aborted = True
+            return None
+        # frames kept after the exposure are copied out of the driver's buffer
+        frame = Frame(cam, copy=(self.pipelined and self.stackers is None) or self.rings is not None)
+        frame.visitId = self.visitId
+        frame.nframe = self.nframe
+        frame.seq_id = self.seq_id
+        frame.combined = self.combined
+        return frame
+
+    def process(self, frame, multiproc=True):
+        """ Centroid a frame, write the spots to OpDB and the image to FITS """
+
+        cam = frame.cam
+        cam_id = frame.agcid + 1
         spots = None
-        if tread > 0:
-            if self.centroid:
-                if multiproc:
-                    cam.in_queue.put(cam.data)
-                    cam.in_queue.put(cam.agcid)
-                    cam.in_queue.put(self.cParms)
-                    cam.in_queue.put(self.iParms)
-                    cam.in_queue.put(self.cMethod)
-                    try:
-                        spots = cam.out_queue.get()
-                    except Exception as e:
-                        self.cmd.warn(f'text="AGC[{cam_id}]: photometry multiprocessing error with photometry: {e}"')
-                else:
+        if self.centroid:
+            if multiproc:
+                # the worker answers in order, one frame of the camera at a time
+                with cam.workerLock:
+                    with self.timeline.span('queue', frame.agcid):
+                        cam.in_queue.put(photometry.measureRequest(frame.data, frame.agcid, self.cParms,
+                                                                   self.iParms, self.cMethod))
+                    # the worker's centroiding and the transfer of the spots back
+                    with self.timeline.span('centroid', frame.agcid):
+                        try:
+                            spots = photometry.getResult(cam.out_queue)
+                        except Exception as e:
+                            self.cmd.warn(f'text="AGC[{cam_id}]: photometry multiprocessing error with photometry: {e}"')
+            else:
+                with self.timeline.span('centroid', frame.agcid):
                     try:
-                        spots = photometry.measure(cam.data,cam.agcid,self.cParms,self.iParms,self.cMethod)
+                        spots = photometry.measure(frame.data,frame.agcid,self.cParms,self.iParms,self.cMethod)
                     except Exception as e:
                         self.cmd.warn(f'text="AGC[{cam_id}]: photometry error: {e}"')
                         spots = None
 
-                cam.spots = spots
-
-                # Writing to database when spot number is larger than zero
-                if spots is not None and len(spots) > 0:
-                    if self.cmd:
-                        self.cmd.inform(f'text="AGC[{cam_id:d}]: find {len(spots):d} objects"')
-                        self.cmd.inform(f'text="AGC[{cam_id:d}]: wrote centroids to database"')
-                        aa=spots['estimated_magnitude']
-                        self.cmd.inform(f'text="AGC[{cam_id:d}]: estimated mags = {aa}"')
-
-                    dbRoutinesAGCC.writeCentroidsToDB(spots,self.visitId, self.nframe,cam.agcid)
+            if spots is not None:
+                metrics.spots.inc(len(spots), camera=str(cam_id))
+
+            # Writing to database when spot number is larger than zero
+            if spots is not None and len(spots) > 0:
+                if self.cmd:
+                    self.cmd.inform(f'text="AGC[{cam_id:d}]: find {len(spots):d} objects"')
+                    self.cmd.inform(f'text="AGC[{cam_id:d}]: wrote centroids to database"')
+                    aa=spots['estimated_magnitude']
+                    self.cmd.inform(f'text="AGC[{cam_id:d}]: estimated mags = {aa}"')
+
+                with self.timeline.span('writeCentroids', frame.agcid):
+                    if self.journal is not None:
+                        self.journal.writeCentroids(spots, self.visitId, self.nframe, frame.agcid)
+                    else:
+                        dbRoutinesAGCC.writeCentroidsToDB(spots,self.visitId, self.nframe,frame.agcid)
+            else:
+                self.cmd.inform(f'text="AGC[{cam_id:d}]: found no objects, skipping DB writing"')
+
+            if spots is not None and self.trackers is not None and frame.agcid in self.trackers:
+                # after the DB write, track_id is not an agc_data column
+                with self.timeline.span('track', frame.agcid):
+                    spots, summary = self.trackers[frame.agcid].update(spots)
+                if self.cmd:
+                    self.cmd.inform('agc_tracks=%s' % spotTracker.keyStr(frame.agcid, self.nframe,
+                                                                         len(spots), summary))
+        frame.spots = spots
+        cam.spots = spots
+
+        if self.archiver is not None or self.stackers is not None:
+            # written once all the cameras are done
+            return
+        if self.rings is not None and frame.agcid in self.rings:
+            frame.archived = True
+            self.rings[frame.agcid].add(frame)
+        with self.timeline.span('wfits', frame.agcid):
+            if self.fitsWriter is not None:
+                if self.combined:
+                    self.fitsWriter.addCombined(self.combinedFile, self.visitId, frame, self.nframe, self.seq_id)
                 else:
-                    self.cmd.inform(f'text="AGC[{cam_id:d}]: found no objects, skipping DB writing"')
+                    self.fitsWriter.wfits(self.cmd, self.visitId, frame, self.nframe)
+            elif self.combined:
+                cards = writeFits.frameCards(frame, self.visitId, self.nframe, self.seq_id)
+                self.combinedWriter.add(frame.agcid, frame.data, cards, frame.spots)
             else:
-                cam.spots = spots
-
-            if not self.combined:
-                writeFits.wfits(self.cmd, self.visitId, cam, self.nframe)
+                writeFits.wfits(self.cmd, self.visitId, frame, self.nframe)
@@ -0,0 +1,388 @@
+"""Direct FITS writer for the fixed AG frame layout.
+
+The astropy path rebuilds every header card by card, builds HDU objects
+and checksums them through a generic code path. Our files always have
+the same shape: an image (or six image extensions) plus optional spot
+tables. Here the structural header cards are precompiled per shape and
+only the frame keywords are formatted; the data go from the NumPy
+buffer to the file with a single big-endian conversion and writev, and
+the DATASUM/CHECKSUM values are accumulated while the blocks are built.
+The files read back in astropy exactly like the ones writeFits writes.
+"""
+
+import functools
+import mmap
+import os
+import threading
+import time
+
+import numpy as np
+
+BLOCK = 2880
+CARD = 80
+
+# dtype: (BITPIX, BZERO)
+_bitpix = {
+    np.dtype('uint8'): (8, None),
+    np.dtype('int16'): (16, None),
+    np.dtype('uint16'): (16, 32768),
+    np.dtype('int32'): (32, None),
+    np.dtype('float32'): (-32, None),
+    np.dtype('float64'): (-64, None),
+}
+
+_tform = {'f4': 'E', 'f8': 'D', 'i2': 'I', 'i4': 'J', 'i8': 'K', 'u1': 'B'}
+
+_exclude = (0x3a, 0x3b, 0x3c, 0x3d, 0x3e, 0x3f, 0x40,
+            0x5b, 0x5c, 0x5d, 0x5e, 0x5f, 0x60)
+
+
+def supports(data):
+    """ Return True if the array can be written by this module """
+
+    return data is not None and data.ndim == 2 and data.dtype in _bitpix
+
+
+def _formatValue(value):
+    # FITS has no NaN or Inf: a value which could not be measured is written undefined
+    if value is None or (isinstance(value, (float, np.floating)) and not np.isfinite(value)):
+        return ' ' * 20
+    if isinstance(value, (bool, np.bool_)):
+        return '%20s' % ('T' if value else 'F')
+    if isinstance(value, (int, np.integer)):
+        return '%20d' % value
+    if isinstance(value, (float, np.floating)):
+        s = str(float(value)).replace('e', 'E')
+        if '.' not in s and 'E' not in s:
+            s += '.0'
+        return '%20s' % s[:20]
+    s = "'%-8s'" % str(value).replace("'", "''")
+    return '%-20s' % s
+
+
+def card(key, value, comment=None):
+    """ Format one 80 character header card """
+
+    s = '%-8s= %s' % (key, _formatValue(value))
+    if comment:
+        s += ' / ' + comment
+    if len(s) > CARD:
+        s = s[:CARD]
+    return s.ljust(CARD).encode('ascii')
+
+
+def _pad(nbytes):
+    return (BLOCK - nbytes % BLOCK) % BLOCK
+
+
+@functools.lru_cache(maxsize=64)
+def _imageCards(extension, dtype, shape, extname):
+    """ Precompiled structural cards of an image HDU """
+
+    cards = []
+    if extension:
+        cards.append(card('XTENSION', 'IMAGE', 'Image extension'))
+    else:
+        cards.append(card('SIMPLE', True, 'conforms to FITS standard'))
+    if shape is None:
+        cards.append(card('BITPIX', 8, 'array data type'))
+        cards.append(card('NAXIS', 0, 'number of array dimensions'))
+    else:
+        bitpix, bzero = _bitpix[np.dtype(dtype)]
+        cards.append(card('BITPIX', bitpix, 'array data type'))
+        cards.append(card('NAXIS', 2, 'number of array dimensions'))
+        cards.append(card('NAXIS1', shape[1]))
+        cards.append(card('NAXIS2', shape[0]))
+    if extension:
+        cards.append(card('PCOUNT', 0, 'number of parameters'))
+        cards.append(card('GCOUNT', 1, 'number of groups'))
+    else:
+        cards.append(card('EXTEND', True))
+    if shape is not None and bzero is not None:
+        cards.append(card('BSCALE', 1))
+        cards.append(card('BZERO', bzero))
+    if extname is not None:
+        cards.append(card('EXTNAME', extname.upper(), 'extension name'))
+    return b''.join(cards)
+
+
+def _checksum(buf, sum32=0):
+    """ Ones-complement sum of a buffer of 32 bit big-endian words """
+
+    words = np.frombuffer(buf, dtype='>u4')
+    s = sum32 + int(words.sum(dtype=np.uint64))
+    while s >> 32:
+        s = (s & 0xffffffff) + (s >> 32)
+    return s
+
+
+def _encodeChecksum(value):
+    """ Encode a checksum as the 16 character CHECKSUM value (FITS checksum convention) """
+
+    value = ~value & 0xffffffff
+    asc = [0] * 16
+    for i in range(4):
+        byte = (value >> ((3 - i) * 8)) & 0xff
+        quotient = byte // 4 + 0x30
+        ch = [quotient + byte % 4, quotient, quotient, quotient]
+        check = True
+        while check:
+            check = False
+            for x in _exclude:
+                for j in (0, 2):
+                    if ch[j] == x or ch[j + 1] == x:
+                        ch[j] += 1
+                        ch[j + 1] -= 1
+                        check = True
+        for j in range(4):
+            asc[4 * j + i] = ch[j]
+    return bytes(asc[(i + 15) % 16] for i in range(16)).decode('ascii')
+
+
+def _header(structure, cards, datasum):
+    """ Build a padded header with DATASUM and CHECKSUM for a data checksum """
+
+    when = time.strftime('%Y-%m-%dT%H:%M:%S')
+    body = structure + b''.join(card(*c) for c in cards)
+    tail = card('DATASUM', str(datasum), 'data unit checksum updated ' + when) + b'END'.ljust(CARD)
+    pad = b' ' * _pad(len(body) + CARD + len(tail))
+    head = body + card('CHECKSUM', '0' * 16, 'HDU checksum updated ' + when) + tail + pad
+    value = _encodeChecksum(_checksum(head, datasum))
+    return body + card('CHECKSUM', value, 'HDU checksum updated ' + when) + tail + pad
+
+
+def _toFits(data, out=None):
+    """ Convert an image to big-endian FITS data, into out if given """
+
+    if out is None:
+        out = np.empty(data.shape, dtype=data.dtype.newbyteorder('>'))
+    if data.dtype == np.uint16:
+        np.bitwise_xor(data, 0x8000, out=out, casting='unsafe')
+    else:
+        out[...] = data
+    return out.reshape(-1).view(np.uint8)
+
+
+def _datasum(raw):
+    """ DATASUM of the raw bytes of a data unit """
+
+    whole = raw.nbytes - raw.nbytes % 4
+    datasum = _checksum(raw[:whole])
+    if whole < raw.nbytes:
+        datasum = _checksum(bytes(raw[whole:]) + b'\0' * (4 - raw.nbytes + whole), datasum)
+    return datasum
+
+
+def _imageData(data):
+    """ Convert an image to big-endian FITS data, return (buffers, datasum) """
+
+    raw = _toFits(data)
+    return [raw, b'\0' * _pad(raw.nbytes)], _datasum(raw)
+
+
+def imageHDU(data, cards, extname=None, extension=False):
+    """ Return the list of buffers of an image HDU, data may be None for an empty one """
+
+    if data is None:
+        structure = _imageCards(extension, None, None, extname)
+        return [_header(structure, cards, 0)]
+    structure = _imageCards(extension, data.dtype.str, data.shape, extname)
+    buffers, datasum = _imageData(data)
+    return [_header(structure, cards, datasum)] + buffers
+
+
+def tableHDU(rows, extname=None):
+    """ Return the list of buffers of a binary table HDU
+
+    Args:
+       rows    - structured array of the table rows, one column per field
+       extname - extension name
+    """
+
+    # FITS rows are packed big-endian records, convert in one pass if needed
+    nrows = len(rows)
+    columns = [(name, rows.dtype.fields[name][0].newbyteorder('>')) for name in rows.dtype.names]
+    dtype = np.dtype(columns)
+    if rows.dtype != dtype:
+        rows = rows.astype(dtype)
+
+    structure = [card('XTENSION', 'BINTABLE', 'binary table extension'),
+                 card('BITPIX', 8, 'array data type'),
+                 card('NAXIS', 2, 'number of array dimensions'),
+                 card('NAXIS1', dtype.itemsize, 'length of dimension 1'),
+                 card('NAXIS2', nrows, 'length of dimension 2'),
+                 card('PCOUNT', 0, 'number of group parameters'),
+                 card('GCOUNT', 1, 'number of groups'),
+                 card('TFIELDS', len(columns), 'number of table fields')]
+    for n, (name, coltype) in enumerate(columns):
+        structure.append(card('TTYPE%d' % (n + 1), name))
+        structure.append(card('TFORM%d' % (n + 1), _tform[coltype.str[1:]]))
+    if extname is not None:
+        structure.append(card('EXTNAME', extname.upper(), 'extension name'))
+
+    raw = np.ascontiguousarray(rows).view(np.uint8)
+    pad = b'\0' * _pad(raw.nbytes)
+    body = bytes(raw) + b'\0' * ((4 - raw.nbytes % 4) % 4)
+    return [_header(b''.join(structure), [], _checksum(body)), raw, pad]
+
+
+def _writeAll(fd, buffers):
+    """ Write a list of buffers with writev, which takes at most IOV_MAX
+    buffers per call and may write partially """
+
+    view = [memoryview(buf).cast('B') for buf in buffers if memoryview(buf).nbytes > 0]
+    while view:
+        n = os.writev(fd, view[:1024])
+        while n > 0:
+            if n >= view[0].nbytes:
+                n -= view[0].nbytes
+                view.pop(0)
+            else:
+                view[0] = view[0][n:]
+                n = 0
+
+
+def writeHDUs(filename, hdus):
+    """ Write the buffers of a list of HDUs to a preallocated file """
+
+    buffers = [buf for hdu in hdus for buf in hdu]
+    size = sum(memoryview(buf).nbytes for buf in buffers)
+    tmpname = filename + '.tmp'
+    fd = os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError:
+            pass
+        _writeAll(fd, buffers)
+    finally:
+        os.close(fd)
+    os.replace(tmpname, filename)
+
+
+class CombinedFile(object):
+    """ Combined multi-extension file filled in place as the cameras finish
+
+    The primary HDU and six image extensions are laid out in a preallocated,
+    memory-mapped file when the exposure starts. Each camera's frame is
+    converted straight into its extension, with its header and checksums,
+    as soon as it arrives; the spot tables are appended when the file is
+    closed. A frame that does not fit its slot (unexpected shape, oversized
+    header) is refused and the file is then rewritten once at close.
+    """
+
+    def __init__(self, filename, shapes, dtype=np.uint16):
+        """ Preallocate the file
+
+        Args:
+           filename - output FITS file
+           shapes   - dict of agcid: (ny, nx) for the expected camera frames
+           dtype    - data type of the frames
+        """
+
+        self.filename = filename
+        self.tmpname = filename + '.tmp'
+        self.dtype = np.dtype(dtype)
+        self.lock = threading.Lock()
+        self.slots = {}
+        self.headers = {}
+        self.filled = {}
+        self.spots = {}
+
+        offset = BLOCK
+        for n in range(6):
+            extname = 'cam%d' % (n + 1)
+            if n in shapes:
+                shape = tuple(shapes[n])
+                nbytes = shape[0] * shape[1] * self.dtype.itemsize
+                self.slots[n] = (offset, offset + BLOCK, shape, nbytes)
+                offset += BLOCK + nbytes + _pad(nbytes)
+            else:
+                self.headers[n] = (offset, imageHDU(None, [], extname, extension=True)[0])
+                offset += BLOCK
+        self.size = offset
+
+        self.fd = os.open(self.tmpname, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.ftruncate(self.fd, self.size)
+        try:
+            os.posix_fallocate(self.fd, 0, self.size)
+        except OSError:
+            pass
+        self.mm = mmap.mmap(self.fd, self.size)
+        self.mm[0:BLOCK] = imageHDU(None, [])[0]
+        for hoff, header in self.headers.values():
+            self.mm[hoff:hoff + BLOCK] = header
+
+    def add(self, agcid, data, cards, spots):
+        """ Write one camera frame into its extension
+
+        Returns True if the frame was written into the file (the caller
+        may release the data), False if it does not fit its slot.
+        """
+
+        slot = self.slots.get(agcid)
+        if slot is None or data.shape != slot[2] or data.dtype != self.dtype:
+            return False
+        hoff, doff, shape, nbytes = slot
+
+        out = np.ndarray(shape, dtype=self.dtype.newbyteorder('>'), buffer=self.mm, offset=doff)
+        raw = _toFits(data, out)
+        structure = _imageCards(True, self.dtype.str, shape, 'cam%d' % (agcid + 1))
+        header = _header(structure, cards, _datasum(raw))
+        del out, raw
+        if len(header) != BLOCK:
+            return False
+        self.mm[hoff:doff] = header
+
+        with self.lock:
+            self.filled[agcid] = True
+            self.spots[agcid] = spots
+        return True
+
+    def close(self, frames, tableHDU):
+        """ Append the spot tables and move the file into place
+
+        Args:
+           frames   - dict of agcid: (data, cards, spots) refused by add()
+           tableHDU - function (spots, extname) returning the spot table buffers
+        """
+
+        spots = dict(self.spots)
+        spots.update({n: f[2] for n, f in frames.items()})
+        tables = [tableHDU(spots[n], 'table%d' % (n + 1)) for n in range(6)
+                  if spots.get(n) is not None]
+
+        if len(frames) == 0 and len(self.filled) == len(self.slots):
+            self.mm.flush()
+            self.mm.close()
+            try:
+                os.lseek(self.fd, 0, os.SEEK_END)
+                _writeAll(self.fd, [buf for hdu in tables for buf in hdu])
+            finally:
+                os.close(self.fd)
+            os.replace(self.tmpname, self.filename)
+            return
+
+        # some frames are missing or did not fit: rewrite once from the mapped slots
+        hdus = [[self.mm[0:BLOCK]]]
+        for n in range(6):
+            extname = 'cam%d' % (n + 1)
+            if n in self.filled:
+                hoff, doff, shape, nbytes = self.slots[n]
+                hdus.append([self.mm[hoff:doff + nbytes + _pad(nbytes)]])
+            elif n in frames:
+                data, cards, _ = frames[n]
+                hdus.append(imageHDU(data, cards, extname, extension=True))
+            else:
+                hdus.append(imageHDU(None, [], extname, extension=True))
+        self.mm.close()
+        os.close(self.fd)
+        os.unlink(self.tmpname)
+        writeHDUs(self.filename, hdus + tables)
+
+    def discard(self):
+        """ Drop the file without writing it """
+
+        self.mm.close()
+        os.close(self.fd)
+        os.unlink(self.tmpname)
@@ -0,0 +1,430 @@
+"""Background FITS writer process for the AG camera frames.
+
+Frames are copied once into shared memory by the exposure threads and
+written by a dedicated process, so exposure completion only depends on
+the frame being captured. Combined files are assembled in the writer
+as the cameras finish: the file is opened when the exposure starts, each
+camera's part goes into its extension as soon as it arrives (and its
+shared memory is released), and the tables are appended when the
+exposure is closed. With tile compression the frames are compressed from
+shared memory by a pool of processes started by the writer, so the
+cameras compress in parallel.
+"""
+
+import atexit
+import functools
+import logging
+import multiprocessing as mp
+import queue
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+import writeFits
+
+
+def _attach(desc):
+    """ Map a shared memory frame described by (name, shape, dtype) in the writer """
+
+    name, shape, dtype = desc
+    # the writer shares the actor's resource tracker, which keeps track of
+    # the block until the actor unlinks it
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _compressShared(desc, cards, extname, compressionType):
+    """ Compress a shared memory frame in a compression pool process, see writeFits.compressHDU """
+
+    shm, data = _attach(desc)
+    try:
+        return writeFits.compressHDU(data, cards, extname, compressionType)
+    finally:
+        del data
+        shm.close()
+
+
+def _submit(desc, cards, extname=None):
+    """ Submit a shared memory frame to the compression pool """
+
+    return writeFits.compressPool().submit(_compressShared, desc, cards, extname,
+                                           writeFits.compressionType())
+
+
+def _nbytes(desc):
+    _, shape, dtype = desc
+    return int(np.prod(shape)) * np.dtype(dtype).itemsize
+
+
+def _singleDone(out_q, filename, nbytes, spots, t0, future):
+    """ Write a compressed single frame file once its compression is done """
+
+    stats = None
+    error = None
+    try:
+        tables = [] if spots is None else [writeFits.spotsTable(spots)]
+        stats = writeFits.writeCompressed(filename, [(future, nbytes)], tables)
+    except Exception as e:
+        error = str(e)
+        nbytes = 0
+    out_q.put(('done', filename, nbytes, time.time() - t0, error, stats))
+
+
+def _writer(in_q, out_q):
+    """ Writer process main loop """
+
+    combined = {}
+    while True:
+        msg = in_q.get()
+        kind = msg[0]
+        if kind == 'stop':
+            writeFits.shutdownPool()
+            break
+
+        if kind == 'open':
+            _, filename, shapes = msg
+            entry = dict(writer=None, kept=[], nbytes=0, dt=0.0, error=None)
+            try:
+                entry['writer'] = writeFits.CombinedWriter(filename, shapes)
+            except Exception as e:
+                entry['error'] = str(e)
+            combined[filename] = entry
+            continue
+
+        if kind == 'part':
+            _, filename, agcid, desc, cards, spots = msg
+            entry = combined.get(filename)
+            if entry is None:
+                # the part is dropped and the error reported when the file is closed
+                entry = dict(writer=None, kept=[], nbytes=0, dt=0.0, error=f'{filename} was not opened')
+                combined[filename] = entry
+            nbytes = _nbytes(desc)
+            if writeFits.compression is not None and entry['writer'] is not None and nbytes > 0:
+                # the shared memory is released once the pool has compressed it
+                try:
+                    future = _submit(desc, cards, 'cam%d' % (agcid + 1))
+                    future.add_done_callback(lambda f, name=desc[0], filename=filename:
+                                             out_q.put(('part', filename, name)))
+                    entry['writer'].addCompressed(agcid, future, nbytes, spots)
+                    entry['nbytes'] += nbytes
+                except Exception as e:
+                    entry['error'] = str(e)
+                continue
+
+            shm, data = _attach(desc)
+            t0 = time.time()
+            released = True
+            if entry['writer'] is not None:
+                try:
+                    released = entry['writer'].add(agcid, data, cards, spots)
+                    entry['nbytes'] += data.nbytes
+                except Exception as e:
+                    entry['error'] = str(e)
+            entry['dt'] += time.time() - t0
+            if released:
+                del data
+                shm.close()
+                out_q.put(('part', filename, desc[0]))
+            else:
+                entry['kept'].append((shm, data))
+            continue
+
+        t0 = time.time()
+        error = None
+        stats = None
+        nbytes = 0
+        if kind == 'single' and writeFits.compression is not None:
+            _, filename, desc, cards, spots = msg
+            try:
+                future = _submit(desc, cards)
+                future.add_done_callback(functools.partial(_singleDone, out_q, filename,
+                                                           _nbytes(desc), spots, t0))
+                continue
+            except Exception as e:
+                error = str(e)
+        elif kind == 'single':
+            _, filename, desc, cards, spots = msg
+            shm, data = _attach(desc)
+            try:
+                stats = writeFits.writeSingle(filename, data, cards, spots)
+                nbytes = data.nbytes
+            except Exception as e:
+                error = str(e)
+            del data
+            shm.close()
+        elif kind == 'combined':
+            _, filename = msg
+            entry = combined.pop(filename, None)
+            if entry is None:
+                out_q.put(('done', filename, 0, 0.0, f'{filename} was not opened', None))
+                continue
+            error = entry['error']
+            if entry['writer'] is not None and error is None:
+                try:
+                    if entry['writer'].close():
+                        nbytes = entry['nbytes']
+                        stats = entry['writer'].compressionStats
+                except Exception as e:
+                    error = str(e)
+            t0 -= entry['dt']
+            for shm, data in entry['kept']:
+                del data
+                shm.close()
+            del entry
+        out_q.put(('done', filename, nbytes, time.time() - t0, error, stats))
+
+
+class FitsWriter(object):
+    """ Bounded queue in front of a FITS writer process """
+
+    def __init__(self, maxQueue=12):
+        """ Start the writer process
+
+        Args:
+           maxQueue - maximum number of frames waiting to be written
+        """
+
+        self.logger = logging.getLogger('agcc')
+        # start the resource tracker first so the writer inherits it and
+        # does not track (and later unlink) the actor's shared memory itself
+        resource_tracker.ensure_running()
+        self.in_q = mp.Queue(maxsize=maxQueue)
+        self.out_q = mp.Queue()
+        # a daemonic writer cannot start the compression pool
+        self.proc = mp.Process(target=_writer, args=(self.in_q, self.out_q),
+                               daemon=writeFits.compression is None)
+        self.proc.start()
+        atexit.register(self.close)
+
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.nWritten = 0
+        self.nFailed = 0
+        self.nBytes = 0
+        self.writeTime = 0.0
+        self.lastLatency = 0.0
+        self.lastRatio = 0.0
+        # seconds between liveness checks of the writer while the queue is full
+        self.putTimeout = 1.0
+
+        self.listener = threading.Thread(target=self._listen, name='fitsWriter', daemon=True)
+        self.listener.start()
+
+    def isAlive(self):
+        return self.proc.is_alive()
+
+    def _pending(self, filename):
+        """ Return the bookkeeping entry of a file, with the lock held """
+
+        if filename not in self.pending:
+            self.pending[filename] = dict(t=time.time(), shms={}, parts=0)
+        return self.pending[filename]
+
+    def _share(self, filename, data):
+        """ Copy a frame into a new shared memory block owned by filename """
+
+        shm = shared_memory.SharedMemory(create=True, size=max(data.nbytes, 1))
+        buf = np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf)
+        buf[...] = data
+        del buf
+        with self.lock:
+            entry = self._pending(filename)
+            entry['shms'][shm.name] = shm
+            entry['parts'] += 1
+        return (shm.name, data.shape, data.dtype.str)
+
+    def _release(self, shms):
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+
+    def _put(self, msg):
+        """ Queue a message to the writer, return False if the writer died """
+
+        try:
+            self.in_q.put_nowait(msg)
+            return True
+        except queue.Full:
+            self.logger.warning('FITS writer queue full, waiting for the writer.')
+        while self.isAlive():
+            try:
+                self.in_q.put(msg, timeout=self.putTimeout)
+                return True
+            except queue.Full:
+                pass
+        self.logger.error('FITS writer process died, writing in the exposure threads.')
+        return False
+
+    def _unshare(self, filename, desc):
+        """ Release the shared memory of a frame which did not reach the writer """
+
+        with self.lock:
+            entry = self.pending.get(filename)
+            shm = entry['shms'].pop(desc[0], None) if entry is not None else None
+            if shm is not None:
+                entry['parts'] -= 1
+        if shm is not None:
+            self._release([shm])
+
+    def _writeLocally(self, filename):
+        """ Return the CombinedWriter assembling a file in the calling
+        threads, started when the writer process is gone """
+
+        with self.lock:
+            entry = self._pending(filename)
+            local = entry.get('local')
+            shapes = entry.get('shapes', {})
+        if local is None:
+            local = writeFits.CombinedWriter(filename, shapes)
+            with self.lock:
+                local = entry.setdefault('local', local)
+        return local
+
+    def _listen(self):
+        while True:
+            try:
+                msg = self.out_q.get()
+            except (EOFError, OSError):
+                return
+
+            if msg[0] == 'part':
+                _, filename, name = msg
+                with self.lock:
+                    # the file may already be done and its memory released
+                    entry = self.pending.get(filename)
+                    shm = entry['shms'].pop(name, None) if entry is not None else None
+                if shm is not None:
+                    self._release([shm])
+                continue
+
+            _, filename, nbytes, dt, error, stats = msg
+            with self.lock:
+                entry = self.pending.pop(filename, None) or dict(t=time.time(), shms={})
+                latency = time.time() - entry['t']
+                if error is not None:
+                    self.nFailed += 1
+                elif nbytes > 0:
+                    self.nWritten += 1
+                    self.nBytes += nbytes
+                    self.writeTime += dt
+                self.lastLatency = latency
+                if stats is not None:
+                    self.lastRatio = stats[0]
+            self._release(entry['shms'].values())
+            if nbytes == 0 and error is None:
+                continue
+            if error is None and stats is not None:
+                self.logger.info(f'Wrote {filename} in {dt:.3f}s, latency {latency:.3f}s, '
+                                 f'{writeFits.compression} ratio {stats[0]:.2f} in {stats[1]:.3f}s.')
+            elif error is None:
+                self.logger.info(f'Wrote {filename} in {dt:.3f}s, latency {latency:.3f}s.')
+            else:
+                self.logger.error(f'Failed to write {filename}: {error}')
+
+    def wfits(self, cmd, visitId, cam, nframe):
+        """ Queue a single camera frame, see writeFits.wfits """
+
+        if not self.isAlive():
+            return writeFits.wfits(cmd, visitId, cam, nframe)
+
+        if(cam.data.size == 0):
+            cmd.warn('text="No image available for AGC[%d]"' % (cam.agcid + 1))
+            return
+
+        pfsFilename = writeFits.fitsFilename(visitId, nframe, cam.agcid)
+        cards = writeFits.frameCards(cam, visitId, nframe)
+        desc = self._share(pfsFilename, cam.data)
+        if not self._put(('single', pfsFilename, desc, cards, cam.spots)):
+            self._unshare(pfsFilename, desc)
+            with self.lock:
+                self.pending.pop(pfsFilename, None)
+            return writeFits.wfits(cmd, visitId, cam, nframe)
+
+        cam.filename = pfsFilename
+        if cmd:
+            cmd.inform('agc%d_fitsfile="%s",%.1f' % (cam.agcid + 1, pfsFilename, cam.tstart))
+
+    def openCombined(self, visitId, shapes, nframe):
+        """ Start a combined file when the exposure starts
+
+        Args:
+           visitId - pfs_visit_id
+           shapes  - dict of agcid: (ny, nx) of the expected frames
+           nframe  - agc_exposure_id
+
+        Returns the filename, for addCombined and wfits_combined: the date in
+        the path may change before the exposure is done.
+        """
+
+        pfsFilename = writeFits.fitsFilename(visitId, nframe)
+        with self.lock:
+            self._pending(pfsFilename)['shapes'] = shapes
+        if not self.isAlive() or not self._put(('open', pfsFilename, shapes)):
+            self._writeLocally(pfsFilename)
+        return pfsFilename
+
+    def addCombined(self, pfsFilename, visitId, cam, nframe, seq_id=-1):
+        """ Queue one camera's part of a combined file as soon as it is available """
+
+        cards = writeFits.frameCards(cam, visitId, nframe, seq_id)
+        with self.lock:
+            local = self._pending(pfsFilename).get('local')
+        if local is None and self.isAlive():
+            desc = self._share(pfsFilename, cam.data)
+            if self._put(('part', pfsFilename, cam.agcid, desc, cards, cam.spots)):
+                return
+            self._unshare(pfsFilename, desc)
+        # the parts already queued to the writer are lost with it
+        self._writeLocally(pfsFilename).add(cam.agcid, cam.data, cards, cam.spots)
+
+    def wfits_combined(self, cmd, pfsFilename, visitId, cams, nframe, seq_id=-1):
+        """ Close a combined file once all parts are queued, see writeFits.wfits_combined """
+
+        with self.lock:
+            entry = self._pending(pfsFilename)
+            nparts = entry['parts']
+            local = entry.get('local')
+        if local is None and self._put(('combined', pfsFilename)):
+            if nparts > 0 and cmd:
+                if seq_id >= 0:
+                    cmd.inform('agc_seq%d="%s"' % (seq_id + 1, writeFits.seqFilename(cams, seq_id)))
+                else:
+                    cmd.inform('agc_fitsfile="%s",%.1f' % (pfsFilename, cams[0].tstart))
+            return
+
+        # the writer process died
+        with self.lock:
+            entry = self.pending.pop(pfsFilename, entry)
+        self._release(entry['shms'].values())
+        if local is not None:
+            writeFits.wfits_combined(cmd, visitId, cams, nframe, seq_id, combinedWriter=local)
+        elif nparts > 0:
+            with self.lock:
+                self.nFailed += 1
+            self.logger.error(f'Failed to write {pfsFilename}: the FITS writer process died')
+
+    def statusStr(self):
+        """ Return queued,written,failed,last latency(s),write throughput(MB/s),
+        last compression ratio (0 if uncompressed) """
+
+        with self.lock:
+            rate = self.nBytes / self.writeTime / 1e6 if self.writeTime > 0 else 0.0
+            return '%d,%d,%d,%.3f,%.1f,%.2f' % (len(self.pending), self.nWritten, self.nFailed,
+                                                self.lastLatency, rate, self.lastRatio)
+
+    def close(self):
+        """ Stop the writer after the queued frames are written """
+
+        if self.isAlive():
+            self.in_q.put(('stop',))
+            self.proc.join()
+
+        # let the listener release the shared memory of the last files
+        tlimit = time.time() + 5.0
+        while time.time() < tlimit:
+            with self.lock:
+                if len(self.pending) == 0:
+                    break
+            time.sleep(0.05)
@@ -6,6 +6,9 @@ import time
 import os
 import threading
 
+from . import starfield
+from . import imagestore
+
 class FliError(Exception):
     """Exception for FLI camera"""
     pass
@@ -18,11 +21,35 @@ def getLibVersion():
     """Get the current library version"""
     return "Software Development Library for Linux 1.999.1"
 
+class StartBarrier:
+    """Start barrier of the exposures of several cameras"""
+
+    def __init__(self, parties, timeout=10.0):
+        self.barrier = threading.Barrier(parties, timeout=timeout)
+
+    def wait(self):
+        """Wait for the other cameras, return False if the barrier was broken"""
+        try:
+            self.barrier.wait()
+        except threading.BrokenBarrierError:
+            return False
+        return True
+
+    def abort(self):
+        """Release the waiting cameras, a camera will not start"""
+        self.barrier.abort()
+
 class Camera:
     """FLI usb camera"""
 
-    def __init__(self, id, devsn, imgPath=None):
-        """(id) : index of the camera device"""
+    def __init__(self, id, devsn, imgPath=None, starField=None):
+        """(id) : index of the camera device
+
+        imgPath: simulated FITS file, single or 6 image extensions, or a
+        directory of such files replayed in order
+        starField: StarField options (a dict, possibly empty) to render
+        synthetic star fields instead of imgPath or zeros
+        """
         if id < 0 or id >= numCams:
             raise FliError("Camera[%d] not available" % id)
         self.id = id
@@ -30,25 +57,33 @@ class Camera:
         self.exposureID = 0
         self.agcid = -1
         self.abort = 0
+        # wakes up the exposure handler on an abort
+        self.abortEvent = threading.Event()
+        self.tabort = 0
+        # seconds from the last abort to the camera ready
+        self.abortLatency = None
         self.temp = None
+        # ReadoutScheduler holding the readout for a slot of the USB bus
+        self.readoutGate = None
+        self.bus = USB_BUS
         self.devname = "MicroLine ML4720"
         self.devsn = devsn
         self.hwRevision = 256
         self.fwRevision = 512
         self.mode = 0
 
-        # read simulated image, contains single or 6 image extensions
+        # simulated images, memory mapped once for all the cameras
         if imgPath is not None:
-            hdulist = pyfits.open(imgPath)
-            if len(hdulist) > 1:
-                if hdulist[id+1].data is None:
-                    self.rawdata = np.zeros((1033, 1072), dtype=np.uint16)
-                else:
-                    self.rawdata = hdulist[id+1].data.astype(np.uint16)
-            else:
-                self.rawdata = hdulist[0].data.astype(np.uint16)
+            self.store = imagestore.getStore(imgPath)
+        else:
+            self.store = None
+        self.frameIndex = 0
+        if starField is not None:
+            options = dict(starField)
+            options.setdefault('seed', id)
+            self.starField = starfield.StarField(**options)
         else:
-            self.rawdata = np.zeros((1033, 1072), dtype=np.uint16)
+            self.starField = None
         self.lock = threading.Lock()
 
     def getStatusStr(self):
@@ -159,6 +194,22 @@ class Camera:
         """Get the pixel sizes in micron"""
         return (0.000013, 0.000013)
 
+    def getDeviceStatus(self):
+        """Get the device status"""
+        with self.lock:
+            status = self.status
+        if status == EXPOSING:
+            return FLI_CAMERA_STATUS_EXPOSING
+        return FLI_CAMERA_STATUS_IDLE
+
+    def getExposureStatus(self):
+        """Get the exposure status"""
+        with self.lock:
+            if self.status != EXPOSING:
+                return 0
+            tleft = self.exptime - (time.time() - self.tstart) * 1000.0
+        return max(int(tleft), 0)
+
     def wfits(self, filename=None):
         """Write the image to a FITS file"""
         with self.lock:
@@ -205,24 +256,48 @@ class Camera:
                (self.agcid + 1, expType, exposureID, timestamp))
 
     def cancelExposure(self):
-        """Cancel current exposure"""
+        """Cancel current exposure, the exposure handler wakes up at once"""
         with self.lock:
-            status = self.status
-        if status == EXPOSING:
-            with self.lock:
-                self.abort = 1
+            if self.status != EXPOSING or self.abort != 0:
+                return
+            self.abort = 1
+            self.tabort = time.monotonic()
+            gate = self.readoutGate
+        self.abortEvent.set()
+        if gate is not None:
+            # stop a wait for a readout slot
+            gate.cancel(self.agcid)
 
     def expose(self, dark=False, blocking=True):
         """Do exposure and return the image"""
+        self.prepareExposure(dark)
+        self.startExposure(blocking)
+
+    def prepareExposure(self, dark=False):
+        """Set up the next exposure, started by startExposure"""
         with self.lock:
             status = self.status
         if status != READY:
             raise FliError("Camera not ready, abort expose command")
         with self.lock:
             self.dark = dark
+
+    def startExposure(self, blocking=True, barrier=None):
+        """Start the exposure set up by prepareExposure
+
+        barrier: StartBarrier, to start together with the other cameras
+        """
+        with self.lock:
+            if self.status != READY:
+                raise FliError("Camera not ready, abort expose command")
+            self.status = EXPOSING
+            self.abort = 0
+            self.abortEvent.clear()
+        if barrier is not None:
+            barrier.wait()
+        with self.lock:
             self.tstart = time.time()
             self.timestamp = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.tstart))
-            self.status = EXPOSING
 
         thr = threading.Thread(target=self.exposeHandler)
         thr.start()
@@ -233,27 +308,76 @@ class Camera:
         # Check if the exposure is done and write the image
         tstart = time.time();
         with self.lock:
-            # add 350ms readout time
-            exptime = (self.exptime + 350.0) / 1000.0
-        while (time.time() - tstart < exptime):
-            time.sleep(POLL_TIME)
-            with self.lock:
-                abort = self.abort
-            if abort != 0:
-                break
+            # readout time of the frame, binning and readout mode
+            exptime = self.exptime / 1000.0
+            readout = starfield.readoutTime(self.expArea, self.hbin, self.vbin, self.mode)
+            expArea, hbin, vbin, dark = self.expArea, self.hbin, self.vbin, self.dark
+            gate = self.readoutGate
+        # rendered, or copied from the store, while the simulated exposure runs
+        if self.starField is not None:
+            image = self.starField.render(exptime, dark, expArea, hbin, vbin)
+        elif self.store is not None:
+            image = self.store.read(self.frameIndex, self.id, expArea)
+            self.frameIndex += 1
+        else:
+            image = np.zeros((expArea[3] - expArea[1], expArea[2] - expArea[0]), dtype=np.uint16)
+        tleft = exptime - (time.time() - tstart)
+        if tleft > 0:
+            self.abortEvent.wait(tleft)
+
+        with self.lock:
+            abort = self.abort
+        if abort == 0 and gate is not None:
+            # wait for a readout slot of the USB bus
+            gate.acquire(self.agcid)
+        complete = False
+        if not self.abortEvent.is_set():
+            complete = self.transfer(readout, image.nbytes)
+        if gate is not None:
+            # a readout stopped by an abort says nothing of the bus
+            gate.release(self.agcid, learn=complete)
 
         with self.lock:
             if self.abort != 0:
-                # Exposure aborted
+                # Exposure aborted, the partial image is dropped
                 self.abort = 0
                 self.tend = 0
+                self.data = np.zeros((0, 0), dtype=np.uint16)
+                self.abortLatency = time.monotonic() - self.tabort
             else:
                 xsize = self.xsize
                 ysize = self.ysize
-                self.data = self.rawdata[self.expArea[1]:self.expArea[3], self.expArea[0]:self.expArea[2]]
+                self.data = image
                 self.tend = time.time()
             self.status = READY
 
+    def transfer(self, readout, nbytes):
+        """Simulate the readout, sharing the bandwidth of the USB bus with
+        the other cameras reading out, return False if aborted"""
+        rate = nbytes / readout
+        with busLock:
+            busReadouts[self.bus] = busReadouts.get(self.bus, 0) + 1
+        try:
+            done = 0.0
+            last = time.time()
+            while done < nbytes:
+                if self.abortEvent.wait(READ_POLL_TIME):
+                    # stopped mid-frame
+                    return False
+                now = time.time()
+                with busLock:
+                    share = USB_BANDWIDTH / busReadouts[self.bus]
+                done += (now - last) * min(rate, share)
+                last = now
+            return True
+        finally:
+            with busLock:
+                busReadouts[self.bus] -= 1
+
+    def getDeviceName(self):
+        """Return the library device name, with the USB bus for libusb"""
+        return "FLI-%sP02A%02d" % (self.bus, self.id + 3)
+
     def expose_test(self):
         """Return the test image"""
         with self.lock:
@@ -302,8 +426,15 @@ class Camera:
 CLOSED, READY, EXPOSING, SETMODE = range(4)
 Status = {CLOSED:"CLOSED", READY:"READY", EXPOSING:"EXPOSING", SETMODE:"SETMODE"}
 POLL_TIME = 0.02
+READ_POLL_TIME = 0.005
 CCD_TEMP = -30
+# the simulated cameras share one USB bus (a hub), of this bandwidth in bytes/s
+USB_BUS = "B01"
+USB_BANDWIDTH = 16e6
+busLock = threading.Lock()
+busReadouts = {}
 FLI_INVALID_DEVICE, FLIDEVICE_CAMERA = 0, 1
+FLI_CAMERA_STATUS_IDLE, FLI_CAMERA_STATUS_EXPOSING = 0x00, 0x02
 
 numCams = 6
 dev = np.zeros(numCams, int)
@@ -1,5 +1,7 @@
 """FLI USB camera library"""
 
+from posix.time cimport timespec
+
 cdef extern from "libfli.h" nogil:
 
     ctypedef long flidev_t
@@ -84,6 +86,22 @@ cdef extern from "libfli.h" nogil:
     LIBFLIAPI FLIEndExposure(flidev_t dev)
     LIBFLIAPI FLISetTDI(flidev_t dev, flitdirate_t tdi_rate, flitdiflags_t flags)
 
+cdef extern from "pthread.h" nogil:
+
+    ctypedef struct pthread_mutex_t:
+        pass
+    ctypedef struct pthread_cond_t:
+        pass
+
+    int pthread_mutex_init(pthread_mutex_t *mutex, void *attr)
+    int pthread_mutex_destroy(pthread_mutex_t *mutex)
+    int pthread_mutex_lock(pthread_mutex_t *mutex)
+    int pthread_mutex_unlock(pthread_mutex_t *mutex)
+    int pthread_cond_init(pthread_cond_t *cond, void *attr)
+    int pthread_cond_destroy(pthread_cond_t *cond)
+    int pthread_cond_broadcast(pthread_cond_t *cond)
+    int pthread_cond_timedwait(pthread_cond_t *cond, pthread_mutex_t *mutex, const timespec *abstime)
+
 cdef enum:
     MAX_DEVICES = 32
     MAX_PATH = 256
@@ -98,4 +116,6 @@ cdef:
     long listDomain[MAX_DEVICES]
     char libver[LIBVERSIZE]
     unsigned short *buffer[MAX_DEVICES]
+    # set by cancelExposure, read by the readout loop without the GIL
+    int abortFlag[MAX_DEVICES]
 
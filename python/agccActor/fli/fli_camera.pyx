@@ -4,6 +4,7 @@ from libc.stdlib cimport malloc, free
 from libc.string cimport strcpy, strlen
 from cython.view cimport array
 from libc.stdio cimport printf
+from posix.time cimport timespec, clock_gettime, CLOCK_REALTIME
 import numpy as np
 import astropy.io.fits as pyfits
 import time
@@ -62,6 +63,71 @@ class CameraInit:
 
 
 
+cdef class StartBarrier:
+    """Start barrier of the exposures of several cameras
+
+    The cameras wait at the barrier and call FLIExposeFrame in the same
+    nogil section, so that the last camera set up releases the others
+    without any of them taking the GIL first.
+    """
+    cdef pthread_mutex_t mutex
+    cdef pthread_cond_t cond
+    cdef int parties, count, broken
+    cdef double timeout
+
+    def __cinit__(self, int parties, double timeout=10.0):
+        pthread_mutex_init(&self.mutex, NULL)
+        pthread_cond_init(&self.cond, NULL)
+        self.parties = parties
+        self.count = 0
+        self.broken = 0
+        self.timeout = timeout
+
+    def __dealloc__(self):
+        pthread_cond_destroy(&self.cond)
+        pthread_mutex_destroy(&self.mutex)
+
+    cdef int nogilWait(self) noexcept nogil:
+        # 0 when all the cameras arrived, -1 if broken or timed out
+        cdef timespec deadline
+        cdef int res = 0
+        clock_gettime(CLOCK_REALTIME, &deadline)
+        deadline.tv_sec += <long> self.timeout
+        deadline.tv_nsec += <long> ((self.timeout - <long> self.timeout) * 1e9)
+        if deadline.tv_nsec >= 1000000000:
+            deadline.tv_sec += 1
+            deadline.tv_nsec -= 1000000000
+        pthread_mutex_lock(&self.mutex)
+        self.count += 1
+        if self.count >= self.parties:
+            pthread_cond_broadcast(&self.cond)
+        while self.count < self.parties and self.broken == 0 and res == 0:
+            res = pthread_cond_timedwait(&self.cond, &self.mutex, &deadline)
+        if self.count < self.parties:
+            # timed out, the others start too
+            self.broken = 1
+            pthread_cond_broadcast(&self.cond)
+            res = -1
+        else:
+            res = 0
+        pthread_mutex_unlock(&self.mutex)
+        return res
+
+    def wait(self):
+        """Wait for the other cameras, return False if the barrier was broken"""
+        cdef int res
+        with nogil:
+            res = self.nogilWait()
+        return res == 0
+
+    def abort(self):
+        """Release the waiting cameras, a camera will not start"""
+        with nogil:
+            pthread_mutex_lock(&self.mutex)
+            self.broken = 1
+            pthread_cond_broadcast(&self.cond)
+            pthread_mutex_unlock(&self.mutex)
+
 class Camera:
     """FLI usb camera"""
 
@@ -74,12 +140,23 @@ class Camera:
         self.exposureID = 0
         self.agcid = -1
         self.abort = 0
+        # wakes up the exposure handler on an abort
+        self.abortEvent = threading.Event()
+        self.tabort = 0
+        # seconds from the last abort to the camera ready
+        self.abortLatency = None
         self.temp = None
+        # ReadoutScheduler holding the readout for a slot of the USB bus
+        self.readoutGate = None
         self.lock = threading.Lock()
 
     def debugInfo(self):
         return dev[self.id], listDomain[self.id], listName[self.id]
 
+    def getDeviceName(self):
+        """Return the library device name, with the USB bus for libusb"""
+        return listName[self.id].decode('utf-8')
+
     def getStatusStr(self):
         with self.lock:
             status = self.status
@@ -400,22 +477,36 @@ class Camera:
                (self.agcid + 1, expType, exposureID, timestamp))
 
     def cancelExposure(self):
-        """Cancel current exposure"""
-        cdef long res
+        """Cancel current exposure
+
+        Returns at once: the exposure handler wakes up, stops the readout at
+        the next row and cancels the exposure in the camera.
+        """
         cdef int id = self.id
 
         with self.lock:
-            status = self.status
-        if status == EXPOSING:
-            with self.lock:
-                self.abort = 1
-            with nogil:
-                res = FLIEndExposure(dev[id])
-            if res != 0:
-                raise FliError("FLIEndExposure failed")
+            if self.status != EXPOSING or self.abort != 0:
+                return
+            self.abort = 1
+            self.tabort = time.monotonic()
+            abortFlag[id] = 1
+            gate = self.readoutGate
+        self.abortEvent.set()
+        if gate is not None:
+            # stop a wait for a readout slot
+            gate.cancel(self.agcid)
 
     def expose(self, dark=False, blocking=True):
         """Do exposure and return the image"""
+        self.prepareExposure(dark)
+        self.startExposure(blocking)
+
+    def prepareExposure(self, dark=False):
+        """Set up the next exposure, started by startExposure
+
+        Only FLIExposeFrame is left to startExposure, so that cameras set up
+        beforehand start their exposures together.
+        """
         cdef long ftype, res
         cdef int id = self.id
 
@@ -433,14 +524,31 @@ class Camera:
             res = FLISetFrameType(dev[id], ftype)
         if res != 0:
             raise FliError("FLISetFrameType failed")
-        with self.lock:
-            self.tstart = time.time()
-            self.timestamp = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.tstart))
+
+    def startExposure(self, blocking=True, StartBarrier barrier=None):
+        """Start the exposure set up by prepareExposure
+
+        barrier: StartBarrier, to start together with the other cameras
+        """
+        cdef long res
+        cdef int id = self.id
+        cdef timespec ts
 
         with self.lock:
+            if self.status != READY:
+                raise FliError("Camera not ready, abort expose command")
             self.status = EXPOSING
+            self.abort = 0
+            abortFlag[id] = 0
+            self.abortEvent.clear()
         with nogil:
+            if barrier is not None:
+                barrier.nogilWait()
+            clock_gettime(CLOCK_REALTIME, &ts)
             res = FLIExposeFrame(dev[id])
+        with self.lock:
+            self.tstart = ts.tv_sec + ts.tv_nsec * 1e-9
+            self.timestamp = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.tstart))
         if res != 0:
             raise FliError("FLIExposeFrame failed")
 
@@ -450,7 +558,7 @@ class Camera:
             thr.join()
 
     def exposeHandler(self):
-        # Check if the exposure is done and write the image
+        # Wait for the exposure and read out the image, until an abort
         cdef int i, id = self.id
         cdef long res
         cdef size_t xsize, ysize
@@ -459,31 +567,55 @@ class Camera:
         with self.lock:
             xsize = self.xsize
             ysize = self.ysize
-        while not self.isDataReady():
-            time.sleep(POLL_TIME)
+            tleft = self.tstart + self.exptime / 1000.0 - time.time()
+        # no need to ask the camera before the end of the exposure
+        if tleft > 0:
+            self.abortEvent.wait(tleft)
+        while not self.abortEvent.is_set() and not self.isDataReady():
+            self.abortEvent.wait(POLL_TIME)
+
+        with self.lock:
+            abort = self.abort
+            gate = self.readoutGate
+        if abort == 0 and gate is not None:
+            # wait for a readout slot of the USB bus
+            gate.acquire(self.agcid)
 
+        # Read data, an abort stops at the next row
+        res = 0
+        with nogil:
+            for i in range(ysize):
+                if abortFlag[id] != 0:
+                    break
+                res = FLIGrabRow(dev[id], &buffer[id][i*xsize], xsize)
+                if res != 0:
+                    break
         with self.lock:
             abort = self.abort
+        if gate is not None:
+            # a readout stopped by an abort says nothing of the bus
+            gate.release(self.agcid, learn=(abort == 0 and res == 0))
         if abort != 0:
-            # Exposure aborted
+            # Exposure aborted: stop the exposure or the rest of the readout
+            # in the camera, which is ready for the next exposure. FLIEndExposure
+            # would start a readout instead, and fails on USB MaxCam cameras.
+            with nogil:
+                FLICancelExposure(dev[id])
             with self.lock:
                 self.abort = 0
                 self.tend = 0
-        else:
-            # Read data
-            res = 0
-            with nogil:
-                for i in range(ysize):
-                    res = FLIGrabRow(dev[id], &buffer[id][i*xsize], xsize)
-                    if res != 0:
-                        break
-            if res != 0:
-                raise FliError("FLIGrabRow failed")
-            mv = <unsigned short[:ysize, :xsize]> buffer[self.id]
-            with self.lock:
-                self.data = np.asarray(mv)
-                self.tend = time.time()
-#            self.wfits()
+                # the readout buffer holds part of the aborted frame
+                self.data = np.zeros((0, 0), dtype=np.uint16)
+                self.status = READY
+                self.abortLatency = time.monotonic() - self.tabort
+            return
+        if res != 0:
+            raise FliError("FLIGrabRow failed")
+        mv = <unsigned short[:ysize, :xsize]> buffer[self.id]
+        with self.lock:
+            self.data = np.asarray(mv)
+            self.tend = time.time()
+#        self.wfits()
 
         with self.lock:
             self.status = READY
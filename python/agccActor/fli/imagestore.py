@@ -0,0 +1,117 @@
+"""Read-only simulated image source shared by the fake cameras.
+
+An ImageStore maps a FITS file, or a directory of FITS files replayed as
+a sequence of frames, into memory once per process. The files are only
+listed when the store is created; each file is opened on first use and
+its image extensions are memory mapped without scaling, so the pages are
+shared by all the cameras and all the frames. Only the most recently used
+files are kept open. Every read returns a new uint16 array of the
+requested area, so the consumers (centroiding subtracts the overscan in
+place) never write into the store.
+
+Compressed (.fits.gz) files cannot be memory mapped, so directories are
+listed without them.
+"""
+
+import collections
+import glob
+import logging
+import os
+import threading
+
+import astropy.io.fits as pyfits
+import numpy as np
+
+sensorShape = (1033, 1072)
+
+_stores = {}
+_storesLock = threading.Lock()
+
+
+def getStore(path):
+    """ Return the shared ImageStore of a file or directory """
+
+    path = os.path.realpath(os.path.expandvars(os.path.expanduser(path)))
+    with _storesLock:
+        store = _stores.get(path)
+        if store is None:
+            store = _stores[path] = ImageStore(path)
+        return store
+
+
+class ImageStore(object):
+    """ Memory-mapped FITS frames """
+
+    def __init__(self, path, maxOpen=16):
+        """
+        Args:
+           path    - FITS file, or directory of FITS files in frame order
+           maxOpen - number of files kept open, the least recently used is closed
+        """
+
+        if os.path.isdir(path):
+            self.files = sorted(glob.glob(os.path.join(path, '*.fits')) +
+                                glob.glob(os.path.join(path, '*.fit')))
+        elif os.path.isfile(path):
+            self.files = [path]
+            if path.endswith('.gz'):
+                logging.getLogger('agcc').warning(f'{path} is compressed and cannot be memory mapped, '
+                                                  f'it is read into memory.')
+        else:
+            self.files = []
+        if len(self.files) == 0:
+            raise ValueError(f'no FITS files in {path}')
+        self.path = path
+        self.maxOpen = maxOpen
+        self.lock = threading.Lock()
+        self.hdulists = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.files)
+
+    def _image(self, index, camId):
+        """ Return the raw (memory-mapped) image of a camera in a frame, and its BZERO """
+
+        filename = self.files[index % len(self.files)]
+        with self.lock:
+            hdulist = self.hdulists.get(filename)
+            if hdulist is None:
+                hdulist = self.hdulists[filename] = pyfits.open(filename, memmap=True,
+                                                                do_not_scale_image_data=True)
+                if len(self.hdulists) > self.maxOpen:
+                    # arrays already returned keep their map, closing only releases the file
+                    _, evicted = self.hdulists.popitem(last=False)
+                    evicted.close()
+            else:
+                self.hdulists.move_to_end(filename)
+            # a single image for all the cameras, or one extension per camera
+            hdu = hdulist[camId + 1] if len(hdulist) > 1 else hdulist[0]
+            return hdu.data, hdu.header.get('BZERO', 0), hdu.header.get('BSCALE', 1)
+
+    def read(self, index, camId, expArea=None):
+        """ Return a uint16 copy of an image area
+
+        Args:
+           index   - frame number, wrapped around the number of frames
+           camId   - camera index, selecting the extension of multi-extension files
+           expArea - (x1, y1, x2, y2) area, the whole image if None
+        """
+
+        data, bzero, bscale = self._image(index, camId)
+        if data is None:
+            data = np.zeros(sensorShape, dtype=np.uint16)
+        if expArea is not None:
+            x1, y1, x2, y2 = expArea
+            data = data[y1:y2, x1:x2]
+        if data.dtype.kind == 'i' and data.dtype.itemsize == 2 and bzero == 32768 and bscale == 1:
+            # unsigned 16 bit FITS: flipping the sign bit is the BZERO offset
+            image = data.view(data.dtype.str.replace('i', 'u')).astype(np.uint16)
+            image ^= 0x8000
+            return image
+        return (data * bscale + bzero).astype(np.uint16)
+
+    def close(self):
+        with self.lock:
+            for hdulist in self.hdulists.values():
+                hdulist.close()
+            self.hdulists.clear()
@@ -0,0 +1,167 @@
+"""Synthetic star fields and readout timing for the fake FLI camera.
+
+StarField renders AG frames of a fixed set of stars with a Gaussian PSF,
+or a ring for defocused stars, sky background, Poisson noise, read noise,
+per-amplifier bias, hot pixels and saturation. The stars drift by a fixed
+offset, plus a random jitter, between frames, like a guide field which is
+not being corrected.
+
+readoutTime models the ML4720 readout: every unbinned row is shifted,
+the rows in the frame are digitized at the pixel rate of the readout mode
+(4 MHz or 500 kHz) after binning, plus a fixed USB/driver overhead. The
+full frame at 4 MHz takes about 350 ms.
+"""
+
+import numpy as np
+
+# full sensor, with the overscan columns, and its light sensitive area
+sensorShape = (1033, 1072)
+visibleArea = (24, 9, 1048, 1033)
+
+# pixel rate of the readout modes, see Camera.getModeString
+pixelRates = {0: 4.0e6, 1: 5.0e5}
+readoutOverhead = 0.05
+rowOverhead = 20e-6
+rowShift = 5e-6
+
+
+def readoutTime(expArea, hbin=1, vbin=1, mode=0):
+    """ Return the modelled readout time in seconds
+
+    Args:
+       expArea - (x1, y1, x2, y2) image area in unbinned pixels
+       hbin    - horizontal binning
+       vbin    - vertical binning
+       mode    - readout mode, 0 for 4 MHz, 1 for 500 kHz
+    """
+
+    x1, y1, x2, y2 = expArea
+    rows = max(y2 - y1, 0) // vbin
+    cols = max(x2 - x1, 0) // hbin
+    return (readoutOverhead + sensorShape[0] * rowShift
+            + rows * (rowOverhead + cols / pixelRates[mode]))
+
+
+class StarField(object):
+    """ Star field renderer of one camera """
+
+    def __init__(self, seed=0, nstars=30, fwhm=4.0, sky=20.0, readNoise=10.0, bias=(1000.0, 1010.0),
+                 gain=1.0, magRange=(9.0, 16.0), zeroPoint=22.0, hotPixels=50, hotRate=500.0,
+                 saturation=65535, drift=(0.0, 0.0), jitter=0.0, donut=0.0):
+        """ Draw the stars and hot pixels of the field
+
+        Args:
+           seed       - random seed, the same seed gives the same field
+           nstars     - number of stars
+           fwhm       - PSF FWHM in pixels
+           sky        - sky background in e-/pixel/s
+           readNoise  - read noise in e-
+           bias       - bias level in ADU of the left and right amplifiers
+           gain       - e-/ADU
+           magRange   - range of the star magnitudes
+           zeroPoint  - magnitude giving 1 e-/s
+           hotPixels  - number of hot pixels
+           hotRate    - dark current of the hot pixels in e-/s
+           saturation - maximum ADU
+           drift      - (dx, dy) star motion per frame in pixels
+           jitter     - rms random star motion per frame in pixels
+           donut      - ring radius in pixels of defocused stars, 0 in focus
+        """
+
+        self.rng = np.random.default_rng(seed)
+        self.fwhm = fwhm
+        self.sky = sky
+        self.readNoise = readNoise
+        self.bias = bias
+        self.gain = gain
+        self.saturation = saturation
+        self.drift = np.array(drift, dtype=float)
+        self.jitter = jitter
+        self.donut = donut
+        self.frame = 0
+
+        x1, y1, x2, y2 = visibleArea
+        self.x = self.rng.uniform(x1 + 10, x2 - 10, nstars)
+        self.y = self.rng.uniform(y1 + 10, y2 - 10, nstars)
+        self.mag = self.rng.uniform(magRange[0], magRange[1], nstars)
+        self.rate = 10 ** (-0.4 * (self.mag - zeroPoint))
+        self.hot = (self.rng.integers(0, sensorShape[0], hotPixels),
+                    self.rng.integers(0, sensorShape[1], hotPixels))
+        self.hotRate = hotRate
+
+        sigma = fwhm / (2 * np.sqrt(2 * np.log(2)))
+        self.sigma = sigma
+        self.stampSize = int(np.ceil(4 * sigma + donut))
+
+    def positions(self):
+        """ Return the star positions of the current frame """
+
+        offset = self.drift * self.frame
+        x = self.x + offset[0]
+        y = self.y + offset[1]
+        if self.jitter > 0:
+            x = x + self.rng.normal(0, self.jitter)
+            y = y + self.rng.normal(0, self.jitter)
+        return x, y
+
+    def electrons(self, exptime, dark=False):
+        """ Return the expected full frame signal in e- """
+
+        image = np.zeros(sensorShape, dtype=np.float32)
+        x1, y1, x2, y2 = visibleArea
+        if not dark:
+            image[y1:y2, x1:x2] = self.sky * exptime
+            s = self.stampSize
+            xs, ys = self.positions()
+            for x, y, rate in zip(xs, ys, self.rate):
+                ix, iy = int(round(x)), int(round(y))
+                ra, rb = max(iy - s, y1), min(iy + s + 1, y2)
+                ca, cb = max(ix - s, x1), min(ix + s + 1, x2)
+                if ra >= rb or ca >= cb:
+                    continue
+                image[ra:rb, ca:cb] += (rate * exptime) * self.psf(x - ca, y - ra, rb - ra, cb - ca)
+        image[self.hot] += self.hotRate * exptime
+        return image
+
+    def psf(self, x, y, ny, nx):
+        """ Return a unit flux PSF stamp of shape (ny, nx) centred at (x, y) """
+
+        if self.donut <= 0:
+            gy = np.exp(-0.5 * ((np.arange(ny) - y) / self.sigma) ** 2)
+            gx = np.exp(-0.5 * ((np.arange(nx) - x) / self.sigma) ** 2)
+            return np.outer(gy, gx) / (2 * np.pi * self.sigma ** 2)
+
+        # defocused: a ring of the PSF width around the pupil image
+        yy, xx = np.mgrid[:ny, :nx]
+        r = np.hypot(xx - x, yy - y)
+        ring = np.exp(-0.5 * ((r - self.donut) / self.sigma) ** 2)
+        norm = 2 * np.pi * self.sigma * (self.donut * np.sqrt(2 * np.pi) + self.sigma)
+        return ring / norm
+
+    def render(self, exptime, dark=False, expArea=None, hbin=1, vbin=1):
+        """ Render the next frame in ADU and advance the drift
+
+        Args:
+           exptime - exposure time in seconds
+           dark    - no sky and no stars if True
+           expArea - (x1, y1, x2, y2) image area, the full sensor if None
+           hbin    - horizontal binning
+           vbin    - vertical binning
+        """
+
+        signal = self.electrons(exptime, dark)
+        self.frame += 1
+
+        x1, y1, x2, y2 = (0, 0, sensorShape[1], sensorShape[0]) if expArea is None else expArea
+        signal = signal[y1:y2, x1:x2]
+        # the charge is binned on the chip, before the read noise and bias
+        h = signal.shape[0] // vbin * vbin
+        w = signal.shape[1] // hbin * hbin
+        signal = signal[:h, :w].reshape(h // vbin, vbin, w // hbin, hbin).sum(axis=(1, 3))
+
+        image = self.rng.poisson(signal).astype(np.float32)
+        image += self.rng.normal(0, self.readNoise, signal.shape).astype(np.float32)
+        image /= self.gain
+        columns = x1 + np.arange(signal.shape[1]) * hbin
+        image += np.where(columns < sensorShape[1] // 2, self.bias[0], self.bias[1]).astype(np.float32)
+        return np.clip(image, 0, self.saturation).astype(np.uint16)
@@ -0,0 +1,50 @@
+"""Snapshot of one camera readout.
+
+The exposure processing (centroiding, OpDB and FITS writes) reads the
+image and its metadata from a Frame instead of the camera object, so the
+camera can take the next exposure while the previous frame is still
+being processed. The FLI driver reads out into a static per-camera
+buffer, so pipelined frames copy the image.
+"""
+
+import telemetry
+
+
+class Frame(object):
+    """ Image and exposure metadata of a camera, as read out """
+
+    # camera attributes used by writeFits and fitsWriter
+    attributes = ('agcid', 'devname', 'devsn', 'timestamp', 'tstart', 'exptime', 'vbin', 'hbin',
+                  'dark', 'expArea', 'regions', 'xsize', 'ysize', 'filename')
+
+    def __init__(self, cam, copy=False):
+        """ Take the snapshot right after the readout
+
+        Args:
+           cam  - camera which has read out
+           copy - copy the image out of the camera buffer
+        """
+
+        self.cam = cam
+        for name in self.attributes:
+            setattr(self, name, getattr(cam, name, None))
+        self.data = cam.data.copy() if copy else cam.data
+        self.temperature = telemetry.temperature(cam)
+        self.spots = None
+        # the exposure, set by Exposure
+        self.visitId = None
+        self.nframe = None
+        self.seq_id = -1
+        self.combined = False
+        # written to FITS, for frameRing
+        self.archived = False
+        # frames in a coadd.Stacker mean, and pixel values clipped
+        self.nstack = 1
+        self.nclipped = 0
+        # no poller: telemetry.temperature() asks getTemperature()
+        self.telemetry = None
+
+    def getTemperature(self):
+        """ Return the CCD temperature at the readout """
+
+        return self.temperature
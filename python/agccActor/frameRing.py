@@ -0,0 +1,195 @@
+"""In-memory rings of the last frames of each camera, with selective archiving.
+
+The frames of each camera are kept in a ring of the last N frames and
+their spots, to centroid them again with new parameters, and sequence
+frames are not all written to FITS. An Archiver decides per
+exposure which frames go to disk: every Nth exposure, exposures with a
+centroid anomaly (a centroiding failure, no spots, or a spot count far
+from the recent frames), and on request the whole ring, for the saveFrames
+command or as the context before an aborted exposure.
+"""
+
+import collections
+import threading
+
+import numpy as np
+
+import metrics
+import writeFits
+
+
+def writeFrames(cmd, frames, fitsWriter=None):
+    """ Write the frames of one exposure, after the exposure
+
+    Args:
+       cmd        - a Command object to report to. Ignored if None.
+       frames     - Frames of the same exposure
+       fitsWriter - FitsWriter process, or None to write in the calling thread
+    """
+
+    visitId, nframe, seq_id = frames[0].visitId, frames[0].nframe, frames[0].seq_id
+    if frames[0].combined:
+        if fitsWriter is not None:
+            shapes = {f.agcid: f.data.shape for f in frames}
+            filename = fitsWriter.openCombined(visitId, shapes, nframe)
+            for f in frames:
+                fitsWriter.addCombined(filename, visitId, f, nframe, seq_id)
+            fitsWriter.wfits_combined(cmd, filename, visitId, frames, nframe, seq_id)
+        else:
+            writeFits.wfits_combined(cmd, visitId, frames, nframe, seq_id)
+    else:
+        for f in frames:
+            if fitsWriter is not None:
+                fitsWriter.wfits(cmd, visitId, f, nframe)
+            else:
+                writeFits.wfits(cmd, visitId, f, nframe)
+
+
+class FrameRing(object):
+    """ The last frames of one camera """
+
+    def __init__(self, depth):
+        self.lock = threading.Lock()
+        self.frames = collections.deque(maxlen=depth)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def add(self, frame):
+        with self.lock:
+            self.frames.append(frame)
+
+    def snapshot(self):
+        """ Return the frames in the ring, oldest first """
+
+        with self.lock:
+            return list(self.frames)
+
+    def find(self, nframe=None):
+        """ Return the frame of an agc_exposure_id, the latest if None """
+
+        with self.lock:
+            for f in reversed(self.frames):
+                if nframe is None or f.nframe == nframe:
+                    return f
+        return None
+
+    def spotCounts(self):
+        """ Return the spot counts of the centroided frames in the ring """
+
+        with self.lock:
+            return [len(f.spots) for f in self.frames if f.spots is not None]
+
+
+class Archiver(object):
+    """ Archiving policy of a sequence """
+
+    # frames are marked archived under the lock, so that a saveFrames
+    # command and the sequence never write the same frame twice
+    archiveLock = threading.Lock()
+
+    def __init__(self, rings, fitsWriter=None, every=1, anomaly=True, anomalyFraction=0.5):
+        """ Keep the sequence frames in rings and write the selected ones
+
+        Args:
+           rings           - dict of agcid: FrameRing
+           fitsWriter      - FitsWriter process, or None to write in the calling thread
+           every           - archive every Nth exposure, 0 for none
+           anomaly         - archive exposures with a centroid anomaly
+           anomalyFraction - relative change of the spot count from the
+                             median of the ring which is an anomaly
+        """
+
+        self.rings = rings
+        self.fitsWriter = fitsWriter
+        self.every = every
+        self.anomaly = anomaly
+        self.anomalyFraction = anomalyFraction
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def isAnomalous(self, frame, centroid):
+        """ Return True if the spots of a frame look wrong """
+
+        if not centroid:
+            return False
+        if frame.spots is None or len(frame.spots) == 0:
+            return True
+        counts = self.rings[frame.agcid].spotCounts()
+        if len(counts) == 0:
+            return False
+        median = np.median(counts)
+        return abs(len(frame.spots) - median) > self.anomalyFraction * max(median, 1)
+
+    def add(self, cmd, exposure, frames):
+        """ Keep the frames of an exposure and archive them if the policy says so
+
+        Args:
+           cmd      - a Command object to report to. Ignored if None.
+           exposure - the Exposure which took the frames
+           frames   - list of the Frames read out
+
+        Returns:
+           - the reason the exposure was archived, or None
+        """
+
+        with self.lock:
+            self.count += 1
+            count = self.count
+        reason = None
+        if exposure.aborted:
+            reason = 'abort'
+        elif self.every > 0 and count % self.every == 0:
+            reason = 'every'
+        elif self.anomaly and any(self.isAnomalous(f, exposure.centroid) for f in frames):
+            reason = 'anomaly'
+
+        if reason == 'abort':
+            # the frames leading to the abort
+            self.save(cmd, reason)
+        if reason is not None:
+            self.write(cmd, frames, reason)
+        for f in frames:
+            if f.agcid in self.rings:
+                self.rings[f.agcid].add(f)
+        return reason
+
+    def write(self, cmd, frames, reason):
+        """ Write the frames of one exposure which are not archived yet """
+
+        with Archiver.archiveLock:
+            frames = [f for f in frames if not f.archived]
+            for f in frames:
+                f.archived = True
+        if len(frames) == 0:
+            return
+        writeFrames(cmd, frames, self.fitsWriter)
+        metrics.archivedFrames.inc(len(frames), reason=reason)
+        if cmd:
+            cmd.inform('agc_archive=%d,%d,%s' % (frames[0].seq_id + 1, frames[0].nframe, reason))
+
+    def save(self, cmd, reason='saveFrames', cams=None):
+        """ Write all the frames in the rings which are not archived yet
+
+        Args:
+           cmd    - a Command object to report to. Ignored if None.
+           reason - reason reported in agc_archive
+           cams   - agcids of the rings to write, all if None
+
+        Returns:
+           - the number of frames written
+        """
+
+        exposures = collections.OrderedDict()
+        for agcid, ring in sorted(self.rings.items()):
+            if cams is not None and agcid not in cams:
+                continue
+            for f in ring.snapshot():
+                if not f.archived:
+                    exposures.setdefault(f.nframe, []).append(f)
+
+        nframes = 0
+        for nframe in sorted(exposures):
+            self.write(cmd, exposures[nframe], reason)
+            nframes += len(exposures[nframe])
+        return nframes
@@ -0,0 +1,434 @@
+"""Local write-ahead journal for the AGCC OpDB writes.
+
+Exposure and centroid records are written to OpDB directly, as without
+the journal, so that they are in the database when the command finishes.
+Only when that write fails, or while older records still wait in the
+journal, are they appended to a local, length-prefixed binary journal. A
+background replayer drains the journal into the database in bulk, so
+exposures keep running while the database is unreachable and catch up
+once it is back.
+
+Record layout: <uint32 payload length> <uint32 crc32> <pickled payload>.
+A torn record at the end of the file (crash during append) fails the
+length or crc check and is dropped when the journal is reopened.
+"""
+
+import datetime
+import logging
+import os
+import pickle
+import struct
+import threading
+import time
+import zlib
+
+from agccActor import dbRoutinesAGCC
+import metrics
+
+EXPOSURE = 'exposure'
+CENTROIDS = 'centroids'
+RECENTROIDS = 'recentroids'
+
+_header = struct.Struct('<II')
+
+
+
+class ExposureIdCollisionError(RuntimeError):
+    """The agc_exposure_id of a journaled exposure belongs to another exposure in OpDB."""
+
+
+# errors which no retry can fix: a record failing with them is rejected at once
+permanentErrors = (dbRoutinesAGCC.MissingStatusError, ExposureIdCollisionError, KeyError, TypeError, ValueError)
+
+
+def isPermanent(e):
+    """ Return True if no retry can fix the error of a record """
+
+    if isinstance(e, permanentErrors):
+        return True
+    # constraint violations, e.g. sqlalchemy.exc.IntegrityError: matched by name,
+    # since the database driver is not imported here
+    return any(c.__name__ == 'IntegrityError' for c in type(e).__mro__)
+
+
+def _sameTime(t0, t1, tolerance=0.001):
+    """ Compare a taken_at value read back from OpDB to a journaled one """
+
+    if isinstance(t0, str):
+        t0 = datetime.datetime.fromisoformat(t0)
+    if t0.tzinfo is not None:
+        t0 = t0.astimezone().replace(tzinfo=None)
+    return abs((t0 - t1).total_seconds()) < tolerance
+
+
+class DBJournal(object):
+    """ Append-only journal of OpDB writes with asynchronous replay """
+
+    def __init__(self, path, retryInterval=5.0, maxAttempts=20, batchSize=64, idTimeout=2.0):
+        """ Open (or create) the journal in a directory
+
+        Args:
+           path          - journal directory
+           retryInterval - seconds between replay attempts while OpDB is failing
+           maxAttempts   - attempts before a record is moved to the rejected file
+           batchSize     - maximum number of records replayed in one pass
+           idTimeout     - seconds to wait for OpDB to answer the first
+                           agc_exposure_id query
+        """
+
+        self.logger = logging.getLogger('agcc')
+        self.path = os.path.expandvars(os.path.expanduser(path))
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path, 0o755)
+        self.retryInterval = retryInterval
+        self.maxAttempts = maxAttempts
+        self.batchSize = batchSize
+        self.idTimeout = idTimeout
+
+        self.journalFile = os.path.join(self.path, 'journal.bin')
+        self.offsetFile = os.path.join(self.path, 'journal.offset')
+        self.rejectedFile = os.path.join(self.path, 'journal.rejected')
+        self.exposureIdFile = os.path.join(self.path, 'last_exposure_id')
+
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.attempts = 0
+        self.nReplayed = 0
+        self.nFailures = 0
+        self.nRejected = 0
+        self.lastError = None
+        self.idError = None
+
+        self.committed = self._readInt(self.offsetFile, 0)
+        # the centroids of a rejected exposure are rejected with it
+        self.rejectedExposures = self._readRejectedExposures()
+        self.lastExposureId = self._readInt(self.exposureIdFile, -1)
+        self.end = self._recover()
+        self.fd = os.open(self.journalFile, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+        self.thread = threading.Thread(target=self._replayLoop, name='dbJournal', daemon=True)
+        self.thread.start()
+        # the local agc_exposure_id counter follows OpDB in the background
+        self.idKnown = threading.Event()
+        self.idWakeup = threading.Event()
+        self.idThread = threading.Thread(target=self._exposureIdLoop, name='dbExposureId', daemon=True)
+        self.idThread.start()
+
+    def _readInt(self, filename, default):
+        try:
+            with open(filename, 'r') as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return default
+
+    def _writeInt(self, filename, value):
+        tmpname = filename + '.tmp'
+        with open(tmpname, 'w') as f:
+            f.write(str(value))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpname, filename)
+
+    def _recover(self):
+        """ Drop a torn record at the end of the journal, return the valid size """
+
+        if not os.path.isfile(self.journalFile):
+            self.committed = 0
+            return 0
+        end = self.committed
+        with open(self.journalFile, 'rb') as f:
+            f.seek(end)
+            for _, size in self._scan(f):
+                end += size
+            f.seek(0, os.SEEK_END)
+            fileSize = f.tell()
+        if end < fileSize:
+            self.logger.warning(f'Dropping {fileSize - end} bytes of torn journal records in {self.journalFile}.')
+            os.truncate(self.journalFile, end)
+        if self.committed > end:
+            self.committed = end
+        return end
+
+    def _readRejectedExposures(self):
+        if not os.path.isfile(self.rejectedFile):
+            return set()
+        with open(self.rejectedFile, 'rb') as f:
+            return set(fields['exposureId'] for (kind, fields), _ in self._scan(f) if kind == EXPOSURE)
+
+    def _scan(self, f, maxRecords=None):
+        """ Yield (payload, record size) from the current file position """
+
+        n = 0
+        while maxRecords is None or n < maxRecords:
+            head = f.read(_header.size)
+            if len(head) < _header.size:
+                return
+            length, crc = _header.unpack(head)
+            body = f.read(length)
+            if len(body) < length or zlib.crc32(body) != crc:
+                return
+            yield pickle.loads(body), _header.size + length
+            n += 1
+
+    def append(self, kind, **fields):
+        """ Append one record and wake the replayer """
+
+        body = pickle.dumps((kind, fields), protocol=pickle.HIGHEST_PROTOCOL)
+        record = _header.pack(len(body), zlib.crc32(body)) + body
+        with self.lock:
+            os.write(self.fd, record)
+            os.fsync(self.fd)
+            self.end += len(record)
+        self.wakeup.set()
+
+    def write(self, kind, **fields):
+        """ Write one record to OpDB, or journal it if that fails
+
+        While older records wait in the journal, the record is appended
+        behind them without trying OpDB, so that the rows reach OpDB in order.
+        """
+
+        if self.pending() == 0:
+            try:
+                self._writeToDB(kind, fields)
+                return
+            except Exception as e:
+                metrics.dbErrors.inc(operation=kind)
+                self.logger.warning(f'Failed to write {kind} {fields["exposureId"]} to OpDB, journaling it: {e}')
+        self.append(kind, **fields)
+
+    def _writeToDB(self, kind, fields):
+        if kind == EXPOSURE:
+            dbRoutinesAGCC.writeExposureToDB(fields['visitId'], fields['exposureId'], fields['exptime'],
+                                             takenAt=fields['takenAt'])
+        elif kind == CENTROIDS:
+            dbRoutinesAGCC.writeCentroidsToDB(fields['result'], fields['visitId'],
+                                              fields['exposureId'], fields['cameraId'])
+        else:
+            dbRoutinesAGCC.replaceCentroidsInDB(fields['result'], fields['visitId'],
+                                                fields['exposureId'], fields['cameraId'])
+
+    def writeExposure(self, visitId, exposureId, exptime, takenAt=None):
+        """ Write an agc_exposure row, see dbRoutinesAGCC.writeExposureToDB """
+
+        self.write(EXPOSURE, visitId=visitId, exposureId=exposureId, exptime=exptime,
+                   takenAt=takenAt or datetime.datetime.now())
+
+    def writeCentroids(self, result, visitId, exposureId, cameraId):
+        """ Write the agc_data rows of one camera, see dbRoutinesAGCC.writeCentroidsToDB """
+
+        self.write(CENTROIDS, result=result, visitId=visitId, exposureId=exposureId, cameraId=cameraId)
+
+    def replaceCentroids(self, result, visitId, exposureId, cameraId):
+        """ Write new agc_data rows of one camera, see dbRoutinesAGCC.replaceCentroidsInDB """
+
+        self.write(RECENTROIDS, result=result, visitId=visitId, exposureId=exposureId, cameraId=cameraId)
+
+    def nextExposureId(self):
+        """ Allocate the next agc_exposure_id
+
+        The id comes from the local counter, so that a slow OpDB does not
+        delay the exposure. After each allocation the counter is raised in
+        the background to the next id in OpDB, if that is higher.
+
+        The counter file may be missing, or stale after a restart, so no id
+        is allocated before OpDB has answered once since the journal was
+        opened: until then the allocation waits up to idTimeout seconds and
+        raises if OpDB still has not answered. Afterwards the counter stays
+        ahead of OpDB, also through an outage, since all agc_exposure rows
+        come from it.
+        """
+
+        if not self.idKnown.is_set():
+            self.idWakeup.set()
+            if not self.idKnown.wait(self.idTimeout):
+                raise RuntimeError(f'OpDB has not answered the agc_exposure_id query yet: {self.idError}')
+        with self.lock:
+            self.lastExposureId += 1
+            self._writeInt(self.exposureIdFile, self.lastExposureId)
+            exposureId = self.lastExposureId
+        self.idWakeup.set()
+        return exposureId
+
+    def _exposureIdLoop(self):
+        failing = False
+        while not self.stopping.is_set():
+            try:
+                dbId = dbRoutinesAGCC.getNextAgcExposureId()
+            except Exception as e:
+                metrics.dbErrors.inc(operation='exposureId')
+                self.idError = e
+                if not failing:
+                    self.logger.warning(f'Failed to get agc_exposure_id from OpDB, using local counter: {e}')
+                failing = True
+            else:
+                with self.lock:
+                    if dbId - 1 > self.lastExposureId:
+                        self.lastExposureId = dbId - 1
+                        self._writeInt(self.exposureIdFile, self.lastExposureId)
+                failing = False
+                self.idKnown.set()
+            # retried until OpDB has answered once, then after each allocation
+            self.idWakeup.wait(None if self.idKnown.is_set() else self.retryInterval)
+            self.idWakeup.clear()
+
+    def pending(self):
+        """ Return the number of bytes still waiting for replay """
+
+        with self.lock:
+            return self.end - self.committed
+
+    def replay(self, db=None):
+        """ Replay one batch of journal records into OpDB
+
+        Returns the number of records committed. Raises on database errors,
+        leaving the failing record at the head of the journal. A failing
+        batch of centroid records is replayed again one record at a time,
+        so that only the failing record is retried and rejected. Records
+        failing with a permanent error are rejected at once, and so are the
+        centroids of a rejected exposure.
+        """
+
+        with self.lock:
+            start, end = self.committed, self.end
+        if start >= end:
+            return 0
+
+        records = []
+        with open(self.journalFile, 'rb') as f:
+            f.seek(start)
+            for (kind, fields), size in self._scan(f, self.batchSize):
+                records.append((kind, fields, size))
+
+        db = db or dbRoutinesAGCC.opdb.OpDB()
+        done = 0
+        n = 0
+        single = False
+        while n < len(records):
+            kind, fields, size = records[n]
+            batch = [records[n]]
+            if kind != EXPOSURE and fields['exposureId'] in self.rejectedExposures:
+                self.logger.error(f'Rejecting journal record {kind} {fields["exposureId"]} of camera '
+                                  f'{fields["cameraId"]}: its agc_exposure record was rejected')
+                self._reject(batch[0][:2])
+                done += size
+                n += 1
+                continue
+            try:
+                if kind == EXPOSURE:
+                    self._replayExposure(db, fields)
+                elif kind == RECENTROIDS:
+                    dbRoutinesAGCC.replaceCentroidsInDB(fields['result'], fields['visitId'],
+                                                        fields['exposureId'], fields['cameraId'], db=db)
+                else:
+                    # consecutive centroid records go to the database in one insert
+                    while not single and n + len(batch) < len(records) and records[n + len(batch)][0] == CENTROIDS \
+                            and records[n + len(batch)][1]['exposureId'] not in self.rejectedExposures:
+                        batch.append(records[n + len(batch)])
+                    self._replayCentroids(db, [b[1] for b in batch])
+            except Exception as e:
+                metrics.dbErrors.inc(operation=kind)
+                self.nFailures += 1
+                self.lastError = str(e)
+                if len(batch) > 1:
+                    # find the failing record of the batch
+                    single = True
+                    continue
+                self.attempts += 1
+                permanent = isPermanent(e)
+                if not permanent and self.attempts < self.maxAttempts:
+                    self._commit(done)
+                    raise
+                self.logger.error(f'Giving up on journal record {kind} {fields.get("exposureId")} '
+                                  f'after {self.attempts} attempts: {e}')
+                self._reject(batch[0][:2])
+            self.attempts = 0
+            done += sum(b[2] for b in batch)
+            n += len(batch)
+            self.nReplayed += len(batch)
+
+        self._commit(done)
+        return n
+
+    def _replayExposure(self, db, fields):
+        row = db.query_series('SELECT pfs_visit_id, taken_at FROM agc_exposure '
+                              'WHERE agc_exposure_id = :agc_exposure_id',
+                              params={'agc_exposure_id': fields['exposureId']})
+        if row is None:
+            dbRoutinesAGCC.writeExposureToDB(fields['visitId'], fields['exposureId'], fields['exptime'],
+                                             takenAt=fields['takenAt'], db=db)
+        elif row['pfs_visit_id'] != fields['visitId'] or not _sameTime(row['taken_at'], fields['takenAt']):
+            # the same id was given to another exposure, not a replay of this one
+            raise ExposureIdCollisionError(f'agc_exposure_id={fields["exposureId"]} of pfs_visit_id='
+                                           f'{fields["visitId"]} taken at {fields["takenAt"]} is already in OpDB '
+                                           f'for pfs_visit_id={row["pfs_visit_id"]} taken at {row["taken_at"]}')
+
+    def _replayCentroids(self, db, batch):
+        todo = []
+        for fields in batch:
+            exists = db.query_scalar('SELECT COUNT(*) FROM agc_data WHERE agc_exposure_id = :agc_exposure_id '
+                                     'AND agc_camera_id = :agc_camera_id',
+                                     params={'agc_exposure_id': fields['exposureId'],
+                                             'agc_camera_id': fields['cameraId']})
+            if not exists:
+                todo.append((fields['result'], fields['visitId'], fields['exposureId'], fields['cameraId']))
+        if len(todo) > 0:
+            dbRoutinesAGCC.writeCentroidsBatchToDB(todo, db=db)
+
+    def _reject(self, record):
+        kind, fields = record
+        if kind == EXPOSURE:
+            self.rejectedExposures.add(fields['exposureId'])
+        self.nRejected += 1
+        metrics.dbRejected.inc(operation=kind)
+        with open(self.rejectedFile, 'ab') as f:
+            body = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+            f.write(_header.pack(len(body), zlib.crc32(body)) + body)
+
+    def _commit(self, nbytes):
+        """ Advance the replay offset, compacting the journal once it is drained """
+
+        if nbytes == 0:
+            return
+        with self.lock:
+            self.committed += nbytes
+            if self.committed == self.end:
+                os.ftruncate(self.fd, 0)
+                self.committed = self.end = 0
+            self._writeInt(self.offsetFile, self.committed)
+
+    def _replayLoop(self):
+        failing = False
+        while not self.stopping.is_set():
+            self.wakeup.wait(self.retryInterval)
+            self.wakeup.clear()
+            try:
+                while True:
+                    t0 = time.monotonic()
+                    if self.replay() == 0:
+                        break
+                    metrics.dbReplaySeconds.observe(time.monotonic() - t0)
+                if failing:
+                    self.logger.info('OpDB journal replay recovered.')
+                failing = False
+            except Exception as e:
+                if not failing:
+                    self.logger.warning(f'OpDB journal replay failed, {self.pending()} bytes pending: {e}')
+                failing = True
+
+    def close(self):
+        """ Stop the replayer and close the journal """
+
+        self.stopping.set()
+        self.wakeup.set()
+        self.idWakeup.set()
+        self.thread.join()
+        # may be stuck in a hanging OpDB query
+        self.idThread.join(self.idTimeout)
+        os.close(self.fd)
+
+    def statusStr(self):
+        """ Return a short status string for the journal """
+
+        return f'{self.pending()},{self.nReplayed},{self.nFailures},{self.nRejected}'
@@ -26,11 +26,13 @@ class AgccActor(Actor):
             self.camera.closeCamera()
             del self.camera
         self.camera = camera.Camera(config)
+        self.camera.sendInitKeys(cmd)
         self.camera.sendStatusKeys(cmd)
         
     def connectCamera(self, cmd, config, doFinish=True):
         reload(camera)
         self.camera = camera.Camera(config)
+        self.camera.sendInitKeys(cmd)
         self.camera.sendStatusKeys(cmd)
 
 #
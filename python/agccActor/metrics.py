@@ -0,0 +1,304 @@
+"""Performance metrics of the actor in the Prometheus text format.
+
+A process-wide registry holds counters (frames, spots, aborts, OpDB
+errors), latency histograms (the exposure stages of timing.Timeline, the
+journal replay, the camera start skew, the USB readout waits, the abort
+latency) and
+gauges, which may be sampled from a callback when the registry is
+rendered (busy cameras, photometry queue depths). A MetricsExporter
+serves the registry on a local HTTP port and/or writes it periodically
+to a textfile for the node exporter; nothing else is needed to scrape
+it.
+"""
+
+import bisect
+import logging
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# seconds, from a fast OpDB insert to a slow readout
+defaultBuckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _labelStr(labelnames, values, extra=None):
+    items = list(zip(labelnames, values))
+    if extra is not None:
+        items.append(extra)
+    if len(items) == 0:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', r'\\').replace('"', r'\"'))
+                             for k, v in items)
+
+
+def _valueStr(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+class Metric(object):
+    """ A named metric with optional labels """
+
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} takes labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(labels[k] for k in self.labelnames)
+
+    def samples(self):
+        """ Yield (suffix, label string, value) """
+
+        with self.lock:
+            items = list(self.values.items())
+        for key, value in sorted(items, key=lambda kv: tuple(map(str, kv[0]))):
+            yield '', _labelStr(self.labelnames, key), value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for suffix, labels, value in self.samples():
+            lines.append(f'{self.name}{suffix}{labels} {_valueStr(value)}')
+        return lines
+
+
+class Counter(Metric):
+    """ Monotonic counter """
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """ Value which goes up and down, set directly or sampled from a callback """
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self.function = None
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def setFunction(self, function):
+        """ Sample the gauge when rendered
+
+        Args:
+           function - callable returning the value, or with labels a dict of
+                      label value tuples to values. None removes the callback.
+        """
+
+        self.function = function
+
+    def samples(self):
+        function = self.function
+        if function is not None:
+            try:
+                values = function()
+            except Exception as e:
+                logging.getLogger('agcc').warning(f'Failed to sample metric {self.name}: {e}')
+                return
+            if not self.labelnames:
+                values = {(): values}
+            with self.lock:
+                self.values = {key if isinstance(key, tuple) else (key,): value
+                               for key, value in values.items()}
+        yield from super().samples()
+
+
+class Histogram(Metric):
+    """ Distribution of observed values in cumulative buckets """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=defaultBuckets):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # per bucket counts, +Inf last, then the sum
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self.lock:
+            items = [(key, list(counts)) for key, counts in self.values.items()]
+        for key, counts in sorted(items, key=lambda kv: tuple(map(str, kv[0]))):
+            total = 0
+            for le, n in zip(self.buckets + (float('inf'),), counts[:-1]):
+                total += n
+                yield '_bucket', _labelStr(self.labelnames, key, ('le', _valueStr(le))), total
+            yield '_sum', _labelStr(self.labelnames, key), counts[-1]
+            yield '_count', _labelStr(self.labelnames, key), total
+
+
+class Registry(object):
+    """ Set of metrics rendered together """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def _get(self, cls, name, help, labelnames, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, help, labelnames, **kwargs)
+            elif not isinstance(metric, cls) or metric.labelnames != tuple(labelnames):
+                raise ValueError(f'metric {name} is already registered as a different metric')
+            return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._get(Counter, name, help, labelnames)
+
+    def gauge(self, name, help, labelnames=()):
+        return self._get(Gauge, name, help, labelnames)
+
+    def histogram(self, name, help, labelnames=(), buckets=defaultBuckets):
+        return self._get(Histogram, name, help, labelnames, buckets=buckets)
+
+    def render(self):
+        """ Return all the metrics in the Prometheus text format """
+
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+frames = registry.counter('agcc_frames_total', 'Frames read out', ('camera',))
+spots = registry.counter('agcc_spots_total', 'Spots measured', ('camera',))
+aborts = registry.counter('agcc_aborts_total', 'Aborted exposures', ('camera',))
+exposureErrors = registry.counter('agcc_exposure_errors_total', 'Failed exposures or readouts', ('camera',))
+archivedFrames = registry.counter('agcc_archived_frames_total', 'Sequence frames written from the rings', ('reason',))
+dbErrors = registry.counter('agcc_db_errors_total', 'Failed OpDB operations', ('operation',))
+dbRejected = registry.counter('agcc_db_rejected_total', 'Journal records moved to the rejected file', ('operation',))
+stageSeconds = registry.histogram('agcc_stage_seconds', 'Duration of the exposure stages', ('stage',))
+dbReplaySeconds = registry.histogram('agcc_db_replay_seconds', 'Duration of the OpDB journal replay batches')
+startSkew = registry.histogram('agcc_start_skew_seconds', 'Spread of the camera start times of an exposure',
+                               buckets=(0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2))
+readoutWait = registry.histogram('agcc_readout_wait_seconds', 'Wait for a USB bus readout slot', ('bus',),
+                                 buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+abortLatency = registry.histogram('agcc_abort_latency_seconds', 'Time from an abort to the camera ready',
+                                  buckets=(0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5))
+busyCameras = registry.gauge('agcc_busy_cameras', 'Cameras in a running exposure')
+workerQueue = registry.gauge('agcc_worker_queue_depth', 'Items waiting in the photometry worker queues',
+                             ('camera',))
+fitsWriterQueue = registry.gauge('agcc_fitswriter_queue_depth', 'Frames waiting in the FITS writer')
+journalPending = registry.gauge('agcc_journal_pending_bytes', 'Journal bytes waiting for OpDB')
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsExporter(object):
+    """ Export a registry over HTTP and/or to a textfile """
+
+    def __init__(self, port=None, host='127.0.0.1', textfile=None, interval=15.0, registry=registry):
+        """ Start the exporters
+
+        Args:
+           port     - HTTP port, no HTTP server if None
+           host     - address to bind the HTTP server to
+           textfile - file rewritten every interval seconds, none if None
+           interval - seconds between textfile updates
+           registry - metrics to export
+        """
+
+        self.logger = logging.getLogger('agcc')
+        self.registry = registry
+        self.server = None
+        self.textfile = None if textfile is None else os.path.expandvars(os.path.expanduser(textfile))
+        self.interval = interval
+        self.stopping = threading.Event()
+        self.threads = []
+
+        if port is not None:
+            self.server = ThreadingHTTPServer((host, port), _Handler)
+            self.server.daemon_threads = True
+            self.server.registry = registry
+            self.threads.append(threading.Thread(target=self.server.serve_forever,
+                                                 name='metricsHttp', daemon=True))
+            self.logger.info(f'Serving metrics on http://{host}:{self.server.server_port}/metrics')
+        if self.textfile is not None:
+            self.threads.append(threading.Thread(target=self._textfileLoop,
+                                                 name='metricsTextfile', daemon=True))
+        for thr in self.threads:
+            thr.start()
+
+    def writeTextfile(self):
+        """ Atomically replace the textfile with the current metrics """
+
+        tmpname = self.textfile + '.tmp'
+        with open(tmpname, 'w') as f:
+            f.write(self.registry.render())
+        os.replace(tmpname, self.textfile)
+
+    def _textfileLoop(self):
+        while True:
+            try:
+                self.writeTextfile()
+            except Exception as e:
+                self.logger.warning(f'Failed to write metrics to {self.textfile}: {e}')
+            if self.stopping.wait(self.interval):
+                return
+
+    def close(self):
+        """ Stop the exporters, leaving a last textfile """
+
+        self.stopping.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        for thr in self.threads:
+            thr.join()
+        if self.textfile is not None:
+            try:
+                self.writeTextfile()
+            except Exception as e:
+                self.logger.warning(f'Failed to write metrics to {self.textfile}: {e}')
+
+
+def observeStages(spans):
+    """ Add the span durations of a finished timeline to the stage histogram """
+
+    for stage, cam, start, end in spans:
+        stageSeconds.observe(end - start, stage=stage)
@@ -4,6 +4,7 @@ from importlib import reload
 import multiprocessing as mp
 import sep
 import logging
+import profiler
 
 spotDtype = np.dtype(dict(names=['image_moment_00_pix', 'centroid_x_pix', 'centroid_y_pix', 'central_image_moment_20_pix', 'central_image_moment_11_pix', 'central_image_moment_02_pix', 'peak_pixel_x_pix', 'peak_pixel_y_pix', 'peak_intensity', 'background', 'estimated_magnitude', 'flags'],
                           formats=['f4', 'f4', 'f4', 'f4', 'f4' ,'f4', 'i2', 'i2', 'f4', 'f4', 'f4', 'i2']))
@@ -19,24 +20,77 @@ def measure(data,agcid,cParms,iParms,cMethod,thresh=10):
         
     return result
 
+# how the photometry workers are started: 'forkserver' forks them from a
+# server process with this module (and the centroid stack) already
+# imported, 'fork' forks the actor itself
+startMethod = 'forkserver'
+
+def setStartMethod(name):
+    """ Select how the photometry workers are started, 'forkserver' or 'fork' """
+
+    global startMethod
+    if name not in ('forkserver', 'fork'):
+        raise ValueError(f'unknown worker start method: {name}')
+    startMethod = name
+
+def worker(in_q, out_q):
+    """ photometry worker main loop
+
+    Messages are tuples: ('measure', data, agcid, cParms, iParms, cMethod),
+    answered with the spots, or the exception raised, on out_q, and
+    ('profile', 'start'|'stop', filename), which turns the profiling of the
+    measurements on and off.
+    """
+
+    prof = profiler.WorkerProfiler()
+    while (True):
+
+        msg = in_q.get()
+        if msg[0] == 'profile':
+            try:
+                prof.control(*msg[1:])
+            except Exception as e:
+                logging.getLogger('agcc').warning(f'photometry worker profile error: {e}')
+            continue
+
+        _, data, agcid, cParms, iParms, cMethod = msg
+        try:
+            result = prof.call(measure, data, agcid, cParms, iParms, cMethod)
+        except Exception as e:
+            # the worker stays up for the next frame
+            result = e
+
+        out_q.put(result)
+
+def measureRequest(data, agcid, cParms, iParms, cMethod):
+    """ Return the worker message measuring one frame """
+
+    return ('measure', data, agcid, cParms, iParms, cMethod)
+
+def getResult(out_q):
+    """ Return the spots of the next worker answer, raising the worker's error """
+
+    result = out_q.get()
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+def profileRequest(action, filename=None):
+    """ Return the worker message starting or stopping its profile """
+
+    return ('profile', action, filename)
+
 def createProc():
     """ multiprocessing for photometry """
-    def worker(in_q, out_q):
-        while (True):
-
-            data = in_q.get()
-            agcid = in_q.get()
-            cParms = in_q.get()
-            iParms = in_q.get()
-            cMethod = in_q.get()
-            
-            result = measure(data,agcid,cParms,iParms,cMethod)
 
-            out_q.put(result)
+    ctx = mp.get_context(startMethod)
+    if startMethod == 'forkserver':
+        # the server is started by the first worker and imports us once
+        ctx.set_forkserver_preload([__name__])
 
-    in_q = mp.Queue()
-    out_q = mp.Queue()
+    in_q = ctx.Queue()
+    out_q = ctx.Queue()
 
-    p = mp.Process(target=worker, args=(in_q, out_q), daemon=True)
+    p = ctx.Process(target=worker, args=(in_q, out_q), daemon=True)
     p.start()
     return in_q, out_q, p
@@ -0,0 +1,119 @@
+"""On-demand profiling of the actor and of the photometry workers.
+
+The actor threads are profiled by sampling: a thread snapshots the stacks
+of all the other threads with sys._current_frames() at a fixed rate and
+counts them in the folded format of flame graph tools
+("thread;outer;...;inner count"). The photometry workers run a cProfile
+of their main loop, turned on and off by control messages on their input
+queue, and dump pstats files. Nothing runs while profiling is off.
+"""
+
+import cProfile
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+
+
+def profileDir():
+    """ Return the directory of the profile files, created if needed """
+
+    path = os.path.join("$ICS_MHS_DATA_ROOT", 'agcc', 'profiles')
+    path = os.path.expandvars(os.path.expanduser(path))
+    if not os.path.isdir(path):
+        os.makedirs(path, 0o755)
+    return path
+
+
+def profileName(what, suffix):
+    """ Return a new profile filename in the profile directory """
+
+    stamp = time.strftime('%Y%m%dT%H%M%S', time.gmtime())
+    return os.path.join(profileDir(), f'agcc_{what}_{stamp}.{suffix}')
+
+
+def _frameName(frame):
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+class StackSampler(threading.Thread):
+    """ Statistical profiler of the threads of this process """
+
+    def __init__(self, interval=0.005):
+        """
+        Args:
+           interval - seconds between samples
+        """
+
+        super().__init__(name='stackSampler', daemon=True)
+        self.logger = logging.getLogger('agcc')
+        self.interval = interval
+        self.stopping = threading.Event()
+        self.stacks = collections.Counter()
+        self.nSamples = 0
+        self.t0 = None
+        self.elapsed = 0.0
+
+    def sample(self):
+        names = {thr.ident: thr.name for thr in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == self.ident:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frameName(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            self.stacks[';'.join(reversed(stack))] += 1
+        self.nSamples += 1
+
+    def run(self):
+        self.t0 = time.monotonic()
+        while not self.stopping.wait(self.interval):
+            self.sample()
+        self.elapsed = time.monotonic() - self.t0
+
+    def stop(self, filename):
+        """ Stop sampling and write the folded stacks to a file """
+
+        self.stopping.set()
+        self.join()
+        with open(filename, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+        self.logger.info(f'Wrote {self.nSamples} stack samples over {self.elapsed:.1f}s to {filename}.')
+
+
+class WorkerProfiler(object):
+    """ cProfile of a photometry worker, driven by control messages """
+
+    def __init__(self):
+        self.profile = None
+
+    def control(self, action, filename=None):
+        """ Handle a ('profile', action, filename) message
+
+        Args:
+           action   - 'start' or 'stop'
+           filename - pstats file written on 'stop'
+        """
+
+        if action == 'start':
+            if self.profile is None:
+                self.profile = cProfile.Profile()
+        elif action == 'stop':
+            if self.profile is not None and filename is not None:
+                self.profile.dump_stats(filename)
+            self.profile = None
+        else:
+            raise ValueError(f'unknown profile action: {action}')
+
+    def call(self, func, *args):
+        """ Call func, profiled when profiling is on """
+
+        if self.profile is None:
+            return func(*args)
+        return self.profile.runcall(func, *args)
@@ -0,0 +1,209 @@
+"""USB bus aware scheduling of the camera readouts.
+
+The cameras are read out by the host, row by row, so cameras on the same
+USB bus or hub share its bandwidth: past the bandwidth of the bus, more
+readouts at a time only make each of them slower, and all the frames
+late. The scheduler limits the concurrent readouts of each bus; the
+cameras over the limit wait, and the next one is the camera with the
+shortest learned readout time, which gets the frames out the earliest.
+Cameras on other buses read out in parallel.
+
+The limit of each bus is learned. The readout time of each camera alone
+on its bus is learned first, one readout at a time. A readout shared
+with others at a mean concurrency c which is s times slower than alone
+shows that the bus carries about c / s readouts at a time: the limit is
+raised while the readouts at the limit are not slowed down, then set to
+this capacity of the bus, past which more readouts only make each of
+them slower.
+
+The bus of a camera is parsed from its libusb device name
+(FLI-B<bus>P<ports>A<address>), or set in the usbBuses configuration.
+A camera whose bus is unknown is never held back, and an aborted camera
+leaves the queue at once.
+"""
+
+import math
+import re
+import threading
+import time
+
+import metrics
+
+busPattern = re.compile(r'B(\d+)P')
+
+
+def parseBus(devname):
+    """ Return the USB bus of a libusb device name, None if unknown """
+
+    match = busPattern.search(devname or '')
+    if match is None:
+        return None
+    return 'B' + match.group(1)
+
+
+def smooth(last, value, weight):
+    return value if last is None else last + weight * (value - last)
+
+
+class Bus(object):
+    """ Readout state of one USB bus """
+
+    def __init__(self, ceiling):
+        self.limit = 1
+        self.ceiling = ceiling
+        self.active = 0
+        # integral of the active readouts over time, for their mean concurrency
+        self.area = 0.0
+        self.t = time.monotonic()
+        # readouts at a time the bus carries at full speed, None until full once
+        self.capacity = None
+
+    def advance(self, now):
+        self.area += self.active * (now - self.t)
+        self.t = now
+
+
+class ReadoutScheduler(object):
+    """ Limits the concurrent readouts of the cameras on each USB bus """
+
+    def __init__(self, maxPerBus=6, smoothing=0.3):
+        """
+        Args:
+           maxPerBus - most concurrent readouts on a bus
+           smoothing - weight of the last readout in the learned values
+        """
+
+        self.maxPerBus = maxPerBus
+        self.smoothing = smoothing
+        self.cond = threading.Condition()
+        self.buses = {}
+        self.cameraBus = {}
+        # readout time of each camera alone on its bus, and with others
+        self.solo = {}
+        self.times = {}
+        self.reading = {}
+        self.waiting = []
+        # waiting cameras whose exposure was aborted
+        self.cancelled = set()
+
+    def setBus(self, agcid, bus):
+        """ Set the USB bus of a camera, None if unknown """
+
+        with self.cond:
+            if bus is None:
+                self.cameraBus.pop(agcid, None)
+            else:
+                self.cameraBus[agcid] = bus
+                if bus not in self.buses:
+                    self.buses[bus] = Bus(self.maxPerBus)
+            self.cond.notify_all()
+
+    def expected(self, agcid):
+        # cameras not read out yet go first, to learn their time
+        return self.solo.get(agcid, self.times.get(agcid, 0.0)), agcid
+
+    def isNext(self, agcid, bus):
+        if bus.active >= bus.limit:
+            return False
+        queued = [a for a in self.waiting if self.cameraBus.get(a) is not None
+                  and self.buses[self.cameraBus[a]] is bus]
+        return min(queued, key=self.expected) == agcid
+
+    def acquire(self, agcid):
+        """ Wait until the camera may read out, return False if cancelled """
+
+        with self.cond:
+            name = self.cameraBus.get(agcid)
+            if name is None:
+                return True
+            bus = self.buses[name]
+            t0 = time.monotonic()
+            self.waiting.append(agcid)
+            try:
+                while agcid not in self.cancelled and not self.isNext(agcid, bus):
+                    self.cond.wait()
+            finally:
+                self.waiting.remove(agcid)
+            if agcid in self.cancelled:
+                self.cancelled.discard(agcid)
+                # the next camera may take the place
+                self.cond.notify_all()
+                return False
+            now = time.monotonic()
+            bus.advance(now)
+            bus.active += 1
+            self.reading[agcid] = (bus, now, bus.area)
+            # the next camera in the queue may have a free slot too
+            self.cond.notify_all()
+        metrics.readoutWait.observe(now - t0, bus=name)
+        return True
+
+    def cancel(self, agcid):
+        """ Stop the wait of an aborted camera for a readout slot """
+
+        with self.cond:
+            if agcid in self.waiting:
+                self.cancelled.add(agcid)
+                self.cond.notify_all()
+
+    def release(self, agcid, learn=True):
+        """ Free the camera's readout slot and learn from its readout
+
+        Args:
+           agcid - camera id
+           learn - False for a readout which did not complete, e.g. aborted
+        """
+
+        with self.cond:
+            if agcid in self.reading:
+                bus, t0, area0 = self.reading.pop(agcid)
+                now = time.monotonic()
+                bus.advance(now)
+                bus.active -= 1
+                if learn and now > t0:
+                    self.learn(agcid, bus, now - t0, (bus.area - area0) / (now - t0))
+            self.cond.notify_all()
+
+    def learn(self, agcid, bus, seconds, concurrency):
+        """ Learn from a readout of seconds at a mean concurrency """
+
+        self.times[agcid] = smooth(self.times.get(agcid), seconds, self.smoothing)
+        if concurrency < 1.1:
+            self.solo[agcid] = smooth(self.solo.get(agcid), seconds, self.smoothing)
+            if bus.limit == 1 and all(a in self.solo for a, b in self.cameraBus.items()
+                                      if self.buses[b] is bus):
+                # all the cameras of the bus are known, try two at a time
+                bus.limit = min(2, bus.ceiling)
+            return
+        if agcid not in self.solo:
+            return
+        slowdown = seconds / self.solo[agcid]
+        if slowdown > 1.1:
+            # the bus was full
+            bus.capacity = smooth(bus.capacity, concurrency / slowdown, self.smoothing)
+            bus.limit = max(1, min(int(math.ceil(bus.capacity - 0.1)), bus.ceiling))
+        elif concurrency > bus.limit - 0.5 and bus.limit < bus.ceiling and \
+                (bus.capacity is None or bus.capacity > bus.limit):
+            # not slowed down at the limit, try one more
+            bus.limit += 1
+
+    def busesStr(self, nCams):
+        """ Return the bus of each camera, - if unknown """
+
+        with self.cond:
+            return ','.join(self.cameraBus.get(n, '-') for n in range(nCams))
+
+    def limitsStr(self):
+        """ Return bus:limit:capacity of each bus """
+
+        with self.cond:
+            return ','.join('%s:%d:%.2f' % (name, bus.limit, math.nan if bus.capacity is None else bus.capacity)
+                            for name, bus in sorted(self.buses.items()))
+
+    def timesStr(self, nCams):
+        """ Return the learned readout time of each camera alone on its bus,
+        in ms, nan if unknown """
+
+        with self.cond:
+            return ','.join('%.0f' % (self.solo[n] * 1000) if n in self.solo else 'nan'
+                            for n in range(nCams))
@@ -1,4 +1,10 @@
 import threading
+import time
+
+import numpy as np
+
+import writeFits
+from coadd import Stacker
 from expose import Exposure
 
 SEQ_IDLE = 0
@@ -6,19 +12,50 @@ SEQ_RUNNING = 1
 SEQ_ABORT = 2
 
 class Sequence(threading.Thread):
-    def __init__(self, cams, expTime_ms, seq_id, count, seq_stat, seq_count, combined, centroid, cParms, iParms, cmd=None):
+    """ Exposure sequence at a fixed cadence
+
+    Frame k starts at t0 + k * cadence; the schedule does not drift with the
+    time each start takes, and ticks which have already passed are dropped.
+    Frames are pipelined: the next exposure starts as soon as the cameras
+    have read out, while the previous frames are still centroided and
+    written, and its agc_exposure_id is allocated while the cameras expose.
+    When more than maxInFlight frames are still being processed at a tick,
+    the frame is skipped ('skip') or taken without centroiding ('degrade');
+    without a cadence the next frame waits for them instead.
+    """
+
+    def __init__(self, cams, expTime_ms, seq_id, count, seq_stat, seq_count, combined, centroid, cParms, iParms,
+                 visitId, cMethod='sep', cmd=None, cadence=0.0, journal=None, fitsWriter=None,
+                 maxInFlight=2, lagPolicy='skip', archiver=None, stack=0, stackClip=0.0, trackers=None,
+                 syncStart=None):
         """ Run exposure command
 
         Args:
            cams        - list of active cameras
            expTime_ms  - exposure time
            seq_id      - Sequence ID
-           count       - number of exposures
+           count       - number of exposures, 0 to run until stopped
            seq_stat    - seq_stat in Camera class
            seq_count   - seq_count in Camera class
            combined    - True if Multiple FITS files else Single FITS file
            centroid    - True if do centroid else don't
+           cParms      - centroid parameters
+           iParms      - image parameters
+           visitId     - pfs_visit_id of the frames
+           cMethod     - centroid method
            cmd         - a Command object to report to. Ignored if None.
+           cadence     - seconds between frame starts, 0 for back to back frames
+           journal     - DBJournal for the OpDB writes which fail, direct writes only if None
+           fitsWriter  - FitsWriter process for the FITS files
+           maxInFlight - frames processed at the same time before falling behind
+           lagPolicy   - 'skip' or 'degrade' frames when falling behind
+           archiver    - frameRing.Archiver selecting the frames written, all if None
+           stack       - centroid and write the mean of every stack frames
+                         instead of the single frames, 0 or 1 for no stacking
+           stackClip   - sigma clipping threshold of the stacks, 0 for none
+           trackers    - dict of agcid: spotTracker.SpotTracker of the cameras
+           syncStart   - StartBarrier class of the camera driver, to start the
+                         exposures of all the cameras together, or None
 
         Returns:
            - NULL
@@ -27,6 +64,8 @@ class Sequence(threading.Thread):
            stat_cam[1-6]
         """
         threading.Thread.__init__(self, daemon=False)
+        if lagPolicy not in ('skip', 'degrade'):
+            raise ValueError(f'unknown sequence lag policy: {lagPolicy}')
         self.cams = cams
         self.expTime_ms = expTime_ms
         self.seq_id = seq_id
@@ -35,7 +74,68 @@ class Sequence(threading.Thread):
         self.seq_count = seq_count
         self.combined = combined
         self.centroid = centroid
+        self.cParms = cParms
+        self.iParms = iParms
+        self.visitId = visitId
+        self.cMethod = cMethod
         self.cmd = cmd
+        self.cadence = cadence
+        self.journal = journal
+        self.fitsWriter = fitsWriter
+        self.maxInFlight = maxInFlight
+        self.lagPolicy = lagPolicy
+        self.archiver = archiver
+        self.trackers = trackers
+        self.syncStart = syncStart
+        self.stackers = None
+        if stack > 1:
+            self.stackers = {cam.agcid: Stacker(writeFits.frameShape(cam), stack, stackClip) for cam in cams}
+
+        self.starts = []
+        self.lateness = []
+        self.missed = 0
+        self.skipped = 0
+        self.degraded = 0
+
+    def running(self):
+        return (self.seq_stat[self.seq_id] == SEQ_RUNNING and
+                (self.count == 0 or self.seq_count[self.seq_id] < self.count))
+
+    def prepare(self):
+        """ Return the next, not yet started, exposure """
+
+        return Exposure(self.cams, self.expTime_ms, False, self.cParms, self.iParms, self.visitId, self.cMethod,
+                        cmd=self.cmd, combined=self.combined, centroid=self.centroid, seq_id=self.seq_id,
+                        journal=self.journal, fitsWriter=self.fitsWriter, pipelined=True,
+                        archiver=self.archiver, stackers=self.stackers, trackers=self.trackers,
+                        syncStart=self.syncStart)
+
+    def waitUntil(self, t):
+        """ Sleep until monotonic time t, return False if the sequence was stopped """
+
+        while self.running():
+            dt = t - time.monotonic()
+            if dt <= 0:
+                return True
+            time.sleep(min(dt, 0.05))
+        return False
+
+    def waitReadout(self, exposure):
+        """ Wait until the cameras of an exposure are read out, return False if
+        the sequence was stopped """
+
+        while not exposure.readoutDone.wait(0.05):
+            if not self.running():
+                return False
+        return True
+
+    def cadenceStr(self):
+        """ Return seq,frames,target,achieved,jitter,missed,skipped,degraded """
+
+        achieved = np.diff(self.starts).mean() if len(self.starts) > 1 else 0.0
+        jitter = np.std(self.lateness) * 1000 if len(self.lateness) > 1 else 0.0
+        return '%d,%d,%.3f,%.3f,%.1f,%d,%d,%d' % (self.seq_id + 1, len(self.starts), self.cadence, achieved,
+                                                  jitter, self.missed, self.skipped, self.degraded)
 
     def run(self):
         # check if any camera is available
@@ -45,20 +145,76 @@ class Sequence(threading.Thread):
                 self.cmd.finish()
             return
 
-        while self.seq_stat[self.seq_id] == SEQ_RUNNING and self.seq_count[self.seq_id] < self.count:
-            exp_thr = Exposure(self.cams, self.expTime_ms, False, cParms, iParms, self.cmd, self.combined, self.centroid, self.seq_id)
-            exp_thr.start()
-            exp_thr.join()
+        inflight = []
+        previous = None
+        exp_thr = None
+        t0 = time.monotonic()
+        k = 0
+        try:
+            exp_thr = self.prepare()
+            while self.running():
+                if self.cadence > 0:
+                    tick = t0 + k * self.cadence
+                    now = time.monotonic()
+                    if now >= tick + self.cadence:
+                        # drop the ticks which have passed, keep the schedule
+                        missed = int((now - tick) // self.cadence)
+                        self.missed += missed
+                        k += missed
+                        tick = t0 + k * self.cadence
+                    if not self.waitUntil(tick):
+                        break
 
-            self.seq_count[self.seq_id] += 1
+                # the cameras are free once the previous frame is read out
+                if previous is not None and not self.waitReadout(previous):
+                    break
+                inflight = [e for e in inflight if e.is_alive()]
+                if self.cadence <= 0:
+                    # back to back frames wait for the processing instead
+                    while len(inflight) >= self.maxInFlight:
+                        inflight.pop(0).join()
+                    tick = time.monotonic()
+                elif len(inflight) >= self.maxInFlight:
+                    if self.lagPolicy == 'skip':
+                        self.skipped += 1
+                        k += 1
+                        if self.cmd:
+                            self.cmd.warn(f'text="Sequence [{self.seq_id + 1}] behind, frame skipped"')
+                        continue
+                    exp_thr.centroid = False
+                    self.degraded += 1
+
+                start = time.monotonic()
+                self.starts.append(start)
+                self.lateness.append(start - tick)
+                exp_thr.start()
+                inflight.append(exp_thr)
+                previous = exp_thr
+                exp_thr = None
+                k += 1
+
+                self.seq_count[self.seq_id] += 1
+                if self.cmd:
+                    self.cmd.inform('text="Sequence [%d] count [%d] started"' % \
+                                    (self.seq_id + 1, self.seq_count[self.seq_id]))
+                    self.cmd.inform('agc_cadence=%s' % self.cadenceStr())
+
+                # allocate the next exposure while this one runs
+                if self.running():
+                    exp_thr = self.prepare()
+        except Exception as e:
             if self.cmd:
-                self.cmd.inform('text="Sequence [%d] count [%d] done"' % \
-                                (self.seq_id + 1, self.seq_count[self.seq_id]))
+                self.cmd.warn(f'text="Sequence [{self.seq_id + 1}] error: {e}"')
+
+        for e in inflight:
+            e.join()
 
+        aborted = self.count == 0 or self.seq_count[self.seq_id] < self.count
         self.seq_stat[self.seq_id] = SEQ_IDLE
         if self.cmd:
+            self.cmd.inform('agc_cadence=%s' % self.cadenceStr())
             self.cmd.inform('inused_seq%d="NO"' % (self.seq_id + 1))
-            if self.seq_count[self.seq_id] >= self.count:
+            if not aborted:
                 self.cmd.inform('text="Sequence [%d] finished"' % (self.seq_id + 1))
             else:
                 self.cmd.inform('text="Sequence [%d] aborted"' % (self.seq_id + 1))
@@ -0,0 +1,158 @@
+"""Persistent spot identities across the frames of a camera.
+
+The spots of each new frame are matched to the last positions of the
+tracks of the camera with a KD-tree: the offset of the frame is first
+estimated from the median shift of nearest neighbours within a wide
+radius, then each track takes the nearest spot within a narrow radius of
+its shifted position, closest pairs first. Unmatched spots start new
+tracks, and tracks which are not seen for a few frames end. Every track
+keeps the running (Welford) mean and variance of its position and flux,
+which give the guiding jitter and the flux scintillation of the stars.
+"""
+
+import threading
+
+import numpy as np
+from numpy.lib import recfunctions
+
+
+class SpotTracker(object):
+    """ Tracks of the spots of one camera """
+
+    def __init__(self, radius=3.0, searchRadius=30.0, maxMissed=3, minCount=3):
+        """
+        Args:
+           radius       - match radius in pixels, after the offset correction
+           searchRadius - radius of the nearest neighbours giving the offset
+           maxMissed    - frames a track may be missing before it ends
+           minCount     - frames of a track before it counts in the statistics
+        """
+
+        self.radius = radius
+        self.searchRadius = searchRadius
+        self.maxMissed = maxMissed
+        self.minCount = minCount
+        # scipy on the first frame would delay it by its import time
+        from scipy.spatial import cKDTree
+        self.kdtree = cKDTree
+        self.lock = threading.Lock()
+        with self.lock:
+            self.clear()
+
+    def clear(self):
+        self.nextId = 0
+        self.nframes = 0
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.last = np.zeros((0, 2))
+        self.lastSeen = np.zeros(0, dtype=np.int64)
+        # Welford statistics of x, y and flux
+        self.count = np.zeros(0, dtype=np.int64)
+        self.mean = np.zeros((0, 3))
+        self.m2 = np.zeros((0, 3))
+        self.offset = np.zeros(2)
+        self.nmatched = 0
+
+    def reset(self):
+        """ End all the tracks """
+
+        with self.lock:
+            self.clear()
+
+    def match(self, pos):
+        """ Return the track index of each position, -1 for none, and the offset """
+
+        index = np.full(len(pos), -1, dtype=np.int64)
+        offset = np.zeros(2)
+        if len(pos) == 0 or len(self.ids) == 0:
+            return index, offset
+
+        tree = self.kdtree(pos)
+        # offset of the frame from the nearest neighbours of the tracks
+        dist, near = tree.query(self.last, distance_upper_bound=self.searchRadius)
+        found = np.isfinite(dist)
+        if np.any(found):
+            offset = np.median(pos[near[found]] - self.last[found], axis=0)
+
+        # unique assignment, closest pairs first
+        dist, near = tree.query(self.last + offset, distance_upper_bound=self.radius)
+        taken = np.zeros(len(pos), dtype=bool)
+        for t in np.argsort(dist):
+            if not np.isfinite(dist[t]):
+                break
+            if not taken[near[t]]:
+                taken[near[t]] = True
+                index[near[t]] = t
+        return index, offset
+
+    def update(self, spots):
+        """ Match the spots of a new frame to the tracks
+
+        Args:
+           spots - centroids of the frame
+
+        Returns:
+           - the spots with a track_id field
+           - the tracking summary: matched spots, tracks, offset x and y from
+             the previous frame, median jitter x and y, median flux rms
+        """
+
+        pos = np.column_stack([spots['centroid_x_pix'], spots['centroid_y_pix']]).astype(float)
+        values = np.column_stack([pos, spots['image_moment_00_pix']]).astype(float)
+
+        with self.lock:
+            self.nframes += 1
+            index, self.offset = self.match(pos)
+            matched = index >= 0
+            self.nmatched = int(np.count_nonzero(matched))
+
+            t = index[matched]
+            v = values[matched]
+            self.count[t] += 1
+            delta = v - self.mean[t]
+            self.mean[t] += delta / self.count[t][:, None]
+            self.m2[t] += delta * (v - self.mean[t])
+            self.last[t] = pos[matched]
+            self.lastSeen[t] = self.nframes
+
+            new = np.flatnonzero(~matched)
+            index[new] = len(self.ids) + np.arange(len(new))
+            self.ids = np.concatenate([self.ids, self.nextId + np.arange(len(new))])
+            self.nextId += len(new)
+            self.last = np.concatenate([self.last, pos[new]])
+            self.lastSeen = np.concatenate([self.lastSeen, np.full(len(new), self.nframes)])
+            self.count = np.concatenate([self.count, np.ones(len(new), dtype=np.int64)])
+            self.mean = np.concatenate([self.mean, values[new]])
+            self.m2 = np.concatenate([self.m2, np.zeros((len(new), 3))])
+
+            trackIds = self.ids[index]
+
+            alive = self.nframes - self.lastSeen <= self.maxMissed
+            if not np.all(alive):
+                for name in ('ids', 'last', 'lastSeen', 'count', 'mean', 'm2'):
+                    setattr(self, name, getattr(self, name)[alive])
+
+            summary = (self.nmatched, len(self.ids), self.offset[0], self.offset[1]) + self.statistics()
+
+        spots = recfunctions.append_fields(spots, 'track_id', trackIds, usemask=False, asrecarray=False)
+        return spots, summary
+
+    def statistics(self):
+        """ Return the median jitter in x and y, in pixels, and the median
+        relative flux rms of the tracks seen in at least minCount frames """
+
+        good = self.count >= self.minCount
+        if not np.any(good):
+            return np.nan, np.nan, np.nan
+        std = np.sqrt(self.m2[good] / (self.count[good] - 1)[:, None])
+        flux = self.mean[good, 2]
+        fluxRms = np.nan
+        if np.any(flux > 0):
+            fluxRms = float(np.median(std[flux > 0, 2] / flux[flux > 0]))
+        return float(np.median(std[:, 0])), float(np.median(std[:, 1])), fluxRms
+
+
+def keyStr(agcid, nframe, nspots, summary):
+    """ Return the agc_tracks value of a frame:
+    cam,frameId,nspots,nmatched,ntracks,dx,dy,jitterX,jitterY,fluxRms """
+
+    return '%d,%d,%d,%d,%d,%.2f,%.2f,%.3f,%.3f,%.4f' % ((agcid + 1, nframe, nspots) + tuple(summary))
@@ -0,0 +1,142 @@
+"""Centroid parameter sweeps over one frame.
+
+A sweep centroids a frame kept in memory for every combination of the
+thresh, deblend, minarea and nmin values given, fanned out over the
+photometry workers of all the cameras, and summarizes each run: the spot
+count, the count of each detection flag, the median FWHM and the time the
+worker took. The summary is sent as keywords and written as a FITS table.
+"""
+
+import itertools
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+from astropy.io import fits
+
+import photometry
+from agccActor import centroidTools as ct
+
+# the swept centroid parameters, in the order of the grid and the keywords
+sweepParams = ('thresh', 'deblend', 'minarea', 'nmin')
+
+# the detection flags counted in the summary
+flagNames = tuple(flag.name for flag in ct.SourceDetectionFlag)
+
+fwhmFactor = 2 * np.sqrt(2 * np.log(2))
+
+
+def sweepDir():
+    """ Return the directory of the sweep tables """
+
+    path = os.path.expandvars(os.path.join('$ICS_MHS_DATA_ROOT', 'agcc', 'sweeps'))
+    if not os.path.isdir(path):
+        os.makedirs(path, 0o755)
+    return path
+
+
+def grid(cParms, values):
+    """ Return the centroid parameters of all the combinations of values
+
+    Args:
+       cParms - centroid parameters, for those which are not swept
+       values - dict of parameter: list of values, for some of sweepParams
+    """
+
+    names = [name for name in sweepParams if name in values]
+    return [dict(cParms, **dict(zip(names, combination)))
+            for combination in itertools.product(*[values[name] for name in names])]
+
+
+def summarize(cParms, spots, seconds):
+    """ Return the summary row of one run: parameters, spots, flag counts, FWHM, ms
+
+    A failed run, with spots None, has nspots -1.
+    """
+
+    row = dict((name, cParms[name]) for name in sweepParams)
+    row['ms'] = seconds * 1000
+    if spots is None:
+        row.update(nspots=-1, fwhm=np.nan, **dict((name, 0) for name in flagNames))
+        return row
+    row['nspots'] = len(spots)
+    flags = spots['flags'].astype(int)
+    for flag in ct.SourceDetectionFlag:
+        row[flag.name] = int(np.count_nonzero(flags & int(flag)))
+    good = spots[flags == 0] if np.any(flags == 0) else spots
+    if len(good) > 0:
+        sigma2 = (good['central_image_moment_20_pix'] + good['central_image_moment_02_pix']) / 2
+        row['fwhm'] = float(np.median(fwhmFactor * np.sqrt(np.clip(sigma2, 0, None))))
+    else:
+        row['fwhm'] = np.nan
+    return row
+
+
+def run(workers, data, agcid, cParmsList, iParms, cMethod):
+    """ Centroid a frame with each set of parameters on the photometry workers
+
+    Args:
+       workers    - cameras whose photometry workers run the measurements
+       data       - the image
+       agcid      - camera of the image
+       cParmsList - list of centroid parameters
+       iParms     - image parameters
+       cMethod    - centroid method
+
+    Returns:
+       - the summary rows, in the order of cParmsList
+       - the errors of the failed runs
+    """
+
+    todo = queue.Queue()
+    for n, cParms in enumerate(cParmsList):
+        todo.put((n, cParms))
+    rows = [None] * len(cParmsList)
+    errors = []
+
+    def drain(cam):
+        while True:
+            try:
+                n, cParms = todo.get_nowait()
+            except queue.Empty:
+                return
+            spots = None
+            with cam.workerLock:
+                t0 = time.monotonic()
+                try:
+                    cam.in_queue.put(photometry.measureRequest(data, agcid, cParms, iParms, cMethod))
+                    spots = photometry.getResult(cam.out_queue)
+                except Exception as e:
+                    errors.append(e)
+                dt = time.monotonic() - t0
+            rows[n] = summarize(cParms, spots, dt)
+
+    thrs = [threading.Thread(target=drain, args=(cam,), daemon=True) for cam in workers]
+    for thr in thrs:
+        thr.start()
+    for thr in thrs:
+        thr.join()
+    return rows, errors
+
+
+def writeTable(filename, rows, header):
+    """ Write the summary rows as a FITS binary table
+
+    Args:
+       filename - output file
+       rows     - summary rows from summarize
+       header   - list of (keyword, value, comment) cards
+    """
+
+    names = list(sweepParams) + ['nspots'] + list(flagNames) + ['fwhm', 'ms']
+    columns = []
+    for name in names:
+        values = np.array([row[name] for row in rows])
+        fmt = 'J' if values.dtype.kind in 'iu' else 'E'
+        columns.append(fits.Column(name=name, format=fmt, array=values))
+    hdu = fits.BinTableHDU.from_columns(columns, name='SWEEP')
+    for card in header:
+        hdu.header.append(card)
+    hdu.writeto(filename, overwrite=True)
@@ -0,0 +1,102 @@
+"""Background telemetry of the AG cameras.
+
+Every FLI status call is a USB round-trip that competes with the readout.
+Each camera has a poller thread that samples the temperature, cooler power,
+device status and exposure status at a fixed rate while the camera is idle
+and publishes them as an immutable snapshot. The status, report and FITS
+header paths read the last snapshot instead of talking to the camera.
+"""
+
+import collections
+import logging
+import threading
+import time
+
+Snapshot = collections.namedtuple('Snapshot', ['time', 'temperature', 'coolerPower',
+                                               'deviceStatus', 'exposureStatus', 'error'])
+
+
+class CameraTelemetry(threading.Thread):
+    """ Telemetry poller of one camera """
+
+    def __init__(self, cam, interval=5.0, history=120):
+        """ Take a first sample of the camera
+
+        Args:
+           cam      - camera to poll
+           interval - seconds between samples
+           history  - number of samples kept in the history ring
+        """
+
+        super().__init__(name=f'telemetry{cam.agcid + 1}', daemon=True)
+        self.logger = logging.getLogger('agcc')
+        self.cam = cam
+        self.interval = interval
+        self.history = collections.deque(maxlen=history)
+        self.stopping = threading.Event()
+        self.snapshot = None
+        self.poll()
+
+    def poll(self):
+        """ Sample the camera and publish a new snapshot """
+
+        cam = self.cam
+        try:
+            snapshot = Snapshot(time.time(), cam.getTemperature(), cam.getCoolerPower(),
+                                cam.getDeviceStatus(), cam.getExposureStatus(), None)
+        except Exception as e:
+            # keep the last good values, and their time, with the error
+            last = self.snapshot
+            if last is None or last.error is None:
+                self.logger.warning(f'Failed to read telemetry of AGC[{cam.agcid + 1}]: {e}')
+            if last is None:
+                snapshot = Snapshot(time.time(), None, None, None, None, str(e))
+            else:
+                snapshot = last._replace(error=str(e))
+
+        # a single reference assignment, readers never see a partial sample
+        self.snapshot = snapshot
+        self.history.append(snapshot)
+        return snapshot
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            # never compete with an exposure or a readout
+            if self.cam.isReady():
+                self.poll()
+
+    def stop(self):
+        """ Stop the poller """
+
+        self.stopping.set()
+        if self.is_alive():
+            self.join()
+
+    def age(self):
+        """ Return the age of the last sample in seconds """
+
+        return time.time() - self.snapshot.time
+
+
+def snapshot(cam):
+    """ Return the last telemetry snapshot of a camera
+
+    Without a poller the camera is sampled now, unless it is busy.
+    """
+
+    telemetry = getattr(cam, 'telemetry', None)
+    if telemetry is not None:
+        return telemetry.snapshot
+    if not cam.isReady():
+        return Snapshot(time.time(), None, None, None, None, 'camera busy')
+    return Snapshot(time.time(), cam.getTemperature(), cam.getCoolerPower(),
+                    cam.getDeviceStatus(), cam.getExposureStatus(), None)
+
+
+def temperature(cam):
+    """ Return the last sampled CCD temperature of a camera """
+
+    telemetry = getattr(cam, 'telemetry', None)
+    if telemetry is not None:
+        return telemetry.snapshot.temperature
+    return cam.getTemperature()
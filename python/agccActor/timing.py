@@ -0,0 +1,128 @@
+"""Per-exposure stage timeline tracing.
+
+A Timeline records monotonic-clock spans of the stages of one exposure,
+per camera where it applies (exposure id allocation, OpDB writes, thread
+delays, exposure, readout, centroiding, FITS writing, ...). When the
+exposure is done the timeline is sent as a compact keyword and a JSON log
+line, and the span durations are added to rolling per-stage statistics
+which the `timing` command reports, and to the stage histogram of the
+metrics registry.
+"""
+
+import collections
+import contextlib
+import json
+import logging
+import threading
+import time
+
+import numpy as np
+
+import metrics
+
+
+class StageStats(object):
+    """ Rolling duration statistics per stage """
+
+    def __init__(self, window=500):
+        """
+        Args:
+           window - number of recent durations kept per stage
+        """
+
+        self.window = window
+        self.lock = threading.Lock()
+        self.durations = collections.OrderedDict()
+        self.counts = collections.Counter()
+
+    def record(self, stage, seconds):
+        with self.lock:
+            if stage not in self.durations:
+                self.durations[stage] = collections.deque(maxlen=self.window)
+            self.durations[stage].append(seconds)
+            self.counts[stage] += 1
+
+    def summary(self):
+        """ Return a list of (stage, count, p50, p95, p99, max) with the durations in ms """
+
+        with self.lock:
+            items = [(stage, self.counts[stage], np.array(d)) for stage, d in self.durations.items()]
+        rows = []
+        for stage, count, d in items:
+            p50, p95, p99 = np.percentile(d, (50, 95, 99)) * 1000
+            rows.append((stage, count, p50, p95, p99, d.max() * 1000))
+        return rows
+
+    def reset(self):
+        with self.lock:
+            self.durations.clear()
+            self.counts.clear()
+
+
+# statistics of all the exposures of this actor
+stats = StageStats()
+
+
+class Timeline(object):
+    """ Stage spans of one exposure """
+
+    def __init__(self):
+        self.logger = logging.getLogger('agcc')
+        self.t0 = time.monotonic()
+        self.exposureId = None
+        self.lock = threading.Lock()
+        self.spans = []
+
+    def add(self, stage, start, end, cam=None):
+        """ Record a span
+
+        Args:
+           stage - stage name
+           start - monotonic start time
+           end   - monotonic end time
+           cam   - camera id, None for the exposure as a whole
+        """
+
+        with self.lock:
+            self.spans.append((stage, cam, start, end))
+
+    @contextlib.contextmanager
+    def span(self, stage, cam=None):
+        """ Record the time spent in a with block """
+
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(stage, start, time.monotonic(), cam)
+
+    def keyword(self):
+        """ Return the timeline as stage[@camera]:start+duration in ms from the start """
+
+        with self.lock:
+            spans = sorted(self.spans, key=lambda s: s[2])
+        items = []
+        for stage, cam, start, end in spans:
+            name = stage if cam is None else '%s@%d' % (stage, cam + 1)
+            items.append('%s:%d+%d' % (name, (start - self.t0) * 1000, (end - start) * 1000))
+        return ' '.join(items)
+
+    def finish(self, cmd=None):
+        """ Close the timeline: update the statistics, send the keyword and log it """
+
+        end = time.monotonic()
+        with self.lock:
+            self.spans.append(('total', None, self.t0, end))
+            spans = list(self.spans)
+        for stage, cam, start, stop in spans:
+            stats.record(stage, stop - start)
+        metrics.observeStages(spans)
+
+        exposureId = -1 if self.exposureId is None else self.exposureId
+        if cmd:
+            cmd.inform('agc_timeline=%d,"%s"' % (exposureId, self.keyword()))
+        self.logger.info('timeline %s' % json.dumps(dict(
+            agc_exposure_id=exposureId,
+            spans=[dict(stage=stage, camera=None if cam is None else cam + 1,
+                        start=round(start - self.t0, 4), duration=round(stop - start, 4))
+                   for stage, cam, start, stop in spans])))
@@ -1,157 +1,446 @@
 import astropy.io.fits as pyfits
+import functools
+import io
 import os
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 import time
+import threading
+import numpy as np
+import fastFits
+import telemetry
 
-def wfits(cmd, visitId, cam, nframe):
-    """Write the image to a FITS file"""
+# FITS writer used by writeSingle/writeCombined: 'direct' (fastFits) or 'astropy'
+engine = 'direct'
 
-    #path = os.path.join("$ICS_MHS_DATA_ROOT", 'agcc')
-    path = os.path.join('/data/raw', time.strftime('%Y-%m-%d', time.gmtime()), 'agcc')
-    path = os.path.expandvars(os.path.expanduser(path))
-    if not os.path.isdir(path):
-        try:
-            os.makedirs(path, 0o755)
-        except Exception as e:
-            raise RuntimeError(f'failed to makedirs({path}): {e}')
+# tile compression of the image HDUs: None, 'rice' or 'hcompress' (both lossless for our frames)
+compression = None
+compressWorkers = 6
+_compressionTypes = {'rice': 'RICE_1', 'hcompress': 'HCOMPRESS_1'}
+_pool = None
+_poolPid = None
 
-    tstart = datetime.fromtimestamp(cam.tstart)
-    mtimestamp = tstart.strftime("%Y%m%d_%H%M%S%f")[:-5]
-    
-    #pfsFilename = os.path.join(path, f'PFSD{visitId:06d}.fits')
-    agc_exposure_id = nframe
-    pfsFilename = os.path.join(path, f'agcc_{visitId:06d}_{agc_exposure_id:08d}_cam{cam.agcid+1}.fits')
+# root of the dated raw data directories
+dataRoot = '/data/raw'
 
-    filename = os.path.join(path, 'agcc_c%d_%s.fits' % \
-           (cam.agcid + 1, mtimestamp))
+# FITS column names of the photometry.spotDtype fields that are renamed in the
+# spot tables, the other fields keep their names
+spotColumns = {
+    'image_moment_00_pix': 'moment_00',
+    'centroid_x_pix': 'centroid_x',
+    'centroid_y_pix': 'centroid_y',
+    'central_image_moment_20_pix': 'moment_20',
+    'central_image_moment_11_pix': 'moment_11',
+    'central_image_moment_02_pix': 'moment_02',
+    'peak_pixel_x_pix': 'peak_x',
+    'peak_pixel_y_pix': 'peak_y',
+}
 
-    if(cam.data.size == 0):
-        cmd.warn('text="No image available for AGC[%d]"' % (cam.agcid + 1))
-        return
-    hdu = pyfits.PrimaryHDU(cam.data)
+def setEngine(name):
+    """Select the FITS writer, 'direct' or 'astropy'"""
+
+    global engine
+    if name not in ('direct', 'astropy'):
+        raise ValueError(f'unknown FITS engine: {name}')
+    engine = name
+
+def setDataRoot(path):
+    """Select the root of the raw data directories"""
+
+    global dataRoot
+    dataRoot = path
+
+def setCompression(name, workers=6):
+    """Select the tile compression of the image HDUs, None, 'rice' or 'hcompress'
+
+    Args:
+       name    - compression, None or 'none' for uncompressed files
+       workers - number of processes compressing the frames in parallel
+    """
+
+    global compression, compressWorkers
+    if name in (None, '', 'none'):
+        name = None
+    elif name not in _compressionTypes:
+        raise ValueError(f'unknown FITS compression: {name}')
+    compression = name
+    compressWorkers = workers
+
+def compressionType():
+    """Return the FITS name of the selected compression"""
+
+    return _compressionTypes[compression]
+
+def compressPool():
+    """Return the process pool compressing the frames, started on first use
+
+    A pool inherited from the parent (e.g. by the FITS writer process) is
+    not usable and a new one is started.
+    """
+
+    global _pool, _poolPid
+    if _pool is None or _poolPid != os.getpid():
+        _pool = ProcessPoolExecutor(max_workers=compressWorkers)
+        _poolPid = os.getpid()
+    return _pool
+
+def shutdownPool():
+    """Stop the compression pool after the submitted frames are done"""
+
+    global _pool
+    if _pool is not None and _poolPid == os.getpid():
+        _pool.shutdown(wait=True)
+    _pool = None
+
+def compressHDU(data, cards, extname, compressionType):
+    """Tile-compress a frame into a FITS extension, run in the compression pool
+
+    Returns (HDU bytes, compression time)
+    """
+
+    t0 = time.time()
+    hdu = pyfits.CompImageHDU(data, compression_type=compressionType, name=extname)
     hdr = hdu.header
-    hdr.set('DATE', cam.timestamp, 'exposure begin date')
-    hdr.set('INSTRUME', cam.devname, 'this instrument')
-    hdr.set('SERIAL', cam.devsn, 'serial number')
-    hdr.set('EXPTIME', cam.exptime, 'exposure time (ms)')
-    hdr.set('VBIN', cam.vbin, 'vertical binning')
-    hdr.set('HBIN', cam.hbin, 'horizontal binning')
-    hdr.set('CCD-TEMP', cam.getTemperature(), 'CCD temperature')
-    if(cam.dark != 0):
-        hdr.set('SHUTTER', 'CLOSE', 'shutter status')
-    else:
-        hdr.set('SHUTTER', 'OPEN', 'shutter status')
-    hdr.set('CCDAREA', '[%d:%d,%d:%d]' % cam.expArea, 'image area')
-    hdr.set('FRAMEID', nframe, 'unique key for exposure')
-    hdr.set('VISITID', visitId, 'visit id')
-
-    if cam.spots is not None:
-        c1 = pyfits.Column(name='moment_00', format='E', array=cam.spots['image_moment_00_pix'])
-        c2 = pyfits.Column(name='centroid_x', format='E', array=cam.spots['centroid_x_pix'])
-        c3 = pyfits.Column(name='centroid_y', format='E', array=cam.spots['centroid_y_pix'])
-        c4 = pyfits.Column(name='moment_20', format='E', array=cam.spots['central_image_moment_20_pix'])
-        c5 = pyfits.Column(name='moment_11', format='E', array=cam.spots['central_image_moment_11_pix'])
-        c6 = pyfits.Column(name='moment_02', format='E', array=cam.spots['central_image_moment_02_pix'])
-        c7 = pyfits.Column(name='peak_x', format='I', array=cam.spots['peak_pixel_x_pix'])
-        c8 = pyfits.Column(name='peak_y', format='I', array=cam.spots['peak_pixel_y_pix'])
-        c9 = pyfits.Column(name='peak_intensity', format='E', array=cam.spots['peak_intensity'])
-        c10 = pyfits.Column(name='background', format='E', array=cam.spots['background'])
-
-        tbhdu = pyfits.BinTableHDU.from_columns([c1, c2, c3, c4, c5, c6, c7, c8, c9, c10])
-        hdulist = pyfits.HDUList([hdu, tbhdu])
-        hdulist.writeto(filename, checksum=True, overwrite=True)
-    else:
-        #hdu.writeto(filename, overwrite=True, checksum=True)
-        hdu.writeto(pfsFilename, overwrite=True, checksum=True)
+    for key, value, comment in cards:
+        hdr.set(key, value, comment)
 
-    # Now make a symbolic link 
-    #os.symlink(pfsFilename, filename)
+    # astropy only serializes complete files: drop the empty primary header
+    buf = io.BytesIO()
+    pyfits.HDUList([pyfits.PrimaryHDU(), hdu]).writeto(buf, checksum=True)
+    return buf.getvalue()[fastFits.BLOCK:], time.time() - t0
 
-    cam.filename = pfsFilename
-    if cmd:
-        cmd.inform('agc%d_fitsfile="%s",%.1f' % (cam.agcid + 1, pfsFilename, cam.tstart))
-        cmd.inform(f'text="AG images are NOT written into {pfsFilename}"')
+def compressFrame(data, cards, extname=None):
+    """Submit a frame to the compression pool, return the future of compressHDU"""
 
-def wfits_combined(cmd, visitId, cams, nframe, seq_id=-1):
-    """Write the images to a FITS file"""
+    return compressPool().submit(compressHDU, data, cards, extname, compressionType())
+
+def writeCompressed(filename, images, tables):
+    """Write the compressed image extensions after an empty primary HDU
+
+    Args:
+       filename - output FITS file
+       images   - list of (future of compressHDU, raw nbytes) of the image
+                  extensions, None for an empty extension
+       tables   - list of spot table buffers
+    Returns:
+       (compression ratio, compression time)
+    """
+
+    hdus = [fastFits.imageHDU(None, [])]
+    rawBytes = packedBytes = 0
+    dt = 0.0
+    for n, image in enumerate(images):
+        if image is None:
+            hdus.append(fastFits.imageHDU(None, [], 'cam%d' % (n + 1), extension=True))
+            continue
+        future, nbytes = image
+        hdu, t = future.result()
+        hdus.append([hdu])
+        rawBytes += nbytes
+        packedBytes += len(hdu)
+        dt += t
+    fastFits.writeHDUs(filename, hdus + tables)
+    return (rawBytes / packedBytes if packedBytes > 0 else 0.0), dt
+
+def dataPath():
+    """Return the directory for today's AG images, creating it if needed"""
 
     #path = os.path.join("$ICS_MHS_DATA_ROOT", 'agcc')
-    path = os.path.join('/data/raw', time.strftime('%Y-%m-%d', time.gmtime()), 'agcc')
+    path = os.path.join(dataRoot, time.strftime('%Y-%m-%d', time.gmtime()), 'agcc')
     path = os.path.expandvars(os.path.expanduser(path))
     if not os.path.isdir(path):
-        os.makedirs(path, 0o755)
+        try:
+            os.makedirs(path, 0o755, exist_ok=True)
+        except Exception as e:
+            raise RuntimeError(f'failed to makedirs({path}): {e}')
+    return path
+
+def fitsFilename(visitId, nframe, agcid=None):
+    """Return the FITS filename for a single camera, or the combined file if agcid is None"""
+
+    path = dataPath()
+    agc_exposure_id = nframe
+    if agcid is None:
+        return os.path.join(path, f'agcc_{visitId:06d}_{agc_exposure_id:08d}.fits')
+    return os.path.join(path, f'agcc_{visitId:06d}_{agc_exposure_id:08d}_cam{agcid+1}.fits')
+
+def seqFilename(cams, seq_id):
+    """Return the legacy sequence filename of a combined file"""
+
     if len(cams) > 0:
         now = datetime.fromtimestamp(cams[0].tstart)
     else:
         now = datetime.now()
     mtimestamp = now.strftime("%Y%m%d_%H%M%S%f")[:-5]
-    
+    return os.path.join(dataPath(), 'agcc_s%d_%s.fits' % (seq_id + 1, mtimestamp))
+
+def frameCards(cam, visitId, nframe, seq_id=-1):
+    """Return the header cards (keyword, value, comment) of a camera frame"""
+
+    # astropy refuses NaN values: a temperature which could not be read is undefined
+    temperature = telemetry.temperature(cam)
+    if temperature is not None and not np.isfinite(temperature):
+        temperature = None
+    cards = [
+        ('DATE', cam.timestamp, 'exposure begin date'),
+        ('INSTRUME', cam.devname, 'this instrument'),
+        ('SERIAL', cam.devsn, 'serial number'),
+        ('EXPTIME', cam.exptime, 'exposure time (ms)'),
+        ('VBIN', cam.vbin, 'vertical binning'),
+        ('HBIN', cam.hbin, 'horizontal binning'),
+        ('CCD-TEMP', temperature, 'CCD temperature'),
+    ]
+    if(cam.dark != 0):
+        cards.append(('SHUTTER', 'CLOSE', 'shutter status'))
+    else:
+        cards.append(('SHUTTER', 'OPEN', 'shutter status'))
+    cards.append(('CCDAREA', '[%d:%d,%d:%d]' % cam.expArea, 'image area'))
+    cards.append(('FRAMEID', nframe, 'unique key for exposure'))
+    cards.append(('VISITID', visitId, 'visit id'))
+    if getattr(cam, 'nstack', 1) > 1:
+        cards.append(('NSTACK', cam.nstack, 'frames in the mean image'))
     if seq_id >= 0:
-        filename = os.path.join(path, 'agcc_s%d_%s.fits' % (seq_id + 1, mtimestamp))
+        cards.append(('REGION1', '[%d,%d,%d]' % cam.regions[0], 'region 1'))
+        cards.append(('REGION2', '[%d,%d,%d]' % cam.regions[1], 'region 2'))
+    return cards
+
+@functools.lru_cache(maxsize=8)
+def spotsTableDtype(dtype):
+    """Return the spot record dtype with the FITS column names, same memory layout"""
+
+    names = [spotColumns.get(name, name) for name in dtype.names]
+    formats = [dtype.fields[name][0] for name in dtype.names]
+    offsets = [dtype.fields[name][1] for name in dtype.names]
+    return np.dtype(dict(names=names, formats=formats, offsets=offsets, itemsize=dtype.itemsize))
+
+def spotsRecords(spots):
+    """Return the spots as a record array with the FITS column names, without copying"""
+
+    return spots.view(spotsTableDtype(spots.dtype))
+
+def spotsHDU(spots):
+    """Return the binary table HDU of the measured spots, with every spot field"""
+
+    return pyfits.BinTableHDU(data=spotsRecords(spots))
+
+def spotsTable(spots, extname=None):
+    """Return the buffers of the spot table HDU for the direct writer"""
+
+    return fastFits.tableHDU(spotsRecords(spots), extname)
+
+def writeSingle(filename, data, cards, spots):
+    """Write one camera frame, and its spots if any, to a FITS file
+
+    Returns (compression ratio, compression time) for a compressed file, else None
+    """
+
+    if compression is not None:
+        tables = [] if spots is None else [spotsTable(spots)]
+        return writeCompressed(filename, [(compressFrame(data, cards), data.nbytes)], tables)
+
+    if engine == 'direct' and fastFits.supports(data):
+        hdus = [fastFits.imageHDU(data, cards)]
+        if spots is not None:
+            hdus.append(spotsTable(spots))
+        fastFits.writeHDUs(filename, hdus)
+        return
+
+    hdu = pyfits.PrimaryHDU(data)
+    hdr = hdu.header
+    for key, value, comment in cards:
+        hdr.set(key, value, comment)
+
+    if spots is not None:
+        hdulist = pyfits.HDUList([hdu, spotsHDU(spots)])
+        hdulist.writeto(filename, checksum=True, overwrite=True)
     else:
-        filename = os.path.join(path, 'agcc_%s.fits' % mtimestamp)
+        hdu.writeto(filename, overwrite=True, checksum=True)
 
-    #pfsFilename = os.path.join(path, f'PFSD{visitId:06d}.fits')
-    agc_exposure_id = nframe
-    pfsFilename = os.path.join(path, f'agcc_{visitId:06d}_{agc_exposure_id:08d}.fits')
+def writeCombined(filename, frames):
+    """Write the frames of all cameras to a single FITS file
+
+    Args:
+       filename - output FITS file
+       frames   - dict of agcid: (data, cards, spots) for the cameras to write
+    Returns:
+       (compression ratio, compression time) for a compressed file, else None
+    """
+
+    if compression is not None:
+        images = []
+        tables = []
+        for n in range(6):
+            if n not in frames or frames[n][0].size == 0:
+                images.append(None)
+                continue
+            data, cards, spots = frames[n]
+            images.append((compressFrame(data, cards, "cam%d" % (n + 1)), data.nbytes))
+            if spots is not None:
+                tables.append(spotsTable(spots, "table%d" % (n + 1)))
+        return writeCompressed(filename, images, tables)
+
+    if engine == 'direct' and all(fastFits.supports(f[0]) for f in frames.values()):
+        hdus = [fastFits.imageHDU(None, [])]
+        tables = []
+        for n in range(6):
+            extname = "cam%d" % (n + 1)
+            if n not in frames:
+                hdus.append(fastFits.imageHDU(None, [], extname, extension=True))
+                continue
+            data, cards, spots = frames[n]
+            hdus.append(fastFits.imageHDU(data, cards, extname, extension=True))
+            if spots is not None:
+                tables.append(spotsTable(spots, "table%d" % (n + 1)))
+        fastFits.writeHDUs(filename, hdus + tables)
+        return
 
     hdulist = pyfits.HDUList([pyfits.PrimaryHDU()])
+    tables = []
     for n in range(6):
         extname = "cam%d" % (n + 1)
-
-        for cam in cams:
-            if cam.agcid == n:
-                break
-        else:
+        if n not in frames:
             hdulist.append(pyfits.ImageHDU(name=extname))
             continue
 
-        hdu = pyfits.ImageHDU(cam.data, name=extname)
+        data, cards, spots = frames[n]
+        hdu = pyfits.ImageHDU(data, name=extname)
         hdr = hdu.header
-        hdr.set('DATE', cam.timestamp, 'exposure begin date')
-        hdr.set('INSTRUME', cam.devname, 'this instrument')
-        hdr.set('SERIAL', cam.devsn, 'serial number')
-        hdr.set('EXPTIME', cam.exptime, 'exposure time (ms)')
-        hdr.set('VBIN', cam.vbin, 'vertical binning')
-        hdr.set('HBIN', cam.hbin, 'horizontal binning')
-        hdr.set('CCD-TEMP', cam.getTemperature(), 'CCD temperature')
-        if(cam.dark != 0):
-            hdr.set('SHUTTER', 'CLOSE', 'shutter status')
-        else:
-            hdr.set('SHUTTER', 'OPEN', 'shutter status')
-        hdr.set('CCDAREA', '[%d:%d,%d:%d]' % cam.expArea, 'image area')
-        hdr.set('FRAMEID', nframe, 'unique key for exposure')
-        hdr.set('VISITID', visitId, 'visit id')
-        if seq_id >= 0:
-            hdr.set('REGION1', '[%d,%d,%d]' % cam.regions[0], 'region 1')
-            hdr.set('REGION2', '[%d,%d,%d]' % cam.regions[1], 'region 2')
-        hdulist.insert(n+1, hdu)
-
-        if cam.spots is not None:
-            c1 = pyfits.Column(name='moment_00', format='E', array=cam.spots['image_moment_00_pix'])
-            c2 = pyfits.Column(name='centroid_x', format='E', array=cam.spots['centroid_x_pix'])
-            c3 = pyfits.Column(name='centroid_y', format='E', array=cam.spots['centroid_y_pix'])
-            c4 = pyfits.Column(name='moment_20', format='E', array=cam.spots['central_image_moment_20_pix'])
-            c5 = pyfits.Column(name='moment_11', format='E', array=cam.spots['central_image_moment_11_pix'])
-            c6 = pyfits.Column(name='moment_02', format='E', array=cam.spots['central_image_moment_02_pix'])
-            c7 = pyfits.Column(name='peak_x', format='I', array=cam.spots['peak_pixel_x_pix'])
-            c8 = pyfits.Column(name='peak_y', format='I', array=cam.spots['peak_pixel_y_pix'])
-            c9 = pyfits.Column(name='peak_intensity', format='E', array=cam.spots['peak_intensity'])
-            c10 = pyfits.Column(name='background', format='E', array=cam.spots['background'])
-
-            tbhdu = pyfits.BinTableHDU.from_columns([c1, c2, c3, c4, c5, c6, c7, c8, c9, c10])
+        for key, value, comment in cards:
+            hdr.set(key, value, comment)
+        hdulist.append(hdu)
+
+        if spots is not None:
+            tbhdu = spotsHDU(spots)
             tbhdu.name = "table%d" % (n + 1)
-            hdulist.append(tbhdu)
+            tables.append(tbhdu)
+
+    hdulist.extend(tables)
+    hdulist.writeto(filename, checksum=True, overwrite=True)
+
+class CombinedWriter(object):
+    """Assemble a combined file as the camera frames arrive
+
+    With the direct engine each frame goes into its preallocated extension
+    as soon as it is added; with compression each frame is submitted to the
+    compression pool as soon as it is added; otherwise the frames are kept
+    and written by writeCombined when the file is closed.
+    """
+
+    def __init__(self, filename, shapes):
+        """
+        Args:
+           filename - output FITS file
+           shapes   - dict of agcid: (ny, nx) of the expected frames
+        """
+        self.filename = filename
+        self.frames = {}
+        self.nAdded = 0
+        self.lock = threading.Lock()
+        self.compressed = {}
+        self.compressionStats = None
+        if compression is None and engine == 'direct':
+            self.direct = fastFits.CombinedFile(filename, shapes)
+        else:
+            self.direct = None
 
-    #hdulist.writeto(filename, checksum=True, overwrite=True)
-    hdulist.writeto(pfsFilename, checksum=True, overwrite=True)
-    
-    # Now make a symbolic link 
-    #os.symlink(filename, filename)
+    def add(self, agcid, data, cards, spots):
+        """Add a camera frame, return True if the data buffer may be released"""
+
+        if compression is not None:
+            if data.size > 0:
+                future = compressFrame(data, cards, "cam%d" % (agcid + 1))
+                self.addCompressed(agcid, future, data.nbytes, spots)
+            else:
+                with self.lock:
+                    self.nAdded += 1
+            return False
+
+        with self.lock:
+            self.nAdded += 1
+        if self.direct is not None and self.direct.add(agcid, data, cards, spots):
+            return True
+        with self.lock:
+            self.frames[agcid] = (data, cards, spots)
+        return False
+
+    def addCompressed(self, agcid, future, nbytes, spots):
+        """Add a camera frame already submitted to the compression pool
+
+        Args:
+           agcid  - camera id
+           future - future of compressHDU
+           nbytes - uncompressed size of the frame
+           spots  - spots of the frame, or None
+        """
+
+        with self.lock:
+            self.nAdded += 1
+            self.compressed[agcid] = (future, nbytes, spots)
+
+    def close(self):
+        """Write the file, return False if no frame was added"""
+
+        if self.nAdded == 0:
+            if self.direct is not None:
+                self.direct.discard()
+            return False
+        if compression is not None:
+            images = [self.compressed[n][:2] if n in self.compressed else None for n in range(6)]
+            tables = [spotsTable(self.compressed[n][2], "table%d" % (n + 1)) for n in range(6)
+                      if n in self.compressed and self.compressed[n][2] is not None]
+            self.compressionStats = writeCompressed(self.filename, images, tables)
+        elif self.direct is not None:
+            self.direct.close(self.frames, spotsTable)
+        else:
+            writeCombined(self.filename, self.frames)
+        return True
+
+def frameShape(cam):
+    """Return the expected (ny, nx) of the next frame of a camera"""
+
+    return (cam.ysize, cam.xsize)
+
+def wfits(cmd, visitId, cam, nframe):
+    """Write the image to a FITS file"""
+
+    if(cam.data.size == 0):
+        cmd.warn('text="No image available for AGC[%d]"' % (cam.agcid + 1))
+        return
+
+    pfsFilename = fitsFilename(visitId, nframe, cam.agcid)
+    stats = writeSingle(pfsFilename, cam.data, frameCards(cam, visitId, nframe), cam.spots)
+
+    cam.filename = pfsFilename
+    if cmd:
+        cmd.inform('agc%d_fitsfile="%s",%.1f' % (cam.agcid + 1, pfsFilename, cam.tstart))
+        if stats is not None:
+            cmd.inform('agc%d_compression=%s,%.2f,%.3f' % ((cam.agcid + 1, compression) + stats))
+        cmd.inform(f'text="AG images are NOT written into {pfsFilename}"')
+
+def wfits_combined(cmd, visitId, cams, nframe, seq_id=-1, combinedWriter=None):
+    """Write the images to a FITS file
+
+    If combinedWriter is given, the frames were already added to it as the
+    cameras finished and only the file is closed here.
+    """
+
+    if combinedWriter is not None:
+        pfsFilename = combinedWriter.filename
+        if not combinedWriter.close():
+            return
+        stats = combinedWriter.compressionStats
+    else:
+        pfsFilename = fitsFilename(visitId, nframe)
+        frames = {}
+        for cam in cams:
+            frames[cam.agcid] = (cam.data, frameCards(cam, visitId, nframe, seq_id), cam.spots)
+        stats = writeCombined(pfsFilename, frames)
 
     if cmd:
         if seq_id >= 0:
-            cmd.inform('agc_seq%d="%s"' % (seq_id + 1, filename))
+            cmd.inform('agc_seq%d="%s"' % (seq_id + 1, seqFilename(cams, seq_id)))
         else:
             cmd.inform('agc_fitsfile="%s",%.1f' % (pfsFilename, cams[0].tstart))
+        if stats is not None:
+            cmd.inform('agc_compression=%s,%.2f,%.3f' % ((compression,) + stats))
         cmd.inform(f'text="AG images are NOT written into {pfsFilename}"')
@@ -0,0 +1,31 @@
+import os
+import sys
+import warnings
+
+import astropy.io.fits as pyfits
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'python', 'agccActor'))
+
+import fastFits  # noqa: E402
+
+
+@pytest.mark.parametrize('value', [float('nan'), float('inf'), -np.inf, np.float32('nan')])
+def test_nonFiniteCardIsUndefined(tmp_path, value):
+    data = np.arange(12, dtype=np.uint16).reshape(3, 4)
+    cards = [('CCD-TEMP', value, 'CCD temperature'), ('EXPTIME', 1000, 'exposure time (ms)')]
+    filename = str(tmp_path / 'frame.fits')
+    fastFits.writeHDUs(filename, [fastFits.imageHDU(data, cards)])
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        with pyfits.open(filename, checksum=True) as hdulist:
+            hdulist.verify('exception')
+            header = hdulist[0].header
+            # an undefined value: blank value field, read back as None (or Undefined)
+            assert header.cards['CCD-TEMP'].image[10:30].strip() == ''
+            assert header['CCD-TEMP'] is None or isinstance(header['CCD-TEMP'], pyfits.card.Undefined)
+            assert header.comments['CCD-TEMP'] == 'CCD temperature'
+            assert header['EXPTIME'] == 1000
+            assert (hdulist[0].data == data).all()